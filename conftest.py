@@ -0,0 +1,47 @@
+import pytest
+
+from lstore.db import Database
+from lstore.query import Query
+
+
+class Databases:
+    """
+    Opens the database of a test at its tmp_path, one at a time
+    Opening it again closes the one still open first, as does the end of the test
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.db = None  # the database open now, if any
+
+    def open(self, create=False):
+        """
+        Open the database and its 3 column Grades table keyed on column 0, creating the table if create is set
+        Returns (db, table, query)
+        """
+        self.close()
+        db = Database()
+        db.open(self.path)
+        self.db = db
+        table = db.create_table('Grades', 3, 0) if create else db.get_table('Grades')
+        return db, table, Query(table)
+
+    def close(self):
+        if self.db is not None:
+            db, self.db = self.db, None
+            db.close()
+
+
+@pytest.fixture
+def databases(tmp_path):
+    databases = Databases(tmp_path)
+    yield databases
+    databases.close()
+
+
+@pytest.fixture
+def grades(databases):
+    """
+    (db, table, query) of a new database with an empty Grades table, closed at the end of the test
+    """
+    return databases.open(create=True)
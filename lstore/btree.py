@@ -0,0 +1,592 @@
+"""
+Paged B+tree, the on-disk form of a column index.
+Every column index of a table is one file, {path}/tables/{table}/index{column}.bin, made of PAGE_SIZE blocks:
+    blocks 0, 1     header slots, the valid one with the higher generation describes the last saved tree
+    blocks 2...     tree nodes and free list pages
+Tree nodes are bufferpool pages keyed (table, column, node id, 'i'). They are faulted in on first use and
+written back on eviction like any other page, so an index is never read whole.
+
+The tree is a B+tree over (value, chunk) keys, the chunk being the page part of a RID (see
+lstore/postings.py). A leaf holds, for each of its sorted keys, the container of slots of the records on that
+page indexed under that value, so the posting list of a value is the run of containers under its keys and a
+dense value costs a bitmap per page instead of an entry per record. Inner nodes hold separators and child
+node ids. Nodes are not chained: a range cursor finds the next leaf by descending again past the last key
+it returned, which keeps it valid while the tree changes between two steps.
+
+Saves are copy-on-write. A node that belongs to a saved tree is never changed in place; the first change
+after a save copies it, and the path above it up to the root, to new node ids. Whatever reaches the file
+between two saves, the nodes reachable from the last saved root stay intact. A save writes the new nodes,
+syncs them, then writes the header of the new tree into the other slot. Node ids freed by the copies are
+reused once a header no longer referencing them is durable.
+Deletes never merge nodes, an emptied leaf stays in place and takes later inserts into its key range.
+"""
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+
+from lstore.config import *
+from lstore.postings import *
+
+TREE_MAGIC = b'LSBT'
+TREE_FORMAT_VERSION = 2
+TREE_HEADER_FORMAT = '<4sHqqqqq'  # magic, version, generation, root, blocks in use, free list head, free ids
+TREE_HEADER_SIZE = struct.calcsize(TREE_HEADER_FORMAT)
+NODE_MAGIC = b'LSBN'
+NODE_FORMAT = '<4sBHq'  # magic, leaf, entry or separator count, generation
+NODE_SIZE = struct.calcsize(NODE_FORMAT)
+ENTRY_SIZE = 18  # leaf entry besides its container: value, chunk and slot count
+FREE_MAGIC = b'LSBF'
+FREE_FORMAT = '<4sqI'  # magic, next free list page, ids in this page
+FREE_SIZE = struct.calcsize(FREE_FORMAT)
+
+LEAF_CAPACITY = PAGE_SIZE - NODE_SIZE  # bytes of entries per leaf
+INNER_CAPACITY = (PAGE_SIZE - NODE_SIZE - 8) // 24  # separators per inner node, each with a child id
+FREE_IDS_PER_PAGE = (PAGE_SIZE - FREE_SIZE) // 8
+FIRST_NODE = 2  # blocks before this one are header slots
+NULL_NODE = -1
+MIN_CHUNK = -(1 << 63)  # sorts before every chunk
+
+
+class Node:
+    def __init__(self, node_id, generation, leaf, keys=None, children=None, size=None):
+        self.id = node_id
+        self.generation = generation  # generation of the tree the node was created in
+        self.leaf = leaf
+        self.keys = keys if keys is not None else []  # leaf: sorted (value, chunk) keys, inner: separators
+        # leaf: the container of each key, inner: child node ids, one more than keys
+        self.children = children if children is not None else []
+        self.size = size  # leaf only, bytes taken by the entries
+        if size is None:
+            self.resize()
+
+    def resize(self):
+        if self.leaf:
+            self.size = sum(entry_size(container) for container in self.children)
+
+    def encode(self):
+        data = bytearray(PAGE_SIZE)
+        struct.pack_into(NODE_FORMAT, data, 0, NODE_MAGIC, self.leaf, len(self.keys), self.generation)
+        if self.leaf:
+            # the values, chunks and slot counts of all entries, then their containers
+            count = len(self.keys)
+            struct.pack_into(f'<{count}q', data, NODE_SIZE, *(value for value, _ in self.keys))
+            struct.pack_into(f'<{count}q', data, NODE_SIZE + 8 * count, *(chunk for _, chunk in self.keys))
+            counts = [container.bit_count() if isinstance(container, int) else len(container)
+                      for container in self.children]
+            struct.pack_into(f'<{count}H', data, NODE_SIZE + 16 * count, *counts)
+            pack_containers(self.children, data, NODE_SIZE + ENTRY_SIZE * count)
+            return data
+        flat = [part for key in self.keys for part in key]
+        struct.pack_into(f'<{len(flat)}q', data, NODE_SIZE, *flat)
+        struct.pack_into(f'<{len(self.children)}q', data, NODE_SIZE + 8 * len(flat), *self.children)
+        return data
+
+
+def entry_size(container):
+    return ENTRY_SIZE + container_bytes(container)
+
+
+def decode_node(node_id, data):
+    """
+    Returns the node stored in a block, or None if the block holds no node
+    """
+    if data[:4] != NODE_MAGIC:
+        return None
+    magic, leaf, count, generation = struct.unpack_from(NODE_FORMAT, data, 0)
+    if leaf:
+        values = struct.unpack_from(f'<{count}q', data, NODE_SIZE)
+        chunks = struct.unpack_from(f'<{count}q', data, NODE_SIZE + 8 * count)
+        counts = struct.unpack_from(f'<{count}H', data, NODE_SIZE + 16 * count)
+        containers, size = unpack_containers(counts, data, NODE_SIZE + ENTRY_SIZE * count)
+        return Node(node_id, generation, True, list(zip(values, chunks)), containers, ENTRY_SIZE * count + size)
+    flat = struct.unpack_from(f'<{2 * count}q', data, NODE_SIZE)
+    keys = list(zip(flat[0::2], flat[1::2]))
+    children = list(struct.unpack_from(f'<{count + 1}q', data, NODE_SIZE + 16 * count))
+    return Node(node_id, generation, False, keys, children)
+
+
+class TreeSnapshot:
+    """
+    A generation of a tree frozen by BPlusTree.freeze, waiting for BPlusTree.save to make it durable
+    """
+
+    def __init__(self, generation, root, next_id, nodes, freed, recorded, pages):
+        self.generation = generation
+        self.root = root
+        self.next_id = next_id
+        self.nodes = nodes  # ids of the nodes created in this generation
+        self.freed = freed  # ids this generation stopped using, free once its header is durable
+        self.recorded = recorded  # ids the header lists as free
+        self.pages = pages  # ids of the pages holding that list
+
+
+class BPlusTree:
+    def __init__(self, bufferpool, table_name, column, fresh=False):
+        self.bufferpool = bufferpool
+        self.disk = bufferpool.disk
+        self.table_name = table_name
+        self.column = column
+        self.free = []  # node ids ready for reuse
+        self.freed = []  # node ids given up since the last save, reused once the next save is durable
+        self.written = set()  # ids of the nodes created since the last save
+        header = None if fresh else self.read_header()
+        if header is None:
+            # start over, a stale file could otherwise win over the headers of the new tree
+            self.disk.truncate_index(table_name, column)
+            self.generation = 1
+            self.next_id = FIRST_NODE
+            root = self.new_node(True)
+            root.unpin_page()
+            self.root = root.node.id
+        else:
+            _, _, saved_generation, self.root, self.next_id, free_head, _ = header
+            self.generation = saved_generation + 1
+            self.free, self.freed = self.read_free_list(free_head)
+
+    def page_key(self, node_id):
+        return (self.table_name, self.column, node_id, 'i')
+
+    def read_header(self):
+        """
+        Returns the newest intact header, or None if the tree was never saved
+        """
+        best = None
+        for slot in (0, 1):
+            data = self.disk.read_index_block(self.table_name, self.column, slot)
+            if len(data) < TREE_HEADER_SIZE + 4 or data[:4] != TREE_MAGIC:
+                continue
+            (checksum,) = struct.unpack_from('<I', data, TREE_HEADER_SIZE)
+            if zlib.crc32(data[:TREE_HEADER_SIZE]) != checksum:
+                continue  # torn by a crash while it was written
+            header = struct.unpack_from(TREE_HEADER_FORMAT, data, 0)
+            if header[1] != TREE_FORMAT_VERSION:
+                raise Exception(f"error in read_header, unsupported index format version: {header[1]}")
+            if best is None or header[2] > best[2]:
+                best = header
+        return best
+
+    def read_free_list(self, page_id):
+        """
+        Returns the free ids listed from page_id on and the ids of the pages listing them
+        """
+        ids = []
+        pages = []
+        while page_id != NULL_NODE:
+            data = self.disk.read_index_block(self.table_name, self.column, page_id)
+            magic, next_page, count = struct.unpack_from(FREE_FORMAT, data, 0)
+            if magic != FREE_MAGIC:
+                raise Exception(f"error in read_free_list, not a free list page: {page_id}")
+            ids.extend(struct.unpack_from(f'<{count}q', data, FREE_SIZE))
+            pages.append(page_id)
+            page_id = next_page
+        return ids, pages
+
+    def fetch(self, node_id):
+        # a node, faulted in if needed
+        # taken from its frame under the page table latch, the frame may be evicted or reused once it is released
+        with self.bufferpool.latch:
+            node = self.bufferpool.frames[self.bufferpool.get_frame_index(self.page_key(node_id))].node
+        if node is None:
+            raise Exception(f"error in fetch, index node missing: {self.page_key(node_id)}")
+        return node
+
+    def new_node(self, leaf, keys=None, children=None):
+        """
+        Allocate a node of the current generation and return its frame, pinned and dirty
+        """
+        if self.free:
+            node_id = self.free.pop()
+        else:
+            node_id = self.next_id
+            self.next_id += 1
+        frame = self.bufferpool.frames[self.bufferpool.new_page(self.page_key(node_id))]
+        frame.node = Node(node_id, self.generation, leaf, keys, children)
+        frame.mark_dirty()
+        self.written.add(node_id)
+        return frame
+
+    def find_leaf(self, key):
+        node = self.fetch(self.root)
+        while not node.leaf:
+            node = self.fetch(node.children[bisect_right(node.keys, key)])
+        return node
+
+    def find(self, key):
+        # the container under key, None if there is none
+        leaf = self.find_leaf(key)
+        position = bisect_left(leaf.keys, key)
+        if position < len(leaf.keys) and leaf.keys[position] == key:
+            return leaf.children[position]
+        return None
+
+    def __contains__(self, entry):
+        value, rid = entry
+        container = self.find((value, rid >> CHUNK_BITS))
+        return container is not None and container_contains(container, rid & SLOT_MASK)
+
+    def writable_path(self, key):
+        """
+        Pin the frames from the root down to the leaf where key belongs and return them, with the child
+        position taken at each inner node
+        Nodes of a saved generation on the way are replaced by copies, so the whole path can be changed in place
+        """
+        frames = []
+        positions = []
+        node_id = self.root
+        while True:
+            # pinned as it is faulted in, so it cannot be evicted in between
+            frame = self.bufferpool.frames[self.bufferpool.pin(self.page_key(node_id))]
+            node = frame.node
+            if node.generation < self.generation:
+                copy = self.new_node(node.leaf, list(node.keys), list(node.children))
+                frame.unpin_page()
+                self.freed.append(node_id)
+                frame = copy
+                if frames:
+                    frames[-1].node.children[positions[-1]] = frame.node.id
+                    frames[-1].mark_dirty()
+                else:
+                    self.root = frame.node.id
+            frames.append(frame)
+            if frame.node.leaf:
+                return frames, positions
+            position = bisect_right(frame.node.keys, key)
+            positions.append(position)
+            node_id = frame.node.children[position]
+
+    def split(self, frames, positions, appended=False):
+        """
+        Split the overfull nodes of a writable path, from the leaf up
+        A new root is added to the front of frames, so the caller unpins it with the rest of the path
+        """
+        level = len(frames) - 1
+        while True:
+            node = frames[level].node
+            if (node.size <= LEAF_CAPACITY) if node.leaf else (len(node.keys) <= INNER_CAPACITY):
+                return
+            separators, siblings = self.split_node(node, appended)
+            frames[level].mark_dirty()
+            appended = False
+            if level == 0:
+                root = self.new_node(False, separators, [node.id] + siblings)
+                self.root = root.node.id
+                frames.insert(0, root)
+                positions.insert(0, 0)
+            else:
+                level -= 1
+                parent = frames[level]
+                position = positions[level]
+                parent.node.keys[position:position] = separators
+                parent.node.children[position + 1:position + 1] = siblings
+                parent.mark_dirty()
+
+    def split_node(self, node, appended):
+        """
+        Spread an overfull node over itself and new right siblings
+        Returns the separators to add to the parent and the ids of the siblings
+        """
+        if node.leaf:
+            if appended:
+                # entries arriving in order leave the left node full
+                target = LEAF_CAPACITY
+            else:
+                pieces = -(-node.size // LEAF_CAPACITY)
+                target = -(-node.size // pieces)
+            # pieces of up to target bytes, entries differ in size
+            bounds = [0]
+            used = 0
+            for i, container in enumerate(node.children):
+                size = entry_size(container)
+                if used and used + size > target:
+                    bounds.append(i)
+                    used = 0
+                used += size
+            bounds.append(len(node.keys))
+            groups = [(node.keys[start:end], node.children[start:end]) for start, end in zip(bounds, bounds[1:])]
+            separators = [keys[0] for keys, _ in groups[1:]]
+        else:
+            # the separator between two pieces moves up to the parent
+            pieces = -(-(len(node.keys) + 1) // (INNER_CAPACITY + 1))
+            bounds = [len(node.children) * i // pieces for i in range(pieces + 1)]
+            groups = [(node.keys[start:end - 1], node.children[start:end]) for start, end in zip(bounds, bounds[1:])]
+            separators = [node.keys[end - 1] for end in bounds[1:-1]]
+        node.keys, node.children = groups[0]
+        node.resize()
+        siblings = []
+        for keys, children in groups[1:]:
+            frame = self.new_node(node.leaf, keys, children)
+            siblings.append(frame.node.id)
+            frame.unpin_page()
+        return separators, siblings
+
+    def insert(self, entry):
+        """
+        Add a (value, rid) entry, returns False if it is already there
+        """
+        value, rid = entry
+        key = (value, rid >> CHUNK_BITS)
+        frames, positions = self.writable_path(key)
+        try:
+            leaf = frames[-1].node
+            position = bisect_left(leaf.keys, key)
+            if position < len(leaf.keys) and leaf.keys[position] == key:
+                old = leaf.children[position]
+                container = container_add(old, rid & SLOT_MASK)
+                if container is None:
+                    return False
+                leaf.children[position] = container
+                leaf.size += container_bytes(container) - container_bytes(old)
+                appended = False
+            else:
+                container = (rid & SLOT_MASK,)
+                leaf.keys.insert(position, key)
+                leaf.children.insert(position, container)
+                leaf.size += entry_size(container)
+                appended = position == len(leaf.keys) - 1
+            frames[-1].mark_dirty()
+            self.split(frames, positions, appended)
+            return True
+        finally:
+            for frame in frames:
+                frame.unpin_page()
+
+    def insert_many(self, entries):
+        """
+        Add many (value, rid) entries given in sorted order without duplicates, every leaf takes its whole
+        run of them at once
+        """
+        keys = []
+        slots = []
+        for value, rid in entries:
+            key = (value, rid >> CHUNK_BITS)
+            if not keys or keys[-1] != key:
+                keys.append(key)
+                slots.append([])
+            slots[-1].append(rid & SLOT_MASK)
+        containers = [make_container(run) for run in slots]
+
+        start = 0
+        while start < len(keys):
+            frames, positions = self.writable_path(keys[start])
+            try:
+                # the leaf covers the keys below the nearest separator right of the path
+                bound = None
+                for frame, position in zip(frames, positions):
+                    if position < len(frame.node.keys):
+                        bound = frame.node.keys[position]
+                end = len(keys) if bound is None else bisect_left(keys, bound, start)
+                leaf = frames[-1].node
+                if not leaf.keys or leaf.keys[-1] < keys[start]:
+                    leaf.keys.extend(keys[start:end])
+                    leaf.children.extend(containers[start:end])
+                else:
+                    merged = dict(zip(leaf.keys, leaf.children))
+                    for key, container in zip(keys[start:end], containers[start:end]):
+                        current = merged.get(key)
+                        merged[key] = container if current is None else container_union(current, container)
+                    leaf.keys = sorted(merged)
+                    leaf.children = [merged[key] for key in leaf.keys]
+                leaf.resize()
+                frames[-1].mark_dirty()
+                self.split(frames, positions)
+            finally:
+                for frame in frames:
+                    frame.unpin_page()
+            start = end
+
+    def delete_many(self, entries):
+        """
+        Remove many (value, rid) entries given in sorted order without duplicates, every leaf drops its whole
+        run of them at once
+        Returns the entries that were there, in the same order
+        """
+        keys = []
+        slots = []
+        for value, rid in entries:
+            key = (value, rid >> CHUNK_BITS)
+            if not keys or keys[-1] != key:
+                keys.append(key)
+                slots.append([])
+            slots[-1].append(rid & SLOT_MASK)
+
+        removed = []
+        start = 0
+        while start < len(keys):
+            frames, positions = self.writable_path(keys[start])
+            try:
+                # the leaf covers the keys below the nearest separator right of the path
+                bound = None
+                for frame, position in zip(frames, positions):
+                    if position < len(frame.node.keys):
+                        bound = frame.node.keys[position]
+                end = len(keys) if bound is None else bisect_left(keys, bound, start)
+                leaf = frames[-1].node
+                for key, run in zip(keys[start:end], slots[start:end]):
+                    position = bisect_left(leaf.keys, key)
+                    if position == len(leaf.keys) or leaf.keys[position] != key:
+                        continue
+                    container = leaf.children[position]
+                    for slot in run:
+                        if container_contains(container, slot):
+                            container = container_remove(container, slot)
+                            removed.append((key[0], key[1] << CHUNK_BITS | slot))
+                    if container:
+                        leaf.children[position] = container
+                    else:
+                        leaf.keys.pop(position)
+                        leaf.children.pop(position)
+                leaf.resize()
+                frames[-1].mark_dirty()
+            finally:
+                for frame in frames:
+                    frame.unpin_page()
+            start = end
+        return removed
+
+    def delete(self, entry):
+        """
+        Remove a (value, rid) entry, returns False if it is not there
+        """
+        if entry not in self:
+            return False
+        value, rid = entry
+        key = (value, rid >> CHUNK_BITS)
+        frames, positions = self.writable_path(key)
+        try:
+            leaf = frames[-1].node
+            position = bisect_left(leaf.keys, key)
+            old = leaf.children[position]
+            container = container_remove(old, rid & SLOT_MASK)
+            if container:
+                leaf.children[position] = container
+                leaf.size += container_bytes(container) - container_bytes(old)
+            else:
+                leaf.keys.pop(position)
+                leaf.children.pop(position)
+                leaf.size -= entry_size(old)
+            frames[-1].mark_dirty()
+            return True
+        finally:
+            for frame in frames:
+                frame.unpin_page()
+
+    def next_run(self, key, after):
+        """
+        The (key, container) pairs of the first leaf holding any from key on, or past key if after is set
+        key None starts from the smallest key; returns [] once the tree is exhausted
+        """
+        stack = []  # (inner node, child position) from the root down
+        node = self.fetch(self.root)
+        while True:
+            if not node.leaf:
+                position = 0 if key is None else bisect_right(node.keys, key)
+                stack.append((node, position))
+                node = self.fetch(node.children[position])
+                continue
+            if key is None:
+                start = 0
+            elif after:
+                start = bisect_right(node.keys, key)
+            else:
+                start = bisect_left(node.keys, key)
+            if start < len(node.keys):
+                return list(zip(node.keys[start:], node.children[start:]))
+            # nothing left in this leaf, continue with the next subtree to the right
+            while stack and stack[-1][1] + 1 >= len(stack[-1][0].children):
+                stack.pop()
+            if not stack:
+                return []
+            parent, position = stack.pop()
+            stack.append((parent, position + 1))
+            node = self.fetch(parent.children[position + 1])
+            key = None
+
+    def runs(self, low=None, high=None):
+        """
+        Range cursor over the (value, chunk, container) of the keys with low <= value <= high, in order
+        None leaves that end of the range open
+        """
+        key = None if low is None else (low, MIN_CHUNK)
+        after = False
+        while True:
+            run = self.next_run(key, after)
+            if not run:
+                return
+            for (value, chunk), container in run:
+                if high is not None and value > high:
+                    return
+                yield value, chunk, container
+            key = run[-1][0]
+            after = True
+
+    def items(self, low=None, high=None):
+        """
+        Range cursor over the (value, rid) entries with low <= value <= high, in order
+        """
+        for value, chunk, container in self.runs(low, high):
+            base = chunk << CHUNK_BITS
+            for slot in container_slots(container):
+                yield value, base | slot
+
+    def clear(self):
+        """
+        Remove every entry, the nodes of the tree are freed
+        """
+        stack = [self.root]
+        while stack:
+            node = self.fetch(stack.pop())
+            if not node.leaf:
+                stack.extend(node.children)
+            self.freed.append(node.id)
+            self.written.discard(node.id)
+        root = self.new_node(True)
+        root.unpin_page()
+        self.root = root.node.id
+
+    def freeze(self):
+        """
+        End the current generation and return it for save, or None if nothing changed since the last save
+        Called with the table latch held; the tree keeps working in the next generation meanwhile
+        """
+        if not self.written and not self.freed:
+            return None
+        freed, self.freed = self.freed, []
+        recorded = self.free + freed
+        # the free list pages go past the end of the file, so none of them is listed as free
+        count = -(-len(recorded) // FREE_IDS_PER_PAGE)
+        pages = list(range(self.next_id, self.next_id + count))
+        self.next_id += count
+        snapshot = TreeSnapshot(self.generation, self.root, self.next_id, sorted(self.written), freed, recorded, pages)
+        # referenced by this generation's header only, they are free once the next one is durable
+        self.freed = list(pages)
+        self.written = set()
+        self.generation += 1
+        return snapshot
+
+    def save(self, snapshot, latch):
+        """
+        Make a frozen generation durable: its nodes and free list first, then its header
+        Runs without the table latch (latch), which is taken for each node written
+        """
+        for node_id in snapshot.nodes:
+            self.bufferpool.flush_page(self.page_key(node_id), latch)
+        for i, page_id in enumerate(snapshot.pages):
+            ids = snapshot.recorded[i * FREE_IDS_PER_PAGE:(i + 1) * FREE_IDS_PER_PAGE]
+            next_page = snapshot.pages[i + 1] if i + 1 < len(snapshot.pages) else NULL_NODE
+            data = bytearray(PAGE_SIZE)
+            struct.pack_into(FREE_FORMAT, data, 0, FREE_MAGIC, next_page, len(ids))
+            struct.pack_into(f'<{len(ids)}q', data, FREE_SIZE, *ids)
+            self.disk.write_index_block(self.table_name, self.column, page_id, data)
+        self.disk.sync_index(self.table_name, self.column)
+
+        # write-ahead rule: the saved tree holds no change the log could still lose
+        self.bufferpool.wal.flush()
+        header = bytearray(PAGE_SIZE)
+        free_head = snapshot.pages[0] if snapshot.pages else NULL_NODE
+        struct.pack_into(TREE_HEADER_FORMAT, header, 0, TREE_MAGIC, TREE_FORMAT_VERSION, snapshot.generation,
+                         snapshot.root, snapshot.next_id, free_head, len(snapshot.recorded))
+        struct.pack_into('<I', header, TREE_HEADER_SIZE, zlib.crc32(header[:TREE_HEADER_SIZE]))
+        self.disk.write_index_block(self.table_name, self.column, snapshot.generation % 2, header)
+        self.disk.sync_index(self.table_name, self.column)
+        with latch:
+            self.free.extend(snapshot.freed)
@@ -1,313 +1,434 @@
-import os
-from datetime import datetime
+import array
+import threading
+from contextlib import contextmanager
 from typing import Optional
 
 from lstore.config import *
-from lstore.page import Page, PageRange
+from lstore.disk import DiskManager
+from lstore.latch import Latch
+from lstore.page import Page, PageRange, METADATA_COLUMNS
+from lstore.replacement import make_replacement_policy
+from lstore.rid import NULL_RID, rid_parts, rid_page_range, rid_page, rid_slot, rid_mark
+from lstore.wal import WriteAheadLog
 
 
 class Bufferpool:
     def __init__(self, path):
         self.frames: list[Frame] = []
         self.numFrames = 0
-        self.frame_directory = []
-        self.frame_info: list[Optional[tuple]] = [None] * FRAMECOUNT
-        self.page_ranges = {}  # In-memory storage of page ranges
+        self.frame_directory: dict[tuple, int] = {}  # page key -> frame slot
+        self.free_frames: list[int] = []  # frame slots not holding any page
+        self.frame_info: list[Optional[tuple]] = [None] * FRAMECOUNT  # frame slot -> page key
+        self.page_ranges = {}  # (table name, page range index) -> in-memory page range
+        self.table_columns = {}  # table name -> number of columns
+        self.replacement = make_replacement_policy(REPLACEMENT_POLICY, FRAMECOUNT)
         self.path = path
+        self.disk = DiskManager(path, STORAGE_MODE)
+        self.wal = WriteAheadLog(path)
+        # guards the page table, frames change pages only while it is held
+        # a frame's contents are guarded by its own latch instead, see Bufferpool.page
+        self.latch = threading.RLock()
 
     def has_capacity(self):
         return self.numFrames < FRAMECOUNT
 
-    def allocate_page_range(self, num_columns, page_range_index):
-        # Create new page range in memory
-        if page_range_index not in self.page_ranges:
-            self.page_ranges[page_range_index] = PageRange(num_columns)
-            # Pre-initialize base pages
-            for base_page_index in range(MAX_BASEPAGES_PER_RANGE):  # MAX_BASEPAGES_PER_RANGE
-                key_directory = (page_range_index, base_page_index, 'b')
-                frame_index = self.get_empty_frame(num_columns)
-                self.frame_info[frame_index] = key_directory
-                self.frames[frame_index].initialize_page()
-        return self.page_ranges[page_range_index]
+    def register_table(self, table_name, num_columns):
+        self.table_columns[table_name] = num_columns
+
+    def allocate_page_range(self, table_name, num_columns, page_range_index):
+        # Create new page range in memory, its pages are faulted in on first use
+        self.register_table(table_name, num_columns)
+        if (table_name, page_range_index) not in self.page_ranges:
+            self.page_ranges[(table_name, page_range_index)] = PageRange()
+        return self.page_ranges[(table_name, page_range_index)]
+
+    def table_page_ranges(self, table_name):
+        # (page range index, page range) of every page range of a table, in order
+        return sorted((key[1], page_range) for key, page_range in self.page_ranges.items() if key[0] == table_name)
 
     def get_frame_index(self, key_directory):
+        # the frame is not pinned, see pin for a frame that has to stay in the pool
+        with self.latch:
+            return self._get_frame_index(key_directory)
+
+    def pin(self, key_directory):
+        """
+        Frame index of a page, faulted in if needed and pinned before the page table latch is released,
+        so it cannot be evicted until the caller unpins it
+        """
+        with self.latch:
+            frame_index = self._get_frame_index(key_directory)
+            if frame_index is None:
+                raise Exception(f"error in pin, page not available, detail: {key_directory}")
+            self.frames[frame_index].pin_page()
+            return frame_index
+
+    @contextmanager
+    def page(self, key_directory, exclusive=False):
+        """
+        Pin a page and hold its frame latch, shared for reading or exclusive for changing it, while the with block runs
+        """
+        frame = self.frames[self.pin(key_directory)]
+        latch = frame.latch
+        try:
+            if exclusive:
+                latch.acquire_exclusive()
+                try:
+                    yield frame
+                finally:
+                    latch.release_exclusive()
+            else:
+                latch.acquire_shared()
+                try:
+                    yield frame
+                finally:
+                    latch.release_shared()
+        finally:
+            frame.unpin_page()
+
+    def record_page(self, table_name, rid, exclusive=False):
+        # the page holding a record, see page
+        return self.page((table_name, rid_page_range(rid), rid_page(rid), rid_mark(rid)), exclusive)
+
+    def _get_frame_index(self, key_directory):
         # First check if frame exists
-        for i in range(len(self.frame_info)):
-            if self.frame_info[i] == key_directory:
-                return i
-
-        page_range_index, page_index, mark = key_directory
-        # If not found, create a new frame
-        page_range = self.page_ranges.get(page_range_index)
-        if not page_range:
-            print(f"error in get_frame_index, page_range not found, detail: {key_directory}")
+        frame_index = self.frame_directory.get(key_directory)
+        if frame_index is not None:
+            self.replacement.record_access(frame_index)
+            return frame_index
+
+        table_name, page_range_index, page_index, mark = key_directory
+        # If not found, fault the page in from disk or start an empty one
+        num_columns = self.table_columns.get(table_name)
+        if not num_columns:
+            print(f"error in get_frame_index, table not registered, detail: {key_directory}")
             return None
 
-        frame_index = self.get_empty_frame(page_range.basePages[0].num_cols if page_range.basePages else 0)
-        self.frame_info[frame_index] = key_directory
+        frame_index = self.get_empty_frame(num_columns)
+        cur_frame = self.frames[frame_index]
+        if mark == 'i':
+            # an index page, page_range_index is the column and page_index the node id
+            self.disk.read_page(key_directory, cur_frame)
+            self.bind_frame(frame_index, key_directory)
+            return frame_index
+        if not self.disk.read_page(key_directory, cur_frame):
+            cur_frame.initialize_page()
+        self.bind_frame(frame_index, key_directory)
+        self.allocate_page_range(table_name, num_columns, page_range_index).note_page(page_index, mark)
         return frame_index
 
-    def LRU(self):
-        evict_index = 0
-        for i in range(len(self.frames) - 1):
-            if self.frames[i].lastAccess > self.frames[i + 1].lastAccess:
-                if not self.frames[i + 1].is_pinned():
-                    evict_index = i + 1
-        return evict_index
+    def new_page(self, key_directory):
+        """
+        Pinned frame for a page about to be written from scratch, nothing is read from disk
+        """
+        with self.latch:
+            frame_index = self.frame_directory.get(key_directory)
+            if frame_index is not None:
+                self.replacement.record_access(frame_index)
+            else:
+                frame_index = self.get_empty_frame(self.table_columns[key_directory[0]])
+                self.bind_frame(frame_index, key_directory)
+            self.frames[frame_index].pin_page()
+            return frame_index
+
+    def bind_frame(self, frame_index, key_directory):
+        # Keep both directions of the page table in sync
+        old_key = self.frame_info[frame_index]
+        if old_key is not None:
+            self.frame_directory.pop(old_key, None)
+        self.frame_info[frame_index] = key_directory
+        self.frame_directory[key_directory] = frame_index
+        self.replacement.record_access(frame_index)
+
+    def unbind_frame(self, frame_index):
+        old_key = self.frame_info[frame_index]
+        if old_key is not None:
+            self.frame_directory.pop(old_key, None)
+        self.frame_info[frame_index] = None
+        self.replacement.remove(frame_index)
+
+    def is_frame_pinned(self, frame_index):
+        return self.frames[frame_index].is_pinned()
 
     def evict_page(self):
-        evict_index = self.LRU()
+        evict_index = self.replacement.victim(self.is_frame_pinned)
+        if evict_index is None:
+            raise Exception("error in evict_page, every frame in the bufferpool is pinned")
         evicted_frame = self.frames[evict_index]
 
         if evicted_frame.dirtyBit:
-            self.write_to_disk(evicted_frame)
+            self.write_to_disk(self.frame_info[evict_index], evicted_frame)
 
+        self.unbind_frame(evict_index)
         self.frames[evict_index] = Frame(evicted_frame.numColumns)
+        self.free_frames.append(evict_index)
         return evict_index
 
     def get_empty_frame(self, numColumns):
-        if not self.has_capacity():
-            frame_index = self.evict_page(table_name)
+        if not self.free_frames and not self.has_capacity():
+            self.evict_page()
+
+        if self.free_frames:
+            frame_index = self.free_frames.pop()
             self.frames[frame_index] = Frame(numColumns)
-            self.frame_info[frame_index] = None
         else:
             frame_index = self.numFrames
             self.frames.append(Frame(numColumns))
             self.numFrames += 1
         return frame_index
 
-    def load_page(self, RID, numColumns=0):
-        page_range_index, page_index, record_id, mark = RID
-        if mark == 'b':
-            return self.load_base_page(page_range_index, page_index, numColumns)
-        elif mark == 't':
-            return self.load_tail_page(page_range_index, page_index, numColumns)
-        else:
-            raise Exception(f"error in load_page, mark is invalid, detail: {RID}")
-
-    def load_base_page(self, page_range_index, base_page_index, numColumns=0):
-        key_directory = (page_range_index, base_page_index, 'b')
-        if self.in_pool(key_directory):
-            return self.get_frame_index(key_directory)
-        else:
-            if numColumns == 0:
-                raise Exception(f"error in load_base_page, numColumns is 0, detail: {key_directory}")
-            frame_index = self.get_empty_frame(numColumns)
-            cur_frame = self.frames[frame_index]
-            cur_frame.pin_page()
-            self.frame_info[frame_index] = key_directory
-
-            # Get data from in-memory page range
-            if page_range_index in self.page_ranges:
-                page_range = self.page_ranges[page_range_index]
-                if base_page_index < len(page_range.basePages):
-                    base_page = page_range.basePages[base_page_index]
-                    for i in range(numColumns):
-                        cur_frame.update_data(i, None, base_page.pages[i])
-            cur_frame.unpin_page()
-            return frame_index
-
-    def load_tail_page(self, page_range_index, tail_page_index, numColumns):
-        key_directory = (page_range_index, tail_page_index, 't')
-
-        # Check if page range exists
-        if page_range_index not in self.page_ranges:
-            self.allocate_page_range(numColumns, page_range_index)
-
-        page_range = self.page_ranges[page_range_index]
-
-        # Create tail page if it doesn't exist
-        while len(page_range.tailPages) <= tail_page_index:
-            page_range.add_tail_page(numColumns)
-
-        frame_index = self.get_frame_index(key_directory)
-        if frame_index is None:
-            frame_index = self.get_empty_frame(numColumns)
-            self.frame_info[frame_index] = key_directory
-
-        cur_frame = self.frames[frame_index]
-        cur_frame.pin_page()
-
-        # Initialize frame data if needed
-        if cur_frame.need_initialize():
-            tail_page = page_range.tailPages[tail_page_index]
-            cur_frame.initialize_page()
-            for i in range(numColumns):
-                cur_frame.update_data(i, None, tail_page.pages[i])
-
-        cur_frame.unpin_page()
-        return frame_index
-
     def in_pool(self, key):
-        for i in range(len(self.frame_info)):
-            if self.frame_info[i] == key:
-                return True
-        return False
-
-    def insertRecBP(self, RID, start_time, schema_encoding, origin_rid, *columns, numColumns):
-        # print(f"insertRecBP with RID: {RID}, start_time: {start_time}, schema_encoding: {schema_encoding}, indirection: {indirection}, numColumns: {numColumns}")
-        page_range_index, base_page_index, record_id, mark = RID
+        return key in self.frame_directory
+
+    def insertRecBP(self, table_name, RID, start_time, schema_encoding, origin_rid, *columns, numColumns):
+        page_range_index, base_page_index, record_id, mark = rid_parts(RID)
         if mark != 'b':
             raise Exception(f"error in insertRecBP, mark is invalid, detail: {RID}")
 
-        frame_index = self.get_frame_index((page_range_index, base_page_index, mark))
-        cur_frame = self.frames[frame_index]
-        # print(f"frame_index: {frame_index}, cur_frame.numRecords: {cur_frame.numRecords}")
-        if not cur_frame.has_capacity():
-            return None
+        with self.page((table_name, page_range_index, base_page_index, mark), exclusive=True) as cur_frame:
+            if not cur_frame.has_capacity():
+                return None
 
-        for i in range(numColumns):
-            cur_frame.write_data(i, columns[i])
-        cur_frame.pin_page()
-
-        cur_frame.numRecords += 1
-        cur_frame.rid.append(RID)
-        cur_frame.start_time.append(start_time)
-        cur_frame.schema_encoding.append(schema_encoding)
-        cur_frame.indirection.append(origin_rid)
-
-        cur_frame.unpin_page()
-        return cur_frame
-
-    def insertRecTP(self, new_rid, current_rid, origin_rid, base_page_frame_index, *columns):
-        # print(f"insertRecTP with new_rid: {new_rid}, current_rid: {current_rid}, origin_rid: {origin_rid}, base_page_frame_index: {base_page_frame_index}, columns: {columns}")
-        new_page_range_index, new_tail_page_index, new_record_id, new_mark = new_rid
-        current_page_range_index, current_tail_page_index, current_record_id, current_mark = current_rid
-        # First ensure the tail page exists
-        new_frame_index = self.load_tail_page(new_page_range_index, new_tail_page_index, len(columns))
-
-        new_frame = self.frames[new_frame_index]
-        base_frame = self.frames[base_page_frame_index]
-
-        new_frame.pin_page()
-        base_frame.pin_page()
-
-        if new_frame.numRecords >= MAX_RECORDS_PER_PAGE:
-            new_frame.unpin_page()
-            frame_index = self.load_tail_page(new_page_range_index, new_tail_page_index + 1, len(columns))
-            new_frame = self.frames[frame_index]
-            new_frame.pin_page()
-
-        schema = ''
-        new_data = []
-        for j in range(len(columns)):
-            if columns[j] is not None:
-                new_frame.write_data(j, columns[j])
-                schema += '1'
-                base_frame.set_schema_encoding(j, 1)
+            for i in range(numColumns):
+                cur_frame.write_data(i, columns[i])
+
+            record_id = cur_frame.numRecords
+            cur_frame.numRecords += 1
+            cur_frame.set_rid(record_id, RID)
+            cur_frame.set_start_time(record_id, start_time)
+            cur_frame.set_schema_encoding(record_id, schema_encoding)
+            cur_frame.set_indirection(record_id, origin_rid)
+            return cur_frame
+
+    def insertRecsBP(self, table_name, RIDs, start_time, schema_encoding, columns):
+        # Bulk version of insertRecBP, columns holds one list of values per column
+        page_range_index, base_page_index, record_id, mark = rid_parts(RIDs[0])
+        if mark != 'b':
+            raise Exception(f"error in insertRecsBP, mark is invalid, detail: {RIDs[0]}")
+
+        with self.page((table_name, page_range_index, base_page_index, mark), exclusive=True) as cur_frame:
+            if cur_frame.numRecords + len(RIDs) > MAX_RECORDS_PER_PAGE:
+                return None
+
+            for i in range(len(columns)):
+                cur_frame.frameData[i].write_many(columns[i])
+            record_id = cur_frame.numRecords
+            cur_frame.numRecords += len(RIDs)
+            cur_frame.set_metadata(cur_frame.rid, record_id, RIDs)
+            cur_frame.set_metadata(cur_frame.start_time, record_id, [start_time] * len(RIDs))
+            cur_frame.set_metadata(cur_frame.schema_encoding, record_id, [schema_encoding] * len(RIDs))
+            cur_frame.set_metadata(cur_frame.indirection, record_id, RIDs)
+            cur_frame.mark_dirty()
+            return cur_frame
+
+    def insertRecTP(self, table_name, new_rid, base_rid, previous_rid, start_time, schema_encoding, *columns):
+        """
+        Write a tail record holding every column of a version of the base record base_rid, into the slot new_rid
+        was allocated, see PageRange.allocate_tail_record
+        previous_rid is the version it replaces, start_time its commit timestamp, schema_encoding marks the columns
+        the update changed
+        """
+        record_id = rid_slot(new_rid)
+        with self.record_page(table_name, new_rid, exclusive=True) as new_frame:
+            for j in range(len(columns)):
+                new_frame.update_data(j, record_id, columns[j])
+
+            new_frame.numRecords = max(new_frame.numRecords, record_id + 1)
+            new_frame.set_start_time(record_id, start_time)
+            new_frame.set_schema_encoding(record_id, schema_encoding)
+            new_frame.set_indirection(record_id, previous_rid)
+            new_frame.set_base_rid(record_id, base_rid)
+            new_frame.set_rid(record_id, new_rid)
+        return new_rid
+
+    def redoRec(self, table_name, RID, columns, indirection, schema_encoding, start_time=None, base_rid=None):
+        """
+        Write a record into its own slot, used by recovery to repeat a logged insert or update
+        Repeating it over a page that already holds the record leaves the page unchanged
+        Base values are only written by inserts and merges, so the values of a base record already on its page
+        are left alone, a merge may have replaced them since
+        """
+        page_range_index, page_index, record_id, mark = rid_parts(RID)
+        if mark == 't':
+            self.allocate_page_range(table_name, len(columns), page_range_index).note_tail_record(page_index, record_id)
+        with self.record_page(table_name, RID, exclusive=True) as frame:
+            if mark == 'b' and record_id < frame.numRecords:
+                columns = ()
+            for j in range(len(columns)):
+                frame.frameData[j].update(record_id, columns[j])
+            frame.numRecords = max(frame.numRecords, record_id + 1)
+            frame.set_rid(record_id, RID)
+            frame.set_indirection(record_id, indirection)
+            frame.set_schema_encoding(record_id, schema_encoding)
+            if start_time is not None:
+                frame.set_start_time(record_id, start_time)
+            if base_rid is not None:
+                frame.set_base_rid(record_id, base_rid)
+
+    def discard_tail_record(self, table_name, tail_rid):
+        """
+        Take back a tail record written by an aborted update
+        The newest record of a tail page is truncated and its slot handed back; one with later records behind it
+        is marked dead by clearing its RID, so the slot is never read again
+        """
+        page_range_index, page_index, record_id, mark = rid_parts(tail_rid)
+        with self.record_page(table_name, tail_rid, exclusive=True) as frame:
+            if record_id == frame.numRecords - 1:
+                self.page_ranges[(table_name, page_range_index)].release_tail_record(page_index, record_id)
+                frame.numRecords -= 1
+                for page in frame.frameData:
+                    if page is not None and page.num_records > record_id:
+                        page.num_records = record_id
+                for page in frame.metadata_pages():
+                    page.num_records = min(page.num_records, record_id)
+                frame.mark_dirty()
             else:
-                new_frame.write_data(j, columns[j])
-                schema += '0'
-            new_data.append(columns[j])
-
-        new_frame.schema_encoding.append(schema)
-        new_frame.numRecords += 1
-        new_frame.set_indirection(new_record_id, current_rid)
-        new_frame.BaseRID.append(origin_rid)
-        new_frame.rid.append(new_rid)
-
-        base_frame.set_indirection(current_record_id, new_rid)
+                frame.set_rid(record_id, None)
+                frame.set_indirection(record_id, None)
 
-        new_frame.unpin_page()
-        base_frame.unpin_page()
-
-    def extract_data(self, frame_index, num_columns, record_id):
+    def extract_data(self, cur_frame, num_columns, record_id):
+        # the columns of a record, cur_frame is pinned by the caller
         data = []
-        cur_frame = self.frames[frame_index]
-        for frame_index in range(num_columns):
-            result = cur_frame.read_data(frame_index, record_id)
-            data.append(result)
+        for column in range(num_columns):
+            data.append(cur_frame.read_data(column, record_id))
         return data
 
-    def extractTPS(self, key_directory, num_columns):
-        frame_index = self.get_frame_index(key_directory)
-        cur_frame = self.frames[frame_index]
+    def write_to_disk(self, key_directory, frame):
+        # write-ahead rule: the log records of a change reach disk before the page holding it
+        # index pages are exempt, a saved tree only starts using them once the save has flushed the log
+        if key_directory[3] != 'i':
+            self.wal.flush()
+        self.disk.write_page(key_directory, frame)
+        frame.reset_dirty()
+
+    def flush_dirty_pages(self, latches):
+        """
+        Write back every page that is dirty now, in page order so the page range files are written front to back
+        Each page is written under the latch of its table (latches maps table name to latch) and stays pinned
+        meanwhile, so the rest of the bufferpool keeps working
+        """
+        with self.latch:
+            dirty = sorted(key for frame_index, key in enumerate(self.frame_info)
+                           if key is not None and frame_index < len(self.frames) and self.frames[frame_index].dirtyBit)
+        for key in dirty:
+            self.flush_page(key, latches[key[0]])
+
+    def flush_page(self, key, latch):
+        """
+        Write back one page if it is dirty, under latch and pinned meanwhile
+        """
+        with self.latch:
+            frame_index = self.frame_directory.get(key)
+            if frame_index is None:
+                return  # evicted, and so written, in the meantime
+            frame = self.frames[frame_index]
+            frame.pin_page()
         try:
-            if len(cur_frame.frameData) >= num_columns + 11:
-                x = cur_frame.read_data(num_columns + 10, 0)
-                y = cur_frame.read_data(num_columns + 10, 1)
-            else:
-                x = y = 0
-        except:
-            x = y = 0
-        return [x, y]
-
-    def write_to_disk(self, frame):
-        disk_directory = f"{self.path}/pages"
-        if not os.path.exists(disk_directory):
-            os.makedirs(disk_directory)
-        disk_filename = f"{disk_directory}/page_{id(frame)}.txt"
-
-        with open(disk_filename, 'w') as f:
-            for i in range(len(frame.frameData)):
-                data = frame.read_data(i, 0)
-                if data is not None:
-                    f.write(f"Column {i}: {data}\n")
-            # print(f"Frame data written to {disk_filename}")
+            with latch, frame.latch.shared():
+                if frame.dirtyBit:
+                    self.write_to_disk(key, frame)
+        finally:
+            frame.unpin_page()
 
-        frame.reset_dirty()
+    def flush_all(self):
+        for frame_index, frame in enumerate(self.frames):
+            if frame.dirtyBit and self.frame_info[frame_index] is not None:
+                self.write_to_disk(self.frame_info[frame_index], frame)
 
     def close(self):
-        for frame in self.frames:
-            if frame.dirtyBit:
-                self.write_to_disk(frame)
+        self.flush_all()
+        # every logged change is now in the page range files, once they are synced the log can go
+        self.disk.sync()
+        self.wal.reset()
+        self.wal.close()
+        self.disk.close()
         self.frames = []
         self.numFrames = 0
-        self.frame_directory = []
-        self.frame_info = [None] * 100
+        self.frame_directory = {}
+        self.free_frames = []
+        self.frame_info = [None] * FRAMECOUNT
+        self.replacement = make_replacement_policy(REPLACEMENT_POLICY, FRAMECOUNT)
         self.page_ranges = {}
+        self.table_columns = {}
 
 
 class Frame:
     def __init__(self, numColumns):
         self.frameData: list[Page] = [None] * numColumns  # List of pages in the frame
-        self.TPS = [0, 0]  # Transaction timestamps, if applicable
+        # TPS[0] of a base page is the newest tail RID merged into it and TPS[1] the newest commit timestamp merged,
+        # see Table.merge_page
+        self.TPS = [0, 0]
         self.numRecords = 0  # Number of records in the frame
-        self.rid = []  # Record IDs for the records in the frame
-        self.start_time = []  # Start times for the records
-        self.schema_encoding = []  # Schema encoding for the records
-        self.indirection = []  # Indirection pointers
-        self.BaseRID = []  # Base Record IDs for updates
+        # Metadata columns, one int64 Page each like the data columns, see METADATA_COLUMNS
+        # A slot holding NULL_RID reads back as None
+        self.rid: Optional[Page] = None  # Record IDs for the records in the frame
+        self.start_time: Optional[Page] = None  # Start times for the records
+        self.schema_encoding: Optional[Page] = None  # Bitmask of the updated columns of each record
+        self.indirection: Optional[Page] = None  # Indirection pointers
+        self.BaseRID: Optional[Page] = None  # Base Record IDs for updates
         self.dirtyBit = False  # Indicates whether the frame has been modified
         self.pinNum = 0  # The number of times this frame has been pinned
         self.numColumns = numColumns  # Number of columns per page/frame
-        self.lastAccess = 0  # Timestamp of last access
+        self.mapping = None  # Mapped page block backing the pages in mmap storage mode
+        self.node = None  # B+tree node held by an index page, see lstore/btree.py
+        self.latch = Latch()  # shared while the contents are read, exclusive while they change
+        self.pin_mutex = threading.Lock()  # makes pinning atomic
 
     def need_initialize(self):
         return self.frameData[0] is None
 
     def initialize_page(self):
         self.frameData = [Page() for _ in range(self.numColumns)]
+        for name in METADATA_COLUMNS:
+            setattr(self, name, Page())
+
+    def metadata_pages(self):
+        return [getattr(self, name) for name in METADATA_COLUMNS]
+
+    def get_metadata(self, page, record_id):
+        value = page.get_value(record_id)
+        return None if value == NULL_RID else value
+
+    def set_metadata(self, page, record_id, values):
+        """
+        Write values to a metadata column from record_id on, slots skipped over read as None
+        """
+        if record_id > page.num_records:
+            page.values[page.num_records:record_id] = array.array('q', [NULL_RID]) * (record_id - page.num_records)
+        page.values[record_id:record_id + len(values)] = array.array('q', [NULL_RID if value is None else value
+                                                                           for value in values])
+        page.num_records = max(page.num_records, record_id + len(values))
+        self.mark_dirty()
 
     def set_indirection(self, record_id, data):
-        self.pin_page()
-        if record_id >= len(self.indirection):
-            self.indirection.extend([None] * (record_id + 1 - len(self.indirection)))
-        self.indirection[record_id] = data
-        self.unpin_page()
+        self.set_metadata(self.indirection, record_id, [data])
 
     def set_schema_encoding(self, record_id, data):
-        self.pin_page()
-        if record_id >= len(self.schema_encoding):
-            self.schema_encoding.extend([None] * (record_id + 1 - len(self.schema_encoding)))
-        self.schema_encoding[record_id] = data
-        self.unpin_page()
+        self.set_metadata(self.schema_encoding, record_id, [data])
+
+    def get_schema_encoding(self, record_id):
+        return self.get_metadata(self.schema_encoding, record_id)
 
     def get_indirection(self, record_id):
-        if record_id >= len(self.indirection):
-            return None
+        return self.get_metadata(self.indirection, record_id)
 
-        self.pin_page()
-        result = self.indirection[record_id]
-        self.unpin_page()
-        return result
+    def get_rid(self, record_id):
+        return self.get_metadata(self.rid, record_id)
+
+    def get_base_rid(self, record_id):
+        return self.get_metadata(self.BaseRID, record_id)
 
     def set_rid(self, record_id, data):
-        self.pin_page()
-        if record_id >= len(self.rid):
-            self.rid.extend([None] * (record_id + 1 - len(self.rid)))
-        self.rid[record_id] = data
-        self.unpin_page()
+        self.set_metadata(self.rid, record_id, [data])
+
+    def get_start_time(self, record_id):
+        return self.get_metadata(self.start_time, record_id)
+
+    def set_start_time(self, record_id, data):
+        self.set_metadata(self.start_time, record_id, [data])
+
+    def set_base_rid(self, record_id, data):
+        self.set_metadata(self.BaseRID, record_id, [data])
 
     def has_capacity(self):
         if self.numRecords < MAX_RECORDS_PER_PAGE:
@@ -316,11 +437,12 @@ class Frame:
             return False
 
     def pin_page(self):
-        self.pinNum += 1
-        self.lastAccess = datetime.now()
+        with self.pin_mutex:
+            self.pinNum += 1
 
     def unpin_page(self):
-        self.pinNum = max(0, self.pinNum - 1)
+        with self.pin_mutex:
+            self.pinNum = max(0, self.pinNum - 1)
 
     def is_pinned(self):
         if self.pinNum == 0:
@@ -338,9 +460,9 @@ class Frame:
 
     def write_data(self, column_index: int, data):
         """Write data to a specific column and mark the frame as dirty."""
-        self.pin_page()
         if data is None:
             return 0
+        self.pin_page()
         if self.frameData[column_index] is None:
             self.frameData[column_index] = Page()  # Initialize if needed
         self.frameData[column_index].write(data)  # Write data to the page
@@ -350,9 +472,9 @@ class Frame:
 
     def update_data(self, column_index: int, record_id, data):
         """Write data to a specific column and mark the frame as dirty."""
-        self.pin_page()
         if data is None:
             return 0
+        self.pin_page()
         if self.frameData[column_index] is None:
             self.frameData[column_index] = Page()  # Initialize if needed
         if record_id is not None:
@@ -0,0 +1,75 @@
+"""
+Fuzzy checkpoints.
+A checkpoint makes the page range and table files hold at least every change logged before it started, then drops
+that part of the write-ahead log, so the log and the work left to recovery stay bounded under continuous load.
+
+Queries keep running meanwhile, nothing is frozen for the whole checkpoint:
+    1. note the cut point, the lowest of the next LSN and the first LSN of every active transaction
+    2. table by table, snapshot the index, page directory and metadata under the table latch and write them out
+    3. write back the dirty pages in page order, each one under its table latch, and sync the page files
+    4. log a CHECKPOINT record and drop the log below the cut point
+Whatever changes while the checkpoint runs may or may not reach the files; recovery replays the log from the
+cut point over them, and its redo leaves records that are already in place unchanged.
+"""
+import threading
+import time
+
+from lstore.config import *
+
+
+def checkpoint(database):
+    """
+    Take one checkpoint of an open database
+    Returns the seconds it took and the bytes of log kept
+    """
+    start = time.perf_counter()
+    wal = database.bufferpool.wal
+    cut = wal.oldest_active_lsn()
+    for table in list(database.tables):
+        database.save_table(table)
+    latches = {table.name: table.latch for table in database.tables}
+    database.bufferpool.flush_dirty_pages(latches)
+    database.bufferpool.disk.sync()
+    wal.checkpoint(cut)
+    wal.discard_before(cut)
+    return time.perf_counter() - start, wal.size()
+
+
+class Checkpointer:
+    """
+    Background thread taking a checkpoint every CHECKPOINT_INTERVAL seconds,
+    or sooner once the log grows past CHECKPOINT_LOG_SIZE bytes
+    """
+
+    def __init__(self, database, interval=CHECKPOINT_INTERVAL, log_size=CHECKPOINT_LOG_SIZE):
+        self.database = database
+        self.interval = interval
+        self.log_size = log_size
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.checkpoints = 0  # checkpoints taken so far
+        self.last_duration = 0  # seconds the last checkpoint took
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name='lstore-checkpointer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        last = time.monotonic()
+        # wake up often enough to notice the log growing between two interval checkpoints
+        while not self.stop_event.wait(min(1, self.interval)):
+            wal = self.database.bufferpool.wal
+            if time.monotonic() - last < self.interval and wal.size() < self.log_size:
+                continue
+            self.last_duration, _ = checkpoint(self.database)
+            self.checkpoints += 1
+            last = time.monotonic()
@@ -14,6 +14,37 @@ TABLECURPG = 2
 TABLECURBP = 3
 TABLECURREC = 4
 
+# Aggregate operations supported by Table.aggregate
+AGGREGATES = ('sum', 'min', 'max', 'count', 'avg')
+
 # Bufferpool constants
 FRAMECOUNT = 100  # Maximum number of frames in bufferpool
-MERGE_INTERVAL = 60  # seconds between merge operations
\ No newline at end of file
+REPLACEMENT_POLICY = 'LRU'  # 'LRU', 'CLOCK' or 'LRU-K'
+LRU_K = 2  # K used by the LRU-K policy
+STORAGE_MODE = 'pread'  # 'pread' reads pages into private buffers, 'mmap' maps page range files
+
+# Transaction worker constants
+WORKER_THREADS = 8  # Threads in the pool shared by all transaction workers
+TRANSACTION_MAX_RETRIES = 100  # Re-runs of a transaction refused a lock before giving up
+TRANSACTION_RETRY_BACKOFF = 0.001  # seconds, first retry delay, doubled on every retry
+TRANSACTION_MAX_BACKOFF = 0.05  # seconds, upper bound on the retry delay
+
+# Lock manager constants
+LOCK_SHARDS = 16  # Stripes of the lock table, each with its own mutex
+LOCK_POLICY = 'no-wait'  # 'no-wait' or 'wait-die' deadlock avoidance
+
+# Write-ahead log constants
+WAL_FSYNC = True  # fsync the log on commit, turning it off trades durability for speed
+GROUP_COMMIT_DELAY = 0  # seconds a commit leader waits for other commits to join its fsync
+
+# Merge constants, see lstore/merge.py
+MERGE_THRESHOLD = MAX_RECORDS_PER_PAGE  # tail records written to a page range since its last merge that queue it
+MERGE_WORKERS = 2  # Threads merging queued page ranges
+MERGE_BUDGET = 0.5  # share of a merge worker's time spent merging, it sleeps the rest
+
+# Version index constants, see lstore/version_index.py
+VERSION_INDEX_DEPTH = 8  # tail records a lookup walks before the record's versions are indexed
+
+# Checkpoint constants
+CHECKPOINT_INTERVAL = 60  # seconds between background checkpoints
+CHECKPOINT_LOG_SIZE = 32 * 1024 * 1024  # bytes of log that trigger a checkpoint before the interval is up
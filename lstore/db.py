@@ -1,11 +1,23 @@
 import array
 import os
-import pickle
 import struct
 
 from lstore.bufferpool import *
 from lstore.table import Table
 from lstore.config import *
+from lstore.recovery import recover
+from lstore.checkpoint import Checkpointer, checkpoint
+from lstore.merge import MergeScheduler
+
+def write_atomic(path, data):
+    # a crash leaves either the old file or the new one, never a mix
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
 
 class Database:
 
@@ -14,6 +26,9 @@ class Database:
         self.tablenames = []
         self.bufferpool: Optional[Bufferpool] = None
         self.path = './ECS165'
+        self.recovery_stats = None  # log records, losers and seconds per phase of the last recovery
+        self.checkpointer = None
+        self.merge_scheduler = None
         self.tables_path = self.path + "/tables"
 
     def open(self, path):
@@ -22,15 +37,11 @@ class Database:
         # pull all tables, update metadata
         self.path = path
         self.bufferpool = Bufferpool(self.path)
+        self.merge_scheduler = MergeScheduler()
         self.tables_path = self.path + "/tables"
         if not os.path.exists(self.tables_path):
             os.makedirs(self.tables_path)
 
-        # Load bufferpool
-        if os.path.exists(self.path + "/buffer.pkl"):
-            with open(self.path + "/buffer.pkl", 'rb') as file:
-                self.bufferpool = pickle.load(file)
-
         for entry in os.listdir(self.tables_path):
             specific_table_path = os.path.join(self.tables_path, entry)
             if os.path.isdir(specific_table_path):
@@ -43,42 +54,66 @@ class Database:
                     num_columns = arr[TABLENUMCOL]
                     table_key = arr[TABLEKEY]
                     table = Table(tableName, num_columns, table_key, self.bufferpool, False, self.tables_path)
+                    table.merge_scheduler = self.merge_scheduler
                     table.page_range_index = arr[TABLECURPG]
                     table.base_page_index = arr[TABLECURBP]
                     table.record_id = arr[TABLECURREC]
                     self.tables.append(table)
 
-                    # Load indices and page directory if they exist
-                    if os.path.exists(specific_table_path + "/indices.pkl"):
-                        table.index.load_index(specific_table_path + "/indices.pkl")
-                    if os.path.exists(specific_table_path + "/pagedirectory.pkl"):
-                        with open(specific_table_path + "/pagedirectory.pkl", 'rb') as file:
-                            table.page_directory = pickle.load(file)
+                    # Only the page range manifest is read now, the page directory, indices
+                    # and pages of the table are read when first used
+                    table.load_manifest(specific_table_path + "/manifest.bin")
 
-                    # Load page ranges
-                    table.pullpagerangesfromdisk(specific_table_path)
+        # Replay the write-ahead log, it is empty after a clean close
+        self.recovery_stats = recover(self)
+        if self.recovery_stats['records']:
+            stats = self.recovery_stats
+            print(f"recovered {stats['records']} log records, {stats['losers']} loser transactions, "
+                  f"analysis {stats['analysis']:.3f}s, redo {stats['redo']:.3f}s, undo {stats['undo']:.3f}s")
+            # start the next run from an empty log
+            checkpoint(self)
 
+        self.checkpointer = Checkpointer(self)
+        self.checkpointer.start()
+        self.merge_scheduler.start()
         print("open DB finished")
 
     def close(self):
-        directory_path = self.path + f"/buffer.pkl"
-        with open(directory_path, 'wb') as file:
-            pickle.dump(self.bufferpool, file)
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+        if self.merge_scheduler is not None:
+            # let running merges swap their pages in before the pages are written
+            self.merge_scheduler.stop()
         for table in self.tables:
-            pickle_path = self.path + f"/tables/{table.name}/indices.pkl"
-            table.index.close_and_save(pickle_path)
-            directory_path = self.path + f"/tables/{table.name}/pagedirectory.pkl"
-            with open(directory_path, 'wb') as file:
-                pickle.dump(table.page_directory, file)
-            metadata_path = self.path + f"/tables/{table.name}/metadata.bin"
-            table.savemetadata(metadata_path)
-            table.bufferpool.close()
+            self.save_table(table)
+        # Write every dirty page back to its page range file
+        self.bufferpool.close()
+
+    def save_table(self, table):
+        """
+        Write the changed indices and page directory ranges, the metadata and the manifest of a table
+        They are captured together under the table latch and written out after it is released
+        """
+        with table.latch:
+            indices = table.index.freeze()
+            page_directory = table.page_directory.dumps()
+            metadata = table.metadata()
+            manifest = table.manifest()
+        table_path = self.path + f"/tables/{table.name}"
+        table.index.save(indices, table.latch)
+        for page_range_index, data in page_directory.items():
+            write_atomic(table_path + f"/pagedirectory{page_range_index}.pkl", data)
+        write_atomic(table_path + "/manifest.bin", manifest)
+        write_atomic(table_path + "/metadata.bin", metadata)
 
     def create_table(self, name, num_columns, key_index):
         if self.bufferpool is None:
             self.open(self.path)
         # self.bufferpool.start_table_dir(name, num_columns)
         table = Table(name, num_columns, key_index, self.bufferpool, True, self.tables_path)
+        table.merge_scheduler = self.merge_scheduler
+        # Written now so that recovery finds the table even if the database is never closed
+        table.savemetadata(f"{self.tables_path}/{name}/metadata.bin")
         self.tables.append(table)
         self.tablenames.append(name)
         return table
@@ -0,0 +1,243 @@
+"""
+Binary page files for the bufferpool.
+Every table keeps one file per page range: {path}/tables/{table}/pagerange{N}.bin
+The file is an array of fixed-size page blocks; base page i lives in block 2i and tail page j in block
+2j + 1, so a page is found by computing its offset and read or written with a single os.pread / os.pwrite.
+
+Block layout (every part is PAGE_SIZE bytes, so column pages stay 4 KiB aligned):
+    header page   magic, format version, column count, record count, TPS, metadata/column record counts
+    metadata      one page each for RID, indirection, schema encoding, start time and base RID
+    columns       one page per data column
+Metadata and column pages are copied verbatim from Page.data (native-endian int64). RIDs are stored packed
+(lstore/rid.py), the schema encoding as a bitmask with bit j set when column j has been updated and bit 62
+(DELETED, lstore/table.py) set on a delete's tail record and on the base record it deleted, and
+NULL_RID where a metadata slot holds nothing. The start time is a commit timestamp (lstore/mvcc.py).
+TPS[0] of a base page is the newest tail RID merged into it and TPS[1] the newest commit timestamp merged.
+
+With STORAGE_MODE = 'mmap' a faulted page block is memory-mapped instead of read, and the frame's
+pages are memoryview slices of the mapping, so values are read straight from the OS page cache. The mapping
+is private (copy-on-write): changes stay in memory until the bufferpool writes the frame back, after the
+log records of those changes, and the mapping is then written to the file with a single os.pwrite.
+
+Index pages, keyed (table, column, node id, 'i'), are PAGE_SIZE blocks of {path}/tables/{table}/index{column}.bin
+holding one B+tree node each, see lstore/btree.py; column numbers from the table's column count on are the
+history trees of lstore/index.py. They are always read with pread.
+"""
+import mmap
+import os
+import struct
+
+from lstore.btree import decode_node
+from lstore.config import *
+from lstore.page import Page, METADATA_COLUMNS
+
+PAGE_MAGIC = b'LSPG'
+PAGE_FORMAT_VERSION = 3
+HEADER_FORMAT = '<4sHHIqq5I'  # magic, version, num_columns, num_records, TPS[0], TPS[1], metadata lengths
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+class DiskManager:
+    def __init__(self, path, mode=STORAGE_MODE):
+        if mode not in ('pread', 'mmap'):
+            raise Exception(f"error in DiskManager, unknown storage mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.files = {}  # (table_name, page_range_index) or (table_name, 'index{column}') -> open file descriptor
+
+    def page_range_path(self, table_name, page_range_index):
+        return f"{self.path}/tables/{table_name}/pagerange{page_range_index}.bin"
+
+    def block_size(self, num_columns):
+        return PAGE_SIZE * (1 + len(METADATA_COLUMNS) + num_columns)
+
+    def page_offset(self, page_index, mark, num_columns):
+        block = 2 * page_index if mark == 'b' else 2 * page_index + 1
+        return block * self.block_size(num_columns)
+
+    def index_path(self, table_name, column):
+        return f"{self.path}/tables/{table_name}/index{column}.bin"
+
+    def open_file(self, file_key, file_path):
+        fd = self.files.get(file_key)
+        if fd is None:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self.files[file_key] = fd
+        return fd
+
+    def get_file(self, table_name, page_range_index):
+        return self.open_file((table_name, page_range_index), self.page_range_path(table_name, page_range_index))
+
+    def get_index_file(self, table_name, column):
+        return self.open_file((table_name, f'index{column}'), self.index_path(table_name, column))
+
+    def read_index_block(self, table_name, column, block):
+        # b'' past the end of the file or if the index was never written
+        if not os.path.exists(self.index_path(table_name, column)):
+            return b''
+        return os.pread(self.get_index_file(table_name, column), PAGE_SIZE, block * PAGE_SIZE)
+
+    def write_index_block(self, table_name, column, block, data):
+        os.pwrite(self.get_index_file(table_name, column), data, block * PAGE_SIZE)
+
+    def sync_index(self, table_name, column):
+        os.fsync(self.get_index_file(table_name, column))
+
+    def truncate_index(self, table_name, column):
+        os.ftruncate(self.get_index_file(table_name, column), 0)
+
+    def write_page(self, key_directory, frame):
+        if key_directory[3] == 'i':
+            table_name, column, node_id, mark = key_directory
+            self.write_index_block(table_name, column, node_id, frame.node.encode())
+            return
+        table_name, page_range_index, page_index, mark = key_directory
+        fd = self.get_file(table_name, page_range_index)
+        offset = self.page_offset(page_index, mark, frame.numColumns)
+        if frame.mapping is not None:
+            self.write_mapped_page(fd, offset, frame)
+            return
+        os.pwrite(fd, self.encode_frame(frame), offset)
+
+    def read_page(self, key_directory, frame):
+        """
+        Fill frame with the stored image of the page
+        Returns False if the page has never been written and the frame still needs empty pages
+        """
+        if key_directory[3] == 'i':
+            table_name, column, node_id, mark = key_directory
+            frame.node = decode_node(node_id, self.read_index_block(table_name, column, node_id))
+            return frame.node is not None
+        if self.mode == 'mmap':
+            self.map_page(key_directory, frame)
+            return True
+        table_name, page_range_index, page_index, mark = key_directory
+        if not os.path.exists(self.page_range_path(table_name, page_range_index)):
+            return False
+        fd = self.get_file(table_name, page_range_index)
+        size = self.block_size(frame.numColumns)
+        data = os.pread(fd, size, self.page_offset(page_index, mark, frame.numColumns))
+        if len(data) < size or data[:4] != PAGE_MAGIC:
+            return False
+        self.decode_frame(data, frame)
+        return True
+
+    def map_page(self, key_directory, frame):
+        """
+        Back the frame's pages with a private mapping of the page block, see write_mapped_page
+        A page that was never written maps a zeroed block, so it starts out empty
+        """
+        table_name, page_range_index, page_index, mark = key_directory
+        fd = self.get_file(table_name, page_range_index)
+        size = self.block_size(frame.numColumns)
+        offset = self.page_offset(page_index, mark, frame.numColumns)
+        if os.fstat(fd).st_size < offset + size:
+            os.ftruncate(fd, offset + size)
+
+        frame.mapping = mmap.mmap(fd, size, offset=offset, access=mmap.ACCESS_COPY)
+        view = memoryview(frame.mapping)
+        if view[:4] == PAGE_MAGIC:
+            page_records = self.decode_header(view, frame)
+        else:
+            page_records = [0] * (len(METADATA_COLUMNS) + frame.numColumns)
+        pages = []
+        for i, num_records in enumerate(page_records):
+            start = PAGE_SIZE * (1 + i)
+            page = Page(view[start:start + PAGE_SIZE])
+            page.num_records = num_records
+            pages.append(page)
+        self.set_pages(frame, pages)
+
+    def write_mapped_page(self, fd, offset, frame):
+        # Page contents already live in the mapping; only the header and pages swapped in from elsewhere are copied
+        # The mapping is private, so nothing reaches the file before this write
+        frame.mapping[:PAGE_SIZE] = self.encode_header(frame)
+        position = PAGE_SIZE
+        for page in self.frame_pages(frame):
+            if page is not None and getattr(page.data, 'obj', None) is not frame.mapping:
+                frame.mapping[position:position + PAGE_SIZE] = page.data[:PAGE_SIZE]
+            position += PAGE_SIZE
+        os.pwrite(fd, frame.mapping, offset)
+
+    def stored_pages(self, table_name, page_range_index, num_columns):
+        """
+        List the (page_index, mark) of every page written to a page range file
+        """
+        file_path = self.page_range_path(table_name, page_range_index)
+        if not os.path.exists(file_path):
+            return []
+        fd = self.get_file(table_name, page_range_index)
+        size = self.block_size(num_columns)
+        result = []
+        for block in range(os.fstat(fd).st_size // size):
+            if os.pread(fd, 4, block * size) != PAGE_MAGIC:
+                continue  # hole left by a page that was never flushed
+            result.append((block // 2, 'b' if block % 2 == 0 else 't'))
+        return result
+
+    def frame_pages(self, frame):
+        # the pages of a frame in block order, metadata columns first
+        return frame.metadata_pages() + frame.frameData
+
+    def set_pages(self, frame, pages):
+        for name, page in zip(METADATA_COLUMNS, pages):
+            setattr(frame, name, page)
+        frame.frameData = pages[len(METADATA_COLUMNS):]
+
+    def encode_frame(self, frame):
+        buffer = bytearray(self.block_size(frame.numColumns))
+        buffer[:PAGE_SIZE] = self.encode_header(frame)
+
+        offset = PAGE_SIZE
+        for page in self.frame_pages(frame):
+            if page is not None:
+                # Never let an overfull page spill into the next part of the block
+                buffer[offset:offset + PAGE_SIZE] = page.data[:PAGE_SIZE]
+            offset += PAGE_SIZE
+        return buffer
+
+    def encode_header(self, frame):
+        num_columns = frame.numColumns
+        buffer = bytearray(PAGE_SIZE)
+        meta_lengths = [min(page.num_records, MAX_RECORDS_PER_PAGE) for page in frame.metadata_pages()]
+        struct.pack_into(HEADER_FORMAT, buffer, 0, PAGE_MAGIC, PAGE_FORMAT_VERSION, num_columns,
+                         frame.numRecords, frame.TPS[0], frame.TPS[1], *meta_lengths)
+        column_records = [page.num_records if page is not None else 0 for page in frame.frameData]
+        struct.pack_into(f'<{num_columns}I', buffer, HEADER_SIZE, *column_records)
+        return buffer
+
+    def decode_frame(self, data, frame):
+        pages = []
+        for i, num_records in enumerate(self.decode_header(data, frame)):
+            start = PAGE_SIZE * (1 + i)
+            page = Page()
+            page.data[:] = data[start:start + PAGE_SIZE]
+            page.num_records = num_records
+            pages.append(page)
+        self.set_pages(frame, pages)
+
+    def decode_header(self, data, frame):
+        """
+        Read the header into frame, returns the record count of every page of the block in order
+        """
+        header = struct.unpack_from(HEADER_FORMAT, data, 0)
+        magic, version, num_columns, num_records, tps_0, tps_1 = header[:6]
+        meta_lengths = header[6:]
+        if version != PAGE_FORMAT_VERSION or num_columns != frame.numColumns:
+            raise Exception(f"error in decode_header, incompatible page image, version: {version}, columns: {num_columns}")
+        column_records = struct.unpack_from(f'<{num_columns}I', data, HEADER_SIZE)
+
+        frame.numRecords = num_records
+        frame.TPS = [tps_0, tps_1]
+        return list(meta_lengths) + list(column_records)
+
+    def sync(self):
+        # make every page written so far durable
+        for fd in self.files.values():
+            os.fsync(fd)
+
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
@@ -1,77 +1,150 @@
 """
 A data strucutre holding indices for various columns of a table.
-Key column should be indexd by default, other columns can be indexed through this object. 
+Key column should be indexd by default, other columns can be indexed through this object.
 Indices are usually B-Trees, but other data structures can be used as well.
+Each column's index is a paged B+tree in its own file, {table}/index{column}.bin, see lstore/btree.py.
+A column's tree is opened the first time the column is used and its nodes are read through the bufferpool.
+Leaves keep the RIDs of a value as compact per-page containers (lstore/postings.py), and lookups on several
+columns are answered by intersecting their posting lists.
+Entries are versioned: an update adds the new values of a record and leaves the old ones, and a delete leaves
+them all, so readers of older versions still find it. Readers check the value in the version they read, see
+Query.read_records. Once merge folds a version into its base page, the entries of values only older versions
+held move to the column's history tree, {table}/index{num_columns + column}.bin, which only readers at
+snapshots before that version consult, see retire; a deleted record's entries all move there. The trees
+therefore hold the values of the latest merged version and of the versions not merged yet.
 """
-from collections import defaultdict
-from BTrees.OOBTree import OOBTree
-import pickle
+from lstore.btree import BPlusTree
+from lstore.mvcc import clock
+from lstore.postings import Postings, intersect
 
 class Index:
-    def __init__(self, table):
+    def __init__(self, table, path=None):
         self.table = table
-        self.indices = [OOBTree() for _ in range(table.num_columns)]
-    
+        self.path = path  # table directory holding the saved indices, None if nothing was saved
+        self.indices = [None] * table.num_columns  # None until the column's tree is opened
+        self.history = [None] * table.num_columns  # None until the column's history tree is opened
+        self.history_time = self.opened_history_time()  # readers at earlier snapshots consult the history
+
+    def opened_history_time(self):
+        # a saved history may hold entries of any version committed before now
+        return 0 if self.path is None else clock.snapshot()
+
     def get_index(self, column_number):
-        return self.indices[column_number]
+        tree = self.indices[column_number]
+        if tree is None:
+            tree = BPlusTree(self.table.bufferpool, self.table.name, column_number, fresh=self.path is None)
+            self.indices[column_number] = tree
+        return tree
+
+    def get_history(self, column_number):
+        tree = self.history[column_number]
+        if tree is None:
+            # stored like a column's tree, numbered after the table's columns
+            tree = BPlusTree(self.table.bufferpool, self.table.name, self.table.num_columns + column_number,
+                             fresh=self.path is None)
+            self.history[column_number] = tree
+        return tree
 
-    def locate(self, column, value):
+    def locate(self, column, value, snapshot=None):
         """
         Find RID of first record with value in given column
+        With a snapshot, also the records only a version older than the merged one held it in, see retire
         """
-        if value in self.indices[column]:
-            return self.indices[column][value]
-        return []
-    
-    def locate_range(self, column, start, end):
+        return self.locate_range(column, value, value, snapshot)
+
+    def locate_range(self, column, start, end, snapshot=None):
         """
         Find all RIDs of records with values in range [start, end] in given column
         """
-        result = []
-        for key in self.indices[column].keys(min=start, max=end):
-            result.extend(self.indices[column][key])
+        rids = [rid for _, rid in self.get_index(column).items(start, end)]
+        if snapshot is not None and snapshot < self.history_time:
+            # a record may be in both, under a value it held again later
+            rids = list(dict.fromkeys(rids + [rid for _, rid in self.get_history(column).items(start, end)]))
+        return rids
+
+    def retire(self, column, entries, timestamp):
+        """
+        Move (value, rid) entries of values only versions older than ones committed by timestamp held to the
+        column's history tree, in sorted order without duplicates
+        Readers at snapshots from timestamp on see those versions or newer ones, so they skip the history
+        """
+        removed = self.get_index(column).delete_many(entries)
+        if removed:
+            self.get_history(column).insert_many(removed)
+            self.history_time = max(self.history_time, timestamp)
+
+    def postings(self, column, start, end=None):
+        """
+        Postings of the RIDs of records with values in range [start, end] in given column, end None meaning
+        start alone
+        """
+        result = Postings()
+        for value, chunk, container in self.get_index(column).runs(start, start if end is None else end):
+            result.add(chunk, container)
         return result
 
+    def locate_all(self, conditions):
+        """
+        Find all RIDs of records matching every {column: value} in conditions, in RID order
+        """
+        return list(intersect([self.postings(column, value) for column, value in conditions.items()]))
+
     def create_index(self, column_number):
-        if not isinstance(self.indices[column_number], OOBTree):
-            self.indices[column_number] = OOBTree()
+        # every column is indexed, the tree is created on first use
+        self.get_index(column_number)
 
     def drop_index(self, column_number):
-        self.indices[column_number] = OOBTree()
+        self.get_index(column_number).clear()
+        self.get_history(column_number).clear()
 
     def add_node(self, column, value, rid):
         """
         Add RID to index for given column and key value
         """
-        if value not in self.indices[column]:
-            self.indices[column][value] = []
-        self.indices[column][value].append(rid)
+        if value is not None:
+            self.get_index(column).insert((value, rid))
+
+    def add_nodes(self, column, values, rids):
+        """
+        Bulk version of add_node, the batch is sorted and merged into the tree one leaf at a time
+        """
+        entries = {(value, rid) for value, rid in zip(values, rids) if value is not None}
+        self.get_index(column).insert_many(sorted(entries))
 
-    def update_node(self, column, value, rid):
-        # First remove the old mapping if it exists
-        self.delete_node(column, None, rid)
+    def update_node(self, column, value, rid, old_value=None):
+        # First remove the old mapping if it exists, only its entry is looked at when the old value is known
+        self.delete_node(column, old_value, rid)
         # Add the new mapping
         self.add_node(column, value, rid)
 
     def delete_node(self, column, value, rid):
-        if value is not None and value in self.indices[column]:
-            if rid in self.indices[column][value]:
-                self.indices[column][value].remove(rid)
-                if not self.indices[column][value]:
-                    del self.indices[column][value]
-        else:
+        tree = self.get_index(column)
+        if value is None:
             # If value not provided, search all values
-            for value in list(self.indices[column].keys()):
-                if rid in self.indices[column][value]:
-                    self.indices[column][value].remove(rid)
-                    if not self.indices[column][value]:
-                        del self.indices[column][value]
-                    break
+            value = next((entry[0] for entry in tree.items() if entry[1] == rid), None)
+            if value is None:
+                return
+        tree.delete((value, rid))
+
+    def freeze(self):
+        """
+        Return (tree, snapshot) for the trees changed since the last call, see BPlusTree.freeze
+        """
+        result = []
+        for tree in self.indices + self.history:
+            snapshot = tree.freeze() if tree is not None else None
+            if snapshot is not None:
+                result.append((tree, snapshot))
+        return result
 
-    def close_and_save(self, path):
-        with open(path, 'wb') as f:
-            pickle.dump(self.indices, f)
+    def save(self, snapshots, latch):
+        # write what freeze returned, latch is the table latch freeze was called under
+        for tree, snapshot in snapshots:
+            tree.save(snapshot, latch)
 
     def load_index(self, path):
-        with open(path, 'rb') as f:
-            self.indices = pickle.load(f)
+        # columns are opened from path when first used
+        self.path = path
+        self.indices = [None] * self.table.num_columns
+        self.history = [None] * self.table.num_columns
+        self.history_time = self.opened_history_time()
@@ -0,0 +1,79 @@
+"""
+Latches: short-term shared/exclusive locks held by a thread while it reads or changes a bufferpool frame.
+Unlike the transaction locks of lstore/lock.py they are never held across queries, and they are not
+checked for deadlocks: a thread takes at most one frame latch per page it works on and always releases it
+before the query returns.
+"""
+import threading
+from contextlib import contextmanager
+
+
+class Latch:
+    """
+    Any number of readers or one writer
+    The writer may take the latch again, shared or exclusive; a reader must not ask for it exclusively
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.released = threading.Condition(self.mutex)
+        self.readers = 0
+        self.writer = None  # ident of the thread holding the latch exclusively
+        self.depth = 0  # times the writer has taken the latch
+
+    def acquire_shared(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if self.writer == me:
+                self.depth += 1
+                return
+            while self.writer is not None:
+                self.released.wait()
+            self.readers += 1
+
+    def release_shared(self):
+        with self.mutex:
+            if self.writer == threading.get_ident():
+                self.release_writer()
+                return
+            self.readers -= 1
+            if self.readers == 0:
+                self.released.notify_all()
+
+    def acquire_exclusive(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if self.writer == me:
+                self.depth += 1
+                return
+            while self.writer is not None or self.readers:
+                self.released.wait()
+            self.writer = me
+            self.depth = 1
+
+    def release_exclusive(self):
+        with self.mutex:
+            self.release_writer()
+
+    def release_writer(self):
+        # called with the mutex held
+        self.depth -= 1
+        if self.depth == 0:
+            self.writer = None
+            self.released.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
@@ -1,20 +1,56 @@
-from lstore.lock_manager import lockEntry
-import threading
-
 class Lock:
+    """
+    Shared/exclusive lock on one item, identified by the transactions holding it
+    A Lock has no mutex of its own: the lock manager shard it lives in guards it
+    """
     def __init__(self):
-        self.read_count = 0
-        self.write_count = 0
-        self.mutex = threading.Lock()
-
-    def acquire_read_lock(self):
-        pass
-    
-    def acquire_write_lock(self):
-        pass
-        
-    def release_read_lock(self):
-        pass
-
-    def release_write_lock(self):
-        pass
+        self.readers = set()  # ids of transactions holding the lock in shared mode
+        self.writer = None  # id of the transaction holding the lock in exclusive mode
+        self.waiters = 0  # transactions blocked on this lock, it is kept in its shard while any remain
+
+    @property
+    def read_count(self):
+        return len(self.readers)
+
+    @property
+    def write_count(self):
+        return 0 if self.writer is None else 1
+
+    def acquire_read_lock(self, txn_id):
+        # an exclusive holder may also read
+        if self.writer is not None and self.writer != txn_id:
+            return False
+        if self.writer is None:
+            self.readers.add(txn_id)
+        return True
+
+    def acquire_write_lock(self, txn_id):
+        if self.writer == txn_id:
+            return True
+        if self.writer is not None:
+            return False
+        # upgrade is only possible when txn_id is the only reader
+        if self.readers - {txn_id}:
+            return False
+        self.readers.discard(txn_id)
+        self.writer = txn_id
+        return True
+
+    def release_read_lock(self, txn_id):
+        self.readers.discard(txn_id)
+
+    def release_write_lock(self, txn_id):
+        if self.writer == txn_id:
+            self.writer = None
+
+    def release(self, txn_id):
+        self.release_read_lock(txn_id)
+        self.release_write_lock(txn_id)
+
+    def holders(self):
+        if self.writer is not None:
+            return {self.writer}
+        return set(self.readers)
+
+    def is_free(self):
+        return self.writer is None and not self.readers and not self.waiters
@@ -1,8 +1,106 @@
+"""
+Strict two-phase locking for transactions.
+Every table owns a LockManager. Lockable items are base RIDs, plus ('key', value) for primary keys being inserted.
+The lock table is striped over LOCK_SHARDS shards, each with its own mutex, so transactions working on
+different items rarely contend on the same mutex.
+
+Deadlocks are avoided rather than detected, following LOCK_POLICY:
+    'no-wait'    a request that conflicts is refused at once
+    'wait-die'   an older transaction waits for younger holders, a younger one is refused
+A refused request makes the query return False; the transaction aborts and its worker may run it again.
+"""
+import itertools
+import threading
+
+from lstore.config import *
+from lstore.lock import Lock
+
+LOCK_POLICIES = ('no-wait', 'wait-die')
+
+# Transaction ids double as wait-die timestamps, a smaller id is an older transaction
+transaction_ids = itertools.count(1)
+
+# The transaction running on this thread, see Transaction.run
+current = threading.local()
+
+
+def next_transaction_id():
+    return next(transaction_ids)
+
+
+def get_current_transaction():
+    return getattr(current, 'transaction', None)
+
+
+def set_current_transaction(transaction):
+    current.transaction = transaction
+
+
 class lockEntry:
     def __init__(self, rid, lock):
         self.rid = rid
         self.lockInfo = lock
 
-pass
 
+class LockShard:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.released = threading.Condition(self.mutex)  # notified whenever a lock in this shard is released
+        self.entries = {}  # lockable item -> lockEntry
+
+
+class LockManager:
+    def __init__(self, num_shards=LOCK_SHARDS, policy=LOCK_POLICY):
+        if policy not in LOCK_POLICIES:
+            raise Exception(f"error in LockManager, unknown lock policy: {policy}")
+        self.policy = policy
+        self.shards = [LockShard() for _ in range(num_shards)]
+
+    def get_shard(self, item):
+        return self.shards[hash(item) % len(self.shards)]
+
+    def acquire(self, txn_id, item, exclusive):
+        """
+        Lock item for the transaction, in exclusive mode if exclusive is set, otherwise shared
+        Upgrading a shared lock to exclusive is allowed once no other transaction holds it
+        Returns True if the lock is granted, False if it is refused
+        """
+        shard = self.get_shard(item)
+        with shard.mutex:
+            entry = shard.entries.get(item)
+            if entry is None:
+                entry = shard.entries[item] = lockEntry(item, Lock())
+            lock = entry.lockInfo
+            while True:
+                if exclusive:
+                    granted = lock.acquire_write_lock(txn_id)
+                else:
+                    granted = lock.acquire_read_lock(txn_id)
+                if granted:
+                    return True
+                # wait-die: only wait when every other holder is younger
+                if self.policy == 'no-wait' or min(lock.holders() - {txn_id}) < txn_id:
+                    if lock.is_free():
+                        del shard.entries[item]
+                    return False
+                lock.waiters += 1
+                shard.released.wait()
+                lock.waiters -= 1
+
+    def release(self, txn_id, item):
+        shard = self.get_shard(item)
+        with shard.mutex:
+            entry = shard.entries.get(item)
+            if entry is None:
+                return
+            entry.lockInfo.release(txn_id)
+            if entry.lockInfo.is_free():
+                del shard.entries[item]
+            else:
+                shard.released.notify_all()
 
+    def is_locked(self, item):
+        shard = self.get_shard(item)
+        with shard.mutex:
+            entry = shard.entries.get(item)
+            return entry is not None and bool(entry.lockInfo.holders())
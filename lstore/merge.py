@@ -0,0 +1,133 @@
+"""
+Merge scheduling.
+Every page range counts the tail records written to it since its last merge and the tail records its reads had
+to follow to reach the versions they wanted, the read amplification the merge would remove. A range is queued
+once MERGE_THRESHOLD tail records pile up, and a bounded pool of merge workers takes the queued ranges in order
+of
+    priority = tail records since the last merge * (1 + tail records followed per read)
+so the ranges that slow reads down most are merged first. Workers merge one base page at a time (Table.merge_page)
+and sleep after each page, keeping merging to a MERGE_BUDGET share of their time so queries keep the CPU and disk.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from lstore.config import *
+
+
+class RangeStats:
+    """
+    Work piled up in one page range since its last merge
+    tail_records and queued change under the table latch; reads and hops are counted by readers without it,
+    they only weigh the priority
+    """
+
+    def __init__(self):
+        self.tail_records = 0  # tail records written since the last merge
+        self.reads = 0  # records read since the last merge
+        self.hops = 0  # tail records those reads followed
+        self.queued = False  # waiting for, or being merged by, a merge worker
+
+    def priority(self):
+        return self.tail_records * (1 + self.hops / max(self.reads, 1))
+
+    def reset(self):
+        self.tail_records = self.reads = self.hops = 0
+
+
+class MergeScheduler:
+    """
+    Priority queue of page ranges to merge and the pool of worker threads merging them
+    """
+
+    def __init__(self, workers=MERGE_WORKERS, threshold=MERGE_THRESHOLD, budget=MERGE_BUDGET):
+        self.workers = workers
+        self.threshold = threshold
+        self.budget = budget
+        self.mutex = threading.Lock()
+        self.work = threading.Condition(self.mutex)
+        self.queue = []  # (-priority, order, table, page range index)
+        self.order = itertools.count()  # breaks ties between equal priorities, oldest first
+        self.stopping = False
+        self.threads = []
+        self.merged_pages = 0  # base pages merged so far
+
+    def start(self):
+        self.stopping = False
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._run, name=f'lstore-merge-{len(self.threads)}')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Workers finish the base page they are merging, ranges still queued are left for the next run
+        with self.mutex:
+            self.stopping = True
+            self.work.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.mutex:
+            for _, _, table, page_range_index in self.queue:
+                table.range_stats(page_range_index).queued = False
+            self.queue = []
+
+    def tail_records_added(self, table, page_range_index, stats):
+        # called by Table.updateRec under the table latch
+        if not stats.queued and stats.tail_records >= self.threshold:
+            stats.queued = True
+            self.push(table, page_range_index, stats.priority())
+
+    def push(self, table, page_range_index, priority):
+        with self.mutex:
+            heapq.heappush(self.queue, (-priority, next(self.order), table, page_range_index))
+            self.work.notify()
+
+    def pop(self):
+        """
+        Highest priority range in the queue, None once the scheduler is stopping
+        A range's priority keeps changing while it waits, so a popped range whose priority dropped below the next
+        one in the queue goes back in with its current priority
+        """
+        with self.mutex:
+            while True:
+                while not self.queue and not self.stopping:
+                    self.work.wait()
+                if self.stopping:
+                    return None
+                _, _, table, page_range_index = heapq.heappop(self.queue)
+                priority = table.range_stats(page_range_index).priority()
+                if self.queue and priority < -self.queue[0][0]:
+                    heapq.heappush(self.queue, (-priority, next(self.order), table, page_range_index))
+                    continue
+                return table, page_range_index
+
+    def _run(self):
+        while True:
+            work = self.pop()
+            if work is None:
+                return
+            table, page_range_index = work
+            stats = table.range_stats(page_range_index)
+            with table.latch:
+                # updates from now on count towards the next merge
+                stats.reset()
+            page_range = table.bufferpool.allocate_page_range(table.name, table.num_columns, page_range_index)
+            try:
+                for page_index in range(page_range.num_base_pages):
+                    if self.stopping:
+                        break
+                    start = time.perf_counter()
+                    if table.merge_page(page_range_index, page_index):
+                        with self.mutex:
+                            self.merged_pages += 1
+                    elapsed = time.perf_counter() - start
+                    time.sleep(elapsed * (1 - self.budget) / self.budget)
+            finally:
+                with table.latch:
+                    stats.queued = False
+                    # queue it again if it filled up while it was being merged
+                    if not self.stopping:
+                        self.tail_records_added(table, page_range_index, stats)
@@ -0,0 +1,65 @@
+"""
+Multi-version concurrency control.
+Every version of a record carries a commit timestamp in its start_time metadata column: the base record the one of
+its insert, each tail record the one of the update that wrote it. A version written by a transaction that has not
+committed yet holds UNCOMMITTED, and Transaction.commit stamps its versions once its COMMIT record is durable.
+The COMMIT record carries the timestamp, so recovery stamps the versions it redoes the same way.
+
+A reader at snapshot timestamp s sees, for each record, the newest version stamped no later than s; a record whose
+base version is stamped later did not exist yet. Readers walk a record's tail chain newest first only until they
+find that version, and go straight to the base page when its newest version is merged and the page's TPS[1], the
+newest commit timestamp merged into it, is no later than s, see Table.visible_version.
+Reads outside a transaction and the reads of read-only transactions run at a snapshot and take no locks, so they
+never wait for writers and writers never wait for them.
+A delete is a version too: its tail record, the tombstone, is marked DELETED in its schema encoding, so readers at
+earlier snapshots still see the record. The indices keep the entries of values records held before, moved to
+history trees once merge folds those versions away, so a lookup finds every record that may match at any snapshot,
+and readers only keep those whose version they read matches, see lstore/index.py.
+
+Timestamps are nanoseconds since the epoch, kept increasing within a run, so a snapshot also names a point in time.
+"""
+import threading
+import time
+
+UNCOMMITTED = (1 << 63) - 1  # start_time of a version whose transaction has not committed, later than any snapshot
+
+
+class CommitClock:
+    """
+    Hands out commit timestamps and the snapshot timestamps readers run at
+    A commit holds its timestamp from begin_commit until its versions are stamped; snapshots stay below every
+    timestamp still held, so a reader never sees part of a commit
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.last = 0  # newest timestamp handed out
+        self.pending = set()  # timestamps of commits still stamping their versions
+
+    def begin_commit(self):
+        with self.mutex:
+            self.last = max(self.last + 1, time.time_ns())
+            self.pending.add(self.last)
+            return self.last
+
+    def end_commit(self, timestamp):
+        with self.mutex:
+            self.pending.discard(timestamp)
+
+    def snapshot(self):
+        # timestamp a reader starting now runs at
+        with self.mutex:
+            if self.pending:
+                return min(self.pending) - 1
+            # commits from now on get later timestamps, even if the system clock steps back
+            self.last = max(self.last, time.time_ns())
+            return self.last
+
+    def observe(self, timestamp):
+        # a timestamp found in the log, later commits get later ones
+        with self.mutex:
+            self.last = max(self.last, timestamp)
+
+
+# Shared by every table, like the transaction ids of lstore/lock_manager.py
+clock = CommitClock()
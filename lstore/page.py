@@ -5,15 +5,28 @@
 
 
 # for arrays and stuff
-from lstore.config import MAX_RECORDS_PER_PAGE, MAX_BASEPAGES_PER_RANGE, PAGE_SIZE
+import array
+
+from lstore.config import MAX_RECORDS_PER_PAGE, PAGE_SIZE
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, bulk operations fall back to array/bytes primitives
+    numpy = None
+
+# Metadata columns of a base or tail page, each kept in a Page like the data columns
+METADATA_COLUMNS = ('rid', 'indirection', 'schema_encoding', 'start_time', 'BaseRID')
 
 
 # One Page for Every Column in Table (maybe 4k pages/columns per base page)
 class Page:
-    def __init__(self):
+    def __init__(self, data=None):
         self.num_records = 0
-        self.data = bytearray(PAGE_SIZE)  # 4096 bytes = MAX_RECORDS_PER_PAGE records * 8 bytes per record
-        # Removed list initialization to keep bytearray
+        # 4096 bytes = MAX_RECORDS_PER_PAGE records * 8 bytes per record
+        # data may be a memoryview into a mapped page file instead of a private buffer
+        self.data = bytearray(PAGE_SIZE) if data is None else data
+        # Native-endian int64 view of data, one slot per record
+        self.values = memoryview(self.data).cast('q')
 
     def has_capacity(self):
         return self.num_records < MAX_RECORDS_PER_PAGE
@@ -21,115 +34,99 @@ class Page:
     def write(self, value):
         if value is None:
             value = 0
-        # Convert value to 8-byte representation and store at the correct offset
-        start = self.num_records * 8
-        end = start + 8
-        self.data[start:end] = int(value).to_bytes(8, byteorder='big', signed=True)
+        self.values[self.num_records] = value
         self.num_records += 1
 
+    def write_many(self, values):
+        """
+        Append a sequence of values in one slice assignment
+        Returns the number of values written, which stops at the page capacity
+        """
+        count = min(len(values), MAX_RECORDS_PER_PAGE - self.num_records)
+        start = self.num_records
+        self.values[start:start + count] = array.array('q', [0 if value is None else value for value in values[:count]])
+        self.num_records += count
+        return count
+
+    def read_many(self, start=0, count=None):
+        end = self.num_records if count is None else min(self.num_records, start + count)
+        return self.values[start:end].tolist()
+
     def find_value(self, value):
+        """
+        Return the slot of every record holding value
+        """
+        if numpy is not None:
+            column = numpy.frombuffer(self.data, dtype=numpy.int64, count=self.num_records)
+            return numpy.flatnonzero(column == value).tolist()
+
+        # Search the raw bytes in C and keep only the hits aligned to a slot
+        needle = array.array('q', [value]).tobytes()
+        haystack = bytes(self.data[:self.num_records * 8])
         indexes = []
-        for i in range(MAX_RECORDS_PER_PAGE):
-            start = i * 8
-            end = start + 8
-            cur_val = int.from_bytes(self.data[start:end], byteorder='big')
-            if cur_val == value:
-                indexes.append(i)
+        position = haystack.find(needle)
+        while position != -1:
+            if position % 8 == 0:
+                indexes.append(position // 8)
+                position = haystack.find(needle, position + 8)
+            else:
+                position = haystack.find(needle, position + 1)
         return indexes
 
     def get_value(self, index):
         if index < self.num_records:
-            start = index * 8
-            end = start + 8
-            return int.from_bytes(self.data[start:end], byteorder='big')
+            return self.values[index]
         return None
 
     def update(self, index, value):
         if value is None:
             value = 0
-        start = index * 8
-        end = start + 8
         # If index is out of current records, extend num_records accordingly
         if index >= self.num_records:
             self.num_records = index + 1
-        self.data[start:end] = int(value).to_bytes(8, byteorder='big', signed=True)
-
-
-class BasePage:
-    def __init__(self, numCols):
-        self.rid = [None] * MAX_RECORDS_PER_PAGE
-        self.start_time = []
-        self.schema_encoding = []
-        self.indirection = []
-        self.pages = [Page() for _ in range(numCols)]
-        self.num_records = 0
-        self.num_cols = numCols
-
-    def has_capacity(self):
-        return self.num_records < MAX_RECORDS_PER_PAGE
-
-    def insertRecBP(self, RID, start_time, schema_encoding, indirection, *columns):
-        for i in range(self.num_cols):
-            self.pages[i].write(columns[i])
-        self.num_records += 1
-        self.rid.append(RID)
-        self.start_time.append(start_time)
-        self.schema_encoding.append(schema_encoding)
-        self.indirection.append(indirection)
-
-
-class TailPage:
-    def __init__(self, numCols):
-        self.rid = []
-        self.indirection = []
-        self.pages = [Page() for _ in range(numCols)]
-        self.schema_encoding = []
-        self.BaseRID = []
-        self.num_records = 0
-
-    def has_capacity(self):
-        return self.num_records < MAX_RECORDS_PER_PAGE
-
-    def insertRecTP(self, record, rid, updateRID, currentRID, baseRID, baseFrameIndex, *columns):
-        # Store the new tail rid, its previous version, and base rid
-        self.rid.append(updateRID)
-        self.indirection.append(currentRID)
-        self.BaseRID.append(baseRID)
-        schema = ''
-        for j in range(len(columns)):
-            if columns[j] is not None:
-                self.pages[j].write(columns[j])
-                schema += '1'
-            else:
-                self.pages[j].write(record.columns[j])
-                schema += '0'
-        self.schema_encoding.append(schema)
-        self.num_records += 1
+        self.values[index] = value
 
 
 class PageRange:
-    def __init__(self, numCols):
-        self.num_base_pages = 0
+    """
+    Page counts and the tail record allocator of one page range, its pages live in bufferpool frames
+    """
+    def __init__(self):
+        self.num_base_pages = 1  # a page range starts out with its first base page
         self.num_tail_pages = 0
-        self.basePages = []
-        self.tailPages = []
-        self.TPS = [0, 0]
-        # Initialize with first base page
-        self.add_base_page(numCols)
-
-    def has_capacity(self):
-        return self.num_base_pages < MAX_BASEPAGES_PER_RANGE
-
-    def add_tail_page(self, numCols):
-        new_tail_page = TailPage(numCols)
-        self.tailPages.append(new_tail_page)
-        self.num_tail_pages += 1
-        return new_tail_page
-
-    def add_base_page(self, numCols):
-        if self.has_capacity():
-            new_base_page = BasePage(numCols)
-            self.basePages.append(new_base_page)
-            self.num_base_pages += 1
-            return new_base_page
-        return None
+        # Tail record allocator, updates go to the next slot of the current tail page
+        # Guarded by the table latch, like the rest of the table's state
+        self.tail_page = 0  # index of the current tail page
+        self.tail_records = 0  # slots of the current tail page handed out so far
+
+    def allocate_tail_record(self, count=1):
+        """
+        (tail page index, slot) for count new tail records in consecutive slots of one tail page, moving on to a
+        new tail page once the current one has no room for them
+        """
+        if self.tail_records + count > MAX_RECORDS_PER_PAGE:
+            self.tail_page += 1
+            self.tail_records = 0
+        slot = self.tail_records
+        self.tail_records += count
+        self.num_tail_pages = max(self.num_tail_pages, self.tail_page + 1)
+        return self.tail_page, slot
+
+    def release_tail_record(self, page_index, slot):
+        # hand back the slot of a tail record that was taken back, if it is the last one handed out
+        if page_index == self.tail_page and slot == self.tail_records - 1:
+            self.tail_records -= 1
+
+    def note_tail_record(self, page_index, slot):
+        # a tail record written by recovery, later records go after it
+        if (page_index, slot) >= (self.tail_page, self.tail_records):
+            self.tail_page = page_index
+            self.tail_records = slot + 1
+        self.num_tail_pages = max(self.num_tail_pages, page_index + 1)
+
+    def note_page(self, page_index, mark):
+        # count a page of this range that has been used, so the counts cover every page in the file
+        if mark == 'b':
+            self.num_base_pages = max(self.num_base_pages, page_index + 1)
+        else:
+            self.num_tail_pages = max(self.num_tail_pages, page_index + 1)
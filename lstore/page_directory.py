@@ -0,0 +1,57 @@
+"""
+Page directory: the RIDs of the live base and tail records of a table.
+It is split by page range and each page range is saved to its own file, {table}/pagedirectory{N}.pkl.
+A page range's entries are read the first time one of its RIDs is looked up, and only the page ranges
+changed since the last save are written again.
+"""
+import os
+import pickle
+
+from lstore.rid import rid_page_range
+
+
+class PageDirectory:
+    def __init__(self, path=None):
+        self.path = path  # table directory holding the saved page ranges, None if nothing was saved
+        self.ranges = {}  # page range index -> {rid: None}
+        self.dirty = set()  # page ranges changed since the last save
+
+    def range_path(self, page_range_index):
+        return f"{self.path}/pagedirectory{page_range_index}.pkl"
+
+    def get_range(self, page_range_index):
+        entries = self.ranges.get(page_range_index)
+        if entries is None:
+            entries = {}
+            if self.path is not None and os.path.exists(self.range_path(page_range_index)):
+                with open(self.range_path(page_range_index), 'rb') as file:
+                    entries = pickle.load(file)
+            self.ranges[page_range_index] = entries
+        return entries
+
+    def __contains__(self, rid):
+        return rid is not None and rid in self.get_range(rid_page_range(rid))
+
+    def __getitem__(self, rid):
+        return self.get_range(rid_page_range(rid))[rid]
+
+    def __setitem__(self, rid, value):
+        page_range_index = rid_page_range(rid)
+        self.get_range(page_range_index)[rid] = value
+        self.dirty.add(page_range_index)
+
+    def pop(self, rid, default=None):
+        page_range_index = rid_page_range(rid)
+        entries = self.get_range(page_range_index)
+        if rid not in entries:
+            return default
+        self.dirty.add(page_range_index)
+        return entries.pop(rid)
+
+    def dumps(self):
+        """
+        Return {page range index: pickled entries} for the page ranges changed since the last call
+        """
+        result = {page_range_index: pickle.dumps(self.ranges[page_range_index]) for page_range_index in self.dirty}
+        self.dirty = set()
+        return result
@@ -0,0 +1,230 @@
+"""
+Compact posting lists, sorted sets of RIDs (see lstore/rid.py).
+The low CHUNK_BITS of a RID are the record's slot, the bits above them name its page, called the chunk.
+A posting list keeps one container per chunk, roaring style:
+    array container   sorted tuple of slots, while the chunk holds at most ARRAY_LIMIT of them
+    bitmap container  int with bit s set for slot s, once the chunk is dense
+The form follows from the slot count alone, so a stored container only needs its count to be read back.
+Containers are never changed in place, adding or removing a slot returns a new one.
+
+The B+tree leaves of the column indices hold one container per (value, chunk), see lstore/btree.py, and
+Postings combines the containers of one or more values so that lookups on several columns can be intersected.
+"""
+from array import array
+from bisect import bisect_left
+
+from lstore.rid import PAGE_SHIFT
+
+CHUNK_BITS = PAGE_SHIFT  # slot bits of a RID
+CHUNK_SIZE = 1 << CHUNK_BITS
+SLOT_MASK = CHUNK_SIZE - 1
+BITMAP_BYTES = CHUNK_SIZE // 8
+ARRAY_LIMIT = BITMAP_BYTES // 2  # with more slots than this a bitmap is smaller than 2 bytes per slot
+
+BYTE_SLOTS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def make_container(slots):
+    """
+    Container of a sorted list of distinct slots
+    """
+    if len(slots) <= ARRAY_LIMIT:
+        return tuple(slots)
+    bitmap = 0
+    for slot in slots:
+        bitmap |= 1 << slot
+    return bitmap
+
+
+def from_bitmap(bitmap):
+    # the canonical form of a set of slots given as a bitmap
+    if bitmap.bit_count() > ARRAY_LIMIT:
+        return bitmap
+    return tuple(bitmap_slots(bitmap))
+
+
+def to_bitmap(container):
+    if isinstance(container, int):
+        return container
+    bitmap = 0
+    for slot in container:
+        bitmap |= 1 << slot
+    return bitmap
+
+
+def bitmap_slots(bitmap):
+    slots = []
+    for i, byte in enumerate(bitmap.to_bytes(BITMAP_BYTES, 'little')):
+        if byte:
+            base = i * 8
+            slots.extend(base + bit for bit in BYTE_SLOTS[byte])
+    return slots
+
+
+def container_slots(container):
+    # the slots of a container in order
+    if isinstance(container, int):
+        return bitmap_slots(container)
+    return container
+
+
+def container_count(container):
+    if isinstance(container, int):
+        return container.bit_count()
+    return len(container)
+
+
+def container_contains(container, slot):
+    if isinstance(container, int):
+        return container >> slot & 1 == 1
+    position = bisect_left(container, slot)
+    return position < len(container) and container[position] == slot
+
+
+def container_add(container, slot):
+    """
+    Returns the container with slot added, or None if it is already there
+    """
+    if container_contains(container, slot):
+        return None
+    if isinstance(container, int):
+        return container | 1 << slot
+    if len(container) == ARRAY_LIMIT:
+        return to_bitmap(container) | 1 << slot
+    position = bisect_left(container, slot)
+    return container[:position] + (slot,) + container[position:]
+
+
+def container_remove(container, slot):
+    """
+    Returns the container without slot, () once it is empty, or None if slot is not there
+    """
+    if not container_contains(container, slot):
+        return None
+    if isinstance(container, int):
+        return from_bitmap(container & ~(1 << slot))
+    position = bisect_left(container, slot)
+    return container[:position] + container[position + 1:]
+
+
+def container_union(first, second):
+    if isinstance(first, int) or isinstance(second, int):
+        return from_bitmap(to_bitmap(first) | to_bitmap(second))
+    return make_container(sorted(set(first).union(second)))
+
+
+def container_intersection(first, second):
+    if isinstance(first, int) and isinstance(second, int):
+        return from_bitmap(first & second)
+    if isinstance(first, int):
+        first, second = second, first
+    # first is an array, test its slots against the other container
+    return tuple(slot for slot in first if container_contains(second, slot))
+
+
+def container_bytes(container):
+    # size of the stored container
+    if isinstance(container, int):
+        return BITMAP_BYTES
+    return 2 * len(container)
+
+
+def pack_containers(containers, data, offset):
+    """
+    Write containers one after another to data at offset, array slots are native-endian uint16 like the
+    column pages
+    """
+    slots = array('H')
+    for container in containers:
+        if isinstance(container, int):
+            slots.frombytes(container.to_bytes(BITMAP_BYTES, 'little'))
+        else:
+            slots.extend(container)
+    data[offset:offset + 2 * len(slots)] = slots.tobytes()
+
+
+def unpack_containers(counts, data, offset):
+    """
+    Read back the containers written by pack_containers, given their slot counts
+    Returns them and the bytes they took
+    """
+    size = sum(count if count <= ARRAY_LIMIT else BITMAP_BYTES // 2 for count in counts)
+    slots = array('H')
+    slots.frombytes(data[offset:offset + 2 * size])
+    containers = []
+    position = 0
+    for count in counts:
+        if count > ARRAY_LIMIT:
+            start = offset + 2 * position
+            containers.append(int.from_bytes(data[start:start + BITMAP_BYTES], 'little'))
+            position += BITMAP_BYTES // 2
+        else:
+            containers.append(tuple(slots[position:position + count]))
+            position += count
+    return containers, 2 * size
+
+
+class Postings:
+    """
+    A sorted set of RIDs, kept as {chunk: container}
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else {}
+
+    @classmethod
+    def from_rids(cls, rids):
+        chunks = {}
+        for rid in sorted(set(rids)):
+            chunks.setdefault(rid >> CHUNK_BITS, []).append(rid & SLOT_MASK)
+        return cls({chunk: make_container(slots) for chunk, slots in chunks.items()})
+
+    def add(self, chunk, container):
+        # merge the slots of container into the chunk
+        current = self.containers.get(chunk)
+        self.containers[chunk] = container if current is None else container_union(current, container)
+
+    def __len__(self):
+        return sum(container_count(container) for container in self.containers.values())
+
+    def __iter__(self):
+        for chunk in sorted(self.containers):
+            base = chunk << CHUNK_BITS
+            for slot in container_slots(self.containers[chunk]):
+                yield base | slot
+
+    def __contains__(self, rid):
+        container = self.containers.get(rid >> CHUNK_BITS)
+        return container is not None and container_contains(container, rid & SLOT_MASK)
+
+    def __and__(self, other):
+        if len(other.containers) < len(self.containers):
+            self, other = other, self
+        result = {}
+        for chunk, container in self.containers.items():
+            if chunk in other.containers:
+                common = container_intersection(container, other.containers[chunk])
+                if common:
+                    result[chunk] = common
+        return Postings(result)
+
+    def __or__(self, other):
+        result = Postings(dict(self.containers))
+        for chunk, container in other.containers.items():
+            result.add(chunk, container)
+        return result
+
+
+def intersect(postings):
+    """
+    The RIDs found in every one of a list of Postings, the smallest ones are intersected first
+    """
+    if not postings:
+        return Postings()
+    postings = sorted(postings, key=lambda p: len(p.containers))
+    result = postings[0]
+    for other in postings[1:]:
+        if not result.containers:
+            break
+        result = result & other
+    return result
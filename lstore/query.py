@@ -1,10 +1,14 @@
 from lstore.table import Table, Record
 from lstore.index import Index
+from lstore.lock_manager import get_current_transaction
+from lstore.mvcc import UNCOMMITTED, clock
+from lstore.wal import AUTOCOMMIT_TXN
 import threading
+from contextlib import contextmanager
 
 class Query:
     """
-    # Creates a Query object that can perform different queries on the specified table 
+    # Creates a Query object that can perform different queries on the specified table
     Queries that fail must return False
     Queries that succeed should return the result or True
     Any query that crashes (due to exceptions) should return False
@@ -12,15 +16,90 @@ class Query:
     def __init__(self, table):
         self.table = table
 
+    """
+    # internal Method
+    # Locks items for the transaction running on this thread, see lstore/lock_manager.py
+    # Queries run outside a transaction take no locks
+    # Never called with the table latch held, so a transaction waiting on a lock does not block the table
+    # Returns False if a lock is refused
+    """
+    def lock(self, items, exclusive):
+        transaction = get_current_transaction()
+        if transaction is None:
+            return True
+        for item in items:
+            if not transaction.acquire_lock(self.table.lock_manager, item, exclusive):
+                return False
+        return True
+
+    """
+    # internal Method
+    # Records a change in the write-ahead log, and in the undo log of the transaction running on this thread
+    # Passed to the table, which calls it before any page holds the change, see Table.updateRec
+    # Changes made outside a transaction are durable once the log is next flushed
+    """
+    def log_change(self, entry):
+        transaction = get_current_transaction()
+        if transaction is not None:
+            transaction.log_change(self.table, entry)
+        else:
+            self.table.bufferpool.wal.log_change(AUTOCOMMIT_TXN, self.table.name, entry)
+
+    """
+    # internal Method
+    # Wraps the writes of a query, yields the start time of the versions they write, see lstore/mvcc.py
+    # In a transaction they stay uncommitted until it commits, outside one they commit together right away
+    """
+    @contextmanager
+    def committing(self):
+        if get_current_transaction() is not None:
+            yield UNCOMMITTED
+            return
+        timestamp = clock.begin_commit()
+        try:
+            yield timestamp
+            self.table.bufferpool.wal.commit(AUTOCOMMIT_TXN, timestamp, durable=False)
+        finally:
+            clock.end_commit(timestamp)
+
+    """
+    # internal Method
+    # Timestamp the reads of this query run at, see lstore/mvcc.py
+    # Reads outside a transaction and in read-only transactions see a snapshot and take no locks
+    # Returns None in a transaction that writes, its reads see the latest versions under its locks
+    """
+    def snapshot(self):
+        transaction = get_current_transaction()
+        if transaction is None:
+            return clock.snapshot()
+        return transaction.snapshot
+
     """
     # Insert a record with specified columns
     # Return True upon succesful insertion
     # Returns False if insert fails for whatever reason
     """
     def insert(self, *columns):
-        schema_encoding = '0' * self.table.num_columns
-        self.table.insertRec(0, schema_encoding, *columns)
-        return True
+        if not self.lock([('key', columns[self.table.key])], True):
+            return False
+        with self.table.latch, self.committing() as start_time:
+            schema_encoding = 0
+            rid = self.table.insertRec(start_time, schema_encoding, *columns, log=self.log_change)
+            # a new RID has no other holder, so this never waits
+            return self.lock([rid], True)
+
+    """
+    # Insert many records at once, each one a list or tuple of column values
+    # Return True upon succesful insertion
+    # Returns False if insert fails for whatever reason
+    """
+    def insert_many(self, rows):
+        if not self.lock([('key', row[self.table.key]) for row in rows], True):
+            return False
+        with self.table.latch, self.committing() as start_time:
+            schema_encoding = 0
+            rids = self.table.bulk_insert(start_time, schema_encoding, rows, log=self.log_change)
+            return self.lock(rids, True)
 
     """
     # internal Method
@@ -29,12 +108,28 @@ class Query:
     # Return False if record doesn't exist or is locked due to 2PL
     """
     def delete(self, primary_key):
-        rid = self.table.index.locate(0, primary_key)[0]
-        if rid:
-            self.table.page_directory.pop(rid, None)
-            self.table.index.delete_node(0, primary_key, rid)
+        rids = self.locate_latest(primary_key)
+        if not rids or not self.lock(rids[:1], True):
+            return False
+        with self.table.latch:
+            rid = rids[0]
+            if not self.table.holds_latest(rid, self.table.key, primary_key):
+                return False
+
+            # the record gets a tombstone version, readers at earlier snapshots still see it
+            with self.committing() as start_time:
+                self.table.deleteRec(rid, start_time, log=self.log_change)
             return True
-        return False
+
+    """
+    # internal Method
+    # RIDs of the records whose latest version holds key in the key column, deleted records left out
+    # The index also keeps the entries of keys records held before, see lstore/index.py
+    """
+    def locate_latest(self, key):
+        with self.table.latch:
+            return [rid for rid in self.table.index.locate(self.table.key, key)
+                    if self.table.holds_latest(rid, self.table.key, key)]
 
     """
     # Read matching record with specified search key
@@ -46,23 +141,7 @@ class Query:
     # Assume that select will never be called on a key that doesn't exist
     """
     def select(self, key, column, query_columns):
-        rids = self.table.index.locate(column, key)
-        if not rids:
-            return []
-
-        records = []
-        for rid in rids:
-            if rid in self.table.page_directory:
-                record = self.table.get_record(rid)
-                if record:
-                    filtered_columns = []
-                    for i, include in enumerate(query_columns):
-                        if include:
-                            filtered_columns.append(record.columns[i])
-                        else:
-                            filtered_columns.append(None)
-                    records.append(Record(rid, key, filtered_columns))
-        return records
+        return self.select_version(key, column, query_columns, 0)
 
     """
     # Read matching record with specified search key
@@ -75,22 +154,57 @@ class Query:
     # Assume that select will never be called on a key that doesn't exist
     """
     def select_version(self, key, column, query_columns, version):
-        rids = self.table.index.locate(column, key)
+        return self.read_records(key, column, query_columns, version, self.snapshot())
+
+    """
+    # Read matching record with specified search key as it was at a point in time
+    # :param search_key: the value you want to search based on
+    # :param search_key_index: the column index you want to search based on
+    # :param projected_columns_index: what columns to return. array of 1 or 0 values.
+    # :param timestamp: nanoseconds since the epoch, like time.time_ns(), see lstore/mvcc.py
+    # Returns a list of Record objects holding the versions committed at timestamp whose value in the column was
+    # key then, leaving out later inserts and earlier deletes
+    # Takes no locks, committed versions never change
+    """
+    def select_as_of(self, key, column, query_columns, timestamp):
+        return self.read_records(key, column, query_columns, 0, self.as_of(timestamp))
+
+    """
+    # internal Method
+    # Snapshot timestamp of an as of query, no later than now so commits still to come stay out of it
+    """
+    def as_of(self, timestamp):
+        return min(timestamp, clock.snapshot())
+
+    """
+    # internal Method
+    # Read the matching records at snapshot, or their latest versions under shared locks if snapshot is None
+    # The table latch is only held for the index lookup, pages are read under their frame latches
+    # The index also keeps the values records held before, only records whose version read holds key match
+    """
+    def read_records(self, key, column, query_columns, version, snapshot):
+        with self.table.latch:
+            rids = self.table.index.locate(column, key, snapshot)
         if not rids:
             return []
+        if snapshot is None and not self.lock(rids, False):
+            return False
 
         records = []
         for rid in rids:
-            if rid in self.table.page_directory:
-                record = self.table.get_record_version(rid, version)
-                if record:
-                    filtered_columns = []
-                    for i, include in enumerate(query_columns):
-                        if include:
-                            filtered_columns.append(record.columns[i])
-                        else:
-                            filtered_columns.append(None)
-                    records.append(Record(rid, key, filtered_columns))
+            record = self.table.get_record(rid, snapshot)
+            if record is None or record.columns[column] != key:
+                continue
+            if version != 0:
+                record = self.table.get_record_version(rid, version, snapshot)
+            if record:
+                filtered_columns = []
+                for i, include in enumerate(query_columns):
+                    if include:
+                        filtered_columns.append(record.columns[i])
+                    else:
+                        filtered_columns.append(None)
+                records.append(Record(rid, key, filtered_columns))
         return records
 
     """
@@ -99,46 +213,46 @@ class Query:
     # Returns False if no records exist with given key or if the target record cannot be accessed due to 2PL locking
     """
     def update(self, primary_key, *columns):
-        rids = self.table.index.locate(0, primary_key)
-        if not rids:
+        rids = self.locate_latest(primary_key)
+        if not rids or not self.lock(rids[:1], True):
             return False
 
-        rid = rids[0]
-        if rid not in self.table.page_directory:
-            return False
+        with self.table.latch:
+            rid = rids[0]
+            # changed or deleted while the lock was awaited
+            if not self.table.holds_latest(rid, self.table.key, primary_key):
+                return False
 
-        self.table.updateRec(rid, *columns)
-        return True
+            with self.committing() as start_time:
+                self.table.updateRec(rid, *columns, start_time=start_time, log=self.log_change)
+            return True
 
     """
-    :param start_range: int         # Start of the key range to aggregate 
-    :param end_range: int           # End of the key range to aggregate 
+    # internal Method
+    # Locks every record whose key is in the range for reading
+    # Returns False if a lock is refused
+    """
+    def lock_range(self, start_range, end_range):
+        if get_current_transaction() is None:
+            return True
+        with self.table.latch:
+            rids = self.table.index.locate_range(self.table.key, start_range, end_range)
+        return self.lock(rids, False)
+
+    """
+    :param start_range: int         # Start of the key range to aggregate
+    :param end_range: int           # End of the key range to aggregate
     :param aggregate_columns: int  # Index of desired column to aggregate
     # this function is only called on the primary key.
     # Returns the summation of the given range upon success
     # Returns False if no record exists in the given range
     """
     def sum(self, start_range, end_range, aggregate_column):
-        if start_range > end_range:
-            return False
-
-        column_sum = 0
-        rids = self.table.index.locate_range(0, start_range, end_range)
-
-        for rid in rids:
-            if rid in self.table.page_directory:
-                record = self.table.get_record(rid)
-                if record:
-                    val = record.columns[aggregate_column]
-                    if val is None:
-                        val = 0
-                    column_sum += val
-
-        return column_sum
+        return self.sum_version(start_range, end_range, aggregate_column, 0)
 
     """
-    :param start_range: int         # Start of the key range to aggregate 
-    :param end_range: int           # End of the key range to aggregate 
+    :param start_range: int         # Start of the key range to aggregate
+    :param end_range: int           # End of the key range to aggregate
     :param aggregate_columns: int  # Index of desired column to aggregate
     :param relative_version: the relative version of the record you need to retreive.
     # this function is only called on the primary key.
@@ -146,22 +260,43 @@ class Query:
     # Returns False if no record exists in the given range
     """
     def sum_version(self, start_range, end_range, aggregate_column, version):
-        if start_range > end_range:
+        snapshot = self.snapshot()
+        if start_range > end_range or snapshot is None and not self.lock_range(start_range, end_range):
             return False
+        return self.table.aggregate(start_range, end_range, aggregate_column, 'sum', version, snapshot) or 0
 
-        column_sum = 0
-        rids = self.table.index.locate_range(0, start_range, end_range)
-
-        for rid in rids:
-            if rid in self.table.page_directory:
-                record = self.table.get_record_version(rid, version)
-                if record:
-                    val = record.columns[aggregate_column]
-                    if val is None:
-                        val = 0
-                    column_sum += val
+    """
+    :param start_range: int         # Start of the key range to aggregate
+    :param end_range: int           # End of the key range to aggregate
+    :param aggregate_columns: int  # Index of desired column to aggregate
+    :param timestamp: int           # nanoseconds since the epoch, like time.time_ns(), see lstore/mvcc.py
+    # this function is only called on the primary key.
+    # Returns the summation of the versions committed at timestamp upon success, takes no locks
+    # Returns False if start_range is past end_range
+    """
+    def sum_as_of(self, start_range, end_range, aggregate_column, timestamp):
+        if start_range > end_range:
+            return False
+        return self.table.aggregate(start_range, end_range, aggregate_column, 'sum', 0, self.as_of(timestamp)) or 0
 
-        return column_sum
+    """
+    :param start_range: int         # Start of the key range to aggregate
+    :param end_range: int           # End of the key range to aggregate
+    :param aggregate_columns: int  # Index of desired column to aggregate
+    :param operation: str          # One of 'sum', 'min', 'max', 'count' or 'avg'
+    :param relative_version: the relative version of the record you need to retreive.
+    # this function is only called on the primary key.
+    # Returns the aggregate of the given range upon success
+    # Returns False if no record exists in the given range
+    """
+    def aggregate(self, start_range, end_range, aggregate_column, operation, version=0):
+        snapshot = self.snapshot()
+        if start_range > end_range or snapshot is None and not self.lock_range(start_range, end_range):
+            return False
+        result = self.table.aggregate(start_range, end_range, aggregate_column, operation, version, snapshot)
+        if result is None:
+            return False
+        return result
 
     """
     increments one column of the record
@@ -172,10 +307,14 @@ class Query:
     # Returns False if no record matches key or if target record is locked by 2PL.
     """
     def increment(self, key, column):
-        r = self.select(key, self.table.key, [1] * self.table.num_columns)[0]
-        if r is not None:
-            updated_columns = [None] * self.table.num_columns
-            updated_columns[column] = r.columns[column] + 1
-            self.update(key, *updated_columns)
-            return True
-        return False
+        # take the exclusive lock up front, two increments upgrading shared locks would refuse each other
+        rids = self.locate_latest(key)
+        if not rids or not self.lock(rids[:1], True):
+            return False
+        r = self.select(key, self.table.key, [1] * self.table.num_columns)
+        if r == False or not r:
+            return False
+        r = r[0]
+        updated_columns = [None] * self.table.num_columns
+        updated_columns[column] = r.columns[column] + 1
+        return self.update(key, *updated_columns)
@@ -0,0 +1,96 @@
+"""
+Crash recovery, run by Database.open before any query.
+The page range files, indices and page directory hold the state of the last clean close, and the write-ahead
+log holds every change since. Recovery follows ARIES:
+    analysis    read the log up to its last intact record, find the loser transactions, those with
+                neither a COMMIT nor an ABORT record
+    redo        repeat history: every change and every compensation (CLR) is applied again in LSN order,
+                which also restores the index entries and page directory entries they touched; the versions
+                a change writes are uncommitted until its COMMIT record, which stamps them with its timestamp
+    undo        roll the losers back newest change first, logging a CLR for each undone change and an ABORT
+                record per loser, so a crash during recovery is recovered from the same way
+Only the log tail is read, so restart time grows with the work done since the last clean close.
+"""
+import time
+
+from lstore.mvcc import clock
+from lstore.wal import read_log, INSERT, UPDATE, DELETE, COMMIT, ABORT, CLR, AUTOCOMMIT_TXN
+
+
+def recover(database):
+    """
+    Bring the tables of an opened database up to date with its log
+    Returns the number of log records, the losers and the seconds spent in each phase
+    """
+    wal = database.bufferpool.wal
+    tables = {table.name: table for table in database.tables}
+    stats = {'records': 0, 'losers': 0, 'analysis': 0, 'redo': 0, 'undo': 0}
+
+    # Analysis
+    start = time.perf_counter()
+    records = list(read_log(wal.path))
+    ended = set()
+    changes = {}  # transaction id -> its changes, oldest first
+    compensated = {}  # transaction id -> number of its changes already undone
+    for record in records:
+        if record.type in (COMMIT, ABORT):
+            ended.add(record.txn_id)
+        elif record.type in (INSERT, UPDATE, DELETE):
+            changes.setdefault(record.txn_id, []).append(record)
+        elif record.type == CLR:
+            compensated[record.txn_id] = compensated.get(record.txn_id, 0) + 1
+    losers = [txn_id for txn_id in changes if txn_id not in ended and txn_id != AUTOCOMMIT_TXN]
+    # drop a torn tail so new records follow the last intact one
+    if records:
+        wal.truncate(records[-1].end)
+    else:
+        wal.truncate()
+    stats['records'] = len(records)
+    stats['losers'] = len(losers)
+    stats['analysis'] = time.perf_counter() - start
+
+    # Redo
+    start = time.perf_counter()
+    unstamped = {}  # transaction id -> (table, entry) of its changes waiting for its COMMIT record
+    for record in records:
+        if record.type == COMMIT:
+            clock.observe(record.entry)
+            for table, entry in unstamped.pop(record.txn_id, ()):
+                table.stamp(entry, record.entry)
+            continue
+        if record.type == ABORT:
+            unstamped.pop(record.txn_id, None)
+        table = tables.get(record.table_name)
+        if table is None:
+            continue  # the table was dropped
+        if record.type in (INSERT, UPDATE, DELETE):
+            table.redo(record.entry)
+            unstamped.setdefault(record.txn_id, []).append((table, record.entry))
+        elif record.type == CLR:
+            table.undo(record.entry)
+    # changes made outside a transaction count as committed even if the crash came before their COMMIT record
+    if unstamped.get(AUTOCOMMIT_TXN):
+        timestamp = clock.begin_commit()
+        for table, entry in unstamped[AUTOCOMMIT_TXN]:
+            table.stamp(entry, timestamp)
+        clock.end_commit(timestamp)
+    stats['redo'] = time.perf_counter() - start
+
+    # Undo
+    start = time.perf_counter()
+    undo_list = []
+    for txn_id in losers:
+        # an abort that was cut short already undid the newest changes
+        remaining = changes[txn_id][:len(changes[txn_id]) - compensated.get(txn_id, 0)]
+        undo_list.extend(remaining)
+    for record in sorted(undo_list, key=lambda record: record.lsn, reverse=True):
+        table = tables.get(record.table_name)
+        if table is None:
+            continue
+        table.undo(record.entry)
+        wal.log_change(record.txn_id, record.table_name, record.entry, compensation=True)
+    for txn_id in losers:
+        wal.abort(txn_id)
+    wal.flush()
+    stats['undo'] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,149 @@
+"""
+Page replacement policies for the bufferpool.
+A policy only tracks frame slots; the bufferpool tells it when a slot is accessed or emptied
+and asks it for a victim when it needs room. Pinned frames are never chosen.
+"""
+import heapq
+from collections import OrderedDict
+
+from lstore.config import LRU_K
+
+
+class ReplacementPolicy:
+
+    def record_access(self, frame_index):
+        raise NotImplementedError
+
+    def remove(self, frame_index):
+        raise NotImplementedError
+
+    def victim(self, is_pinned):
+        """
+        Return the frame slot to evict, or None if every tracked frame is pinned
+        :param is_pinned: callable taking a frame slot and returning True if it is pinned
+        """
+        raise NotImplementedError
+
+
+class LRUPolicy(ReplacementPolicy):
+    """
+    True LRU: slots are kept in an ordered map from least to most recently used
+    """
+
+    def __init__(self, capacity):
+        self.order = OrderedDict()
+
+    def record_access(self, frame_index):
+        if frame_index in self.order:
+            self.order.move_to_end(frame_index)
+        else:
+            self.order[frame_index] = None
+
+    def remove(self, frame_index):
+        self.order.pop(frame_index, None)
+
+    def victim(self, is_pinned):
+        # Only pinned frames are skipped, so this is O(1) unless many frames are pinned
+        for frame_index in self.order:
+            if not is_pinned(frame_index):
+                return frame_index
+        return None
+
+
+class ClockPolicy(ReplacementPolicy):
+    """
+    CLOCK / second-chance: a reference bit per slot and a hand sweeping over the slots
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = [False] * capacity
+        self.ref_bit = [False] * capacity
+        self.hand = 0
+
+    def record_access(self, frame_index):
+        self.in_use[frame_index] = True
+        self.ref_bit[frame_index] = True
+
+    def remove(self, frame_index):
+        self.in_use[frame_index] = False
+        self.ref_bit[frame_index] = False
+
+    def victim(self, is_pinned):
+        # Two full sweeps are enough: the first clears every reference bit
+        for _ in range(2 * self.capacity):
+            frame_index = self.hand
+            self.hand = (self.hand + 1) % self.capacity
+            if not self.in_use[frame_index] or is_pinned(frame_index):
+                continue
+            if self.ref_bit[frame_index]:
+                self.ref_bit[frame_index] = False
+                continue
+            return frame_index
+        return None
+
+
+class LRUKPolicy(ReplacementPolicy):
+    """
+    LRU-K: evict the slot whose K-th most recent access is the oldest.
+    Slots with fewer than K accesses count as infinitely old and are evicted first, oldest access first.
+    """
+
+    def __init__(self, capacity, k=LRU_K):
+        self.k = k
+        self.clock = 0
+        self.history = {}  # frame slot -> last k access ticks, oldest first
+        self.heap = []  # (k-th most recent tick or -1, last tick, frame slot), stale entries skipped lazily
+
+    def _priority(self, frame_index):
+        history = self.history[frame_index]
+        kth_access = history[0] if len(history) == self.k else -1
+        return (kth_access, history[-1], frame_index)
+
+    def record_access(self, frame_index):
+        self.clock += 1
+        history = self.history.setdefault(frame_index, [])
+        history.append(self.clock)
+        if len(history) > self.k:
+            del history[0]
+        heapq.heappush(self.heap, self._priority(frame_index))
+        if len(self.heap) > 4 * len(self.history) + 64:
+            # Drop stale entries so the heap stays proportional to the number of frames
+            self.heap = [self._priority(i) for i in self.history]
+            heapq.heapify(self.heap)
+
+    def remove(self, frame_index):
+        # Its heap entries become stale and are dropped when they surface
+        self.history.pop(frame_index, None)
+
+    def victim(self, is_pinned):
+        skipped = []
+        result = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            frame_index = entry[2]
+            if frame_index not in self.history or entry != self._priority(frame_index):
+                continue
+            if is_pinned(frame_index):
+                skipped.append(entry)
+                continue
+            # Keep the entry until the bufferpool actually removes the slot
+            skipped.append(entry)
+            result = frame_index
+            break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return result
+
+
+REPLACEMENT_POLICIES = {
+    'LRU': LRUPolicy,
+    'CLOCK': ClockPolicy,
+    'LRU-K': LRUKPolicy,
+}
+
+
+def make_replacement_policy(name, capacity):
+    if name not in REPLACEMENT_POLICIES:
+        raise Exception(f"error in make_replacement_policy, unknown policy: {name}")
+    return REPLACEMENT_POLICIES[name](capacity)
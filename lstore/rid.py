@@ -0,0 +1,57 @@
+"""
+Record IDs.
+A RID is a 64-bit integer packing where the record lives:
+    bit 62          set for tail records
+    bits 32 - 61    page range index
+    bits 10 - 31    page index within the page range
+    bits 0 - 9      slot of the record in its page
+RIDs are hashed and compared as plain ints, sort by page range, page and slot, and are stored as they are
+in the page directory, the indices, the log and the metadata columns of a page.
+Where a stored column needs a value for no RID, NULL_RID is written instead of None.
+"""
+
+TAIL_BIT = 1 << 62
+PAGE_RANGE_SHIFT = 32
+PAGE_SHIFT = 10
+PAGE_RANGE_MASK = (1 << 30) - 1
+PAGE_MASK = (1 << 22) - 1
+SLOT_MASK = (1 << PAGE_SHIFT) - 1
+NULL_RID = -1
+
+
+def make_rid(page_range_index, page_index, slot, mark='b'):
+    tail_bit = TAIL_BIT if mark == 't' else 0
+    return tail_bit | page_range_index << PAGE_RANGE_SHIFT | page_index << PAGE_SHIFT | slot
+
+
+def rid_page_range(rid):
+    return rid >> PAGE_RANGE_SHIFT & PAGE_RANGE_MASK
+
+
+def rid_page(rid):
+    return rid >> PAGE_SHIFT & PAGE_MASK
+
+
+def rid_slot(rid):
+    return rid & SLOT_MASK
+
+
+def rid_mark(rid):
+    # 'b' for base records and 't' for tail records, like the mark of a page key
+    return 't' if rid & TAIL_BIT else 'b'
+
+
+def rid_parts(rid):
+    """
+    (page range index, page index, slot, mark) of a RID
+    """
+    return rid_page_range(rid), rid_page(rid), rid_slot(rid), rid_mark(rid)
+
+
+def encode_rid(rid):
+    # a RID or None as a stored int64
+    return NULL_RID if rid is None else rid
+
+
+def decode_rid(value):
+    return None if value == NULL_RID else value
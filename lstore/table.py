@@ -1,12 +1,26 @@
 import array
 import os
 import threading
-import time
+from collections import defaultdict
 
 from lstore.bufferpool import Bufferpool
 from lstore.config import *
 from lstore.index import Index
+from lstore.lock_manager import LockManager
+from lstore.merge import RangeStats
+from lstore.mvcc import UNCOMMITTED
+from lstore.page_directory import PageDirectory
 from lstore.page import *
+from lstore.version_index import VersionIndex
+from lstore.rid import make_rid, rid_parts, rid_page_range, rid_page, rid_slot, rid_mark
+
+# Schema encoding bit of a delete's tail record, the tombstone, and of the base record it deleted
+DELETED = 1 << 62
+
+
+def updated_columns(columns):
+    # schema encoding bitmask of the columns given a value
+    return sum(1 << j for j, value in enumerate(columns) if value is not None)
 
 
 class Record:
@@ -21,17 +35,25 @@ class Table:
         self.name = name
         self.key = key
         self.num_columns = num_columns
-        self.page_directory = {}
-        self.index = Index(self)
+        # a reopened table reads its page directory and indices lazily from its directory
+        saved_path = None if isNew else f"{path}/{name}"
+        self.page_directory = PageDirectory(saved_path)
+        self.index = Index(self, saved_path)
         self.bufferpool: Bufferpool = bufferpool
         self.num_pageRanges = 0
         self.page_range_index = 0
         self.base_page_index = 0
         self.record_id = 0
-        self.base_page_frame_index = 0
-        self.tail_page_frame_index = 0
-        self.merge_thread = None
+        self.merge_lock = threading.Lock()  # one base page merge at a time
+        self.merge_scheduler = None  # set by the database, queues page ranges to merge, see lstore/merge.py
+        self.merge_stats = {}  # page range index -> RangeStats
+        self.version_index = VersionIndex()  # committed versions of records with long histories
+        # held while the indices, page directory or insert position are read or changed, and by writers
+        # while they change the table's pages; readers read pages under their frame latches alone
+        self.latch = threading.RLock()
+        self.lock_manager = LockManager()  # record locks held by transactions, see lstore/lock_manager.py
         self.path = path
+        self.bufferpool.register_table(self.name, self.num_columns)
         if isNew:
             self.add_page_range(self.num_columns)
 
@@ -40,344 +62,742 @@ class Table:
 
     def add_page_range(self, numCols):
 
-        self.bufferpool.allocate_page_range(self.num_columns, self.page_range_index)
+        self.bufferpool.allocate_page_range(self.name, self.num_columns, self.page_range_index)
         self.num_pageRanges += 1
 
     def updateCurBP(self):
         self.base_page_index += 1
         self.record_id = 0
 
-    def getCurBP(self):
-        return self.pageRange[self.page_range_index].basePages[self.base_page_index]
-
     def updateCurRecord(self):
         self.record_id += 1
 
     def createBP_RID(self):
-        result = (self.page_range_index, self.base_page_index, self.record_id, 'b')
+        result = make_rid(self.page_range_index, self.base_page_index, self.record_id, 'b')
         return result
 
-    def createTP_RID(self, frame_index):
-        cur_frame = self.bufferpool.frames[frame_index]
-        result = (self.page_range_index, len(cur_frame.rid), self.record_id, 't')
-        return result
-
-    def find_record(self, key, rid, projected_columns_index, TPS):
-        if rid[3] == 't':
-            frame_index = self.bufferpool.load_tail_page(rid[0], rid[1], self.num_columns)
-            data = self.bufferpool.extract_data(frame_index, self.num_columns, rid[2])
-
-        if rid[3] == 'b':
-            self.base_page_frame_index = self.bufferpool.load_base_page(rid[0], rid[1], self.num_columns)
-            data = self.bufferpool.extract_data(self.base_page_frame_index, self.num_columns, rid[2])
-
-        record = []
-        for i in range(len(projected_columns_index)):
-            if projected_columns_index[i] == 1:
-                record.append(data[i])
-        return Record(key, rid, record)
-
-    def curBP_has_Capacity(self):
-        return self.bufferpool.frames[self.base_page_frame_index].numRecords < MAX_RECORDS_PER_PAGE
-
-    def curPR_has_Capacity(self):
-        return self.bufferpool.frames[15].numRecords < MAX_RECORDS_PER_PAGE
+    def latest_version(self, frame, record_id):
+        """
+        RID of the tail record holding the latest values of a base record, None if its base page holds them:
+        the record was never updated, or its newest tail record is merged (no newer than the page's TPS)
+        """
+        indirection = frame.get_indirection(record_id)
+        if indirection is None or rid_mark(indirection) != 't' or indirection <= frame.TPS[0]:
+            return None
+        return indirection
+
+    def range_stats(self, page_range_index):
+        stats = self.merge_stats.get(page_range_index)
+        if stats is None:
+            # readers get here without the table latch, setdefault keeps a single RangeStats per range
+            stats = self.merge_stats.setdefault(page_range_index, RangeStats())
+        return stats
+
+    def is_live(self, rid):
+        # the page directory is only looked at under the table latch, it is loaded lazily
+        with self.latch:
+            return rid in self.page_directory
+
+    def visible_version(self, rid, snapshot):
+        """
+        RID of the version of a base record a reader at snapshot sees, see lstore/mvcc.py
+        rid itself when its base page holds that version, the tail record holding it otherwise, None if the record
+        was inserted after the snapshot or by a transaction that has not committed, or deleted before the snapshot
+        """
+        stats = self.range_stats(rid_page_range(rid))
+        stats.reads += 1
+        record_id = rid_slot(rid)
+        with self.bufferpool.record_page(self.name, rid) as frame:
+            start_time = frame.get_start_time(record_id)
+            if start_time is None or start_time > snapshot:
+                return None  # inserted later, or never stamped
+            version_rid = frame.get_indirection(record_id)
+            if version_rid is None or rid_mark(version_rid) != 't':
+                return rid  # never updated
+            if self.latest_version(frame, record_id) is None and frame.TPS[1] <= snapshot:
+                # the newest version is merged and was committed before the snapshot
+                return None if (frame.get_schema_encoding(record_id) or 0) & DELETED else rid
+        versions = self.version_index.get(rid)
+        if versions is not None:
+            position = versions.position(snapshot)
+            if position < 0 or self.is_tombstone(versions.rids[position]):
+                return None
+            return versions.rids[position]
+        # Walk back from the newest version, the oldest one holds the original values and is stamped like the base
+        newest_rid = version_rid
+        hops = 0
+        deleted = 0
+        while rid_mark(version_rid) == 't':
+            hops += 1
+            with self.bufferpool.record_page(self.name, version_rid) as tail_frame:
+                slot = rid_slot(version_rid)
+                start_time = tail_frame.get_start_time(slot)
+                if start_time is not None and start_time <= snapshot:
+                    deleted = (tail_frame.get_schema_encoding(slot) or 0) & DELETED
+                    break
+                version_rid = tail_frame.get_indirection(slot)
+        stats.hops += hops
+        if hops >= VERSION_INDEX_DEPTH:
+            # the next lookup this deep skips the walk
+            self.index_versions(rid, newest_rid)
+        return version_rid if rid_mark(version_rid) == 't' and not deleted else None
+
+    def is_tombstone(self, rid):
+        # whether a tail record is the version a delete wrote
+        with self.bufferpool.record_page(self.name, rid) as frame:
+            return bool((frame.get_schema_encoding(rid_slot(rid)) or 0) & DELETED)
+
+    def holds_latest(self, rid, column, value):
+        """
+        Whether the latest version of a record the index found under value still holds it and is not deleted
+        The index keeps the entries of values records held before, see lstore/index.py
+        Called under the table latch
+        """
+        if rid not in self.page_directory:
+            return False
+        with self.bufferpool.record_page(self.name, rid) as frame:
+            schema = frame.get_schema_encoding(rid_slot(rid)) or 0
+        if schema & DELETED:
+            return False
+        if not schema >> column & 1:
+            return True  # no update changed the column, it holds the value the record was inserted with
+        return self.read_record(rid)[column] == value
+
+    def older_versions_hold(self, rid, origin_columns, origin_indirection, column, value):
+        """
+        Whether a version of a record before an update or delete keeps value indexed in column, so its index entry
+        stays when the change is undone; origin_columns and origin_indirection are the ones the change logged
+        Those are the versions not merged yet and the merged one the base page holds, see Index.retire
+        """
+        if origin_columns[column] == value:
+            return True
+        with self.bufferpool.record_page(self.name, rid) as base_frame:
+            if base_frame.read_data(column, rid_slot(rid)) == value:
+                return True
+            tps = base_frame.TPS[0]
+        version_rid = origin_indirection
+        while version_rid is not None and rid_mark(version_rid) == 't' and version_rid > tps:
+            with self.bufferpool.record_page(self.name, version_rid) as tail_frame:
+                slot = rid_slot(version_rid)
+                if tail_frame.read_data(column, slot) == value:
+                    return True
+                version_rid = tail_frame.get_indirection(slot)
+        return False
 
-    def insertRec(self, start_time, schema_encoding, *columns):
+    def index_versions(self, rid, newest_rid):
+        """
+        Add a record to the version index, walking its tail chain from newest_rid
+        The walk runs under the table latch, so no version is stamped between the walk and the index taking it in
+        """
+        versions = []
+        version_rid = newest_rid
+        with self.latch:
+            while version_rid is not None and rid_mark(version_rid) == 't':
+                with self.bufferpool.record_page(self.name, version_rid) as tail_frame:
+                    slot = rid_slot(version_rid)
+                    start_time = tail_frame.get_start_time(slot)
+                    if start_time != UNCOMMITTED:
+                        versions.append((start_time, version_rid))
+                    version_rid = tail_frame.get_indirection(slot)
+            return self.version_index.index(rid, versions)
+
+    def read_version(self, rid):
+        # the values held by a base or tail record
+        with self.bufferpool.record_page(self.name, rid) as frame:
+            return self.bufferpool.extract_data(frame, self.num_columns, rid_slot(rid))
+
+    def read_record(self, rid):
+        # the latest values of a base record, None if it is deleted
+        stats = self.range_stats(rid_page_range(rid))
+        stats.reads += 1
+        with self.bufferpool.record_page(self.name, rid) as frame:
+            if (frame.get_schema_encoding(rid_slot(rid)) or 0) & DELETED:
+                return None
+            tail_rid = self.latest_version(frame, rid_slot(rid))
+            if tail_rid is None:
+                return self.bufferpool.extract_data(frame, self.num_columns, rid_slot(rid))
+        stats.hops += 1
+        return self.read_version(tail_rid)
+
+    def insertRec(self, start_time, schema_encoding, *columns, log=None):
         # print(f"inserting record with start_time: {start_time}, schema_encoding: {schema_encoding}, columns: {columns}")
-        self.base_page_frame_index = self.bufferpool.get_frame_index((self.page_range_index, self.base_page_index, 'b'))
-        if self.base_page_frame_index is None:
-            raise Exception(f"Error: Could not find frame for base page with index {self.base_page_index}")
-
+        # log is called with the change before any page holds it, see updateRec
         RID = self.createBP_RID()
+        if log is not None:
+            log(('insert', RID, columns))
         self.page_directory[RID] = None
         origin_rid = RID
 
-        cur_frame = self.bufferpool.insertRecBP(RID, start_time, schema_encoding, origin_rid, *columns, numColumns=self.num_columns)
+        cur_frame = self.bufferpool.insertRecBP(self.name, RID, start_time, schema_encoding, origin_rid, *columns, numColumns=self.num_columns)
         self.updateCurRecord()
 
         if not cur_frame.has_capacity():
-            if self.record_id >= MAX_RECORDS_PER_PAGE * MAX_BASEPAGES_PER_RANGE:
-                self.page_range_index += 1
-                self.record_id = 0
-                self.base_page_index = 0
-                self.add_page_range(self.num_columns)
-            else:
-                self.updateCurBP()
+            self.advance_base_page()
 
         for i in range(len(columns)):
             self.index.add_node(i, columns[i], RID)
-
-    def updateRec(self, current_rid, *columns):
-        page_range_index, page_index, record_id, mark = current_rid
-
-        # Load base page
-        self.base_page_frame_index = self.bufferpool.get_frame_index((page_range_index, page_index, 'b'))
-        base_frame = self.bufferpool.frames[self.base_page_frame_index]
-        origin_rid = base_frame.get_indirection(record_id)
-
-        # update data
-        origin_columns = []
-        new_columns = []
-        for j in range(len(columns)):
-            origin_columns.append(base_frame.read_data(j, record_id))
-            if columns[j] is not None:
-                base_frame.update_data(j, record_id, columns[j])
-            new_columns.append(base_frame.read_data(j, record_id))
-        # Find or create appropriate tail page
-        numTPS = 0
-        pagerange_path = f"{self.path}/{self.name}/pagerange{page_range_index}/tailPages"
-        if os.path.exists(pagerange_path):
-            numTPS = len([f for f in os.listdir(pagerange_path) if f.startswith('tail') and f.endswith('.pkl')])
-            if numTPS > 0:
-                numTPS -= 1
-
-        # Load tail page
-        self.tail_page_frame_index = self.bufferpool.get_frame_index((page_range_index, numTPS, 't'))
-        tail_frame = self.bufferpool.frames[self.tail_page_frame_index]
-
-        # Create new tail page if current is full
-        if not tail_frame.has_capacity():
-            numTPS += 1
-            tail_frame.pin_page()
-            self.tail_page_frame_index = self.bufferpool.get_frame_index((page_range_index, numTPS, 't'))
-            tail_frame = self.bufferpool.frames[self.tail_page_frame_index]
-            tail_frame.unpin_page()
-
-        # Create new tail record RID
-        new_rid = (page_range_index, numTPS, tail_frame.numRecords, 't')
-        self.bufferpool.insertRecTP(new_rid, current_rid, origin_rid, self.base_page_frame_index, *origin_columns)
-
-        # print(f"new_columns: {new_columns}, origin_columns: {origin_columns}")
+        return RID
+
+    def advance_base_page(self):
+        # Move on to the next base page once the current one is full, and to a new page range after its last one
+        if self.base_page_index + 1 >= MAX_BASEPAGES_PER_RANGE:
+            self.page_range_index += 1
+            self.record_id = 0
+            self.base_page_index = 0
+            self.add_page_range(self.num_columns)
+        else:
+            self.updateCurBP()
+
+    def bulk_insert(self, start_time, schema_encoding, rows, log=None):
+        """
+        Insert many records at once
+        Each base page is filled column-at-a-time and the indices are built from the whole batch
+        log is called with each insert before any page holds it, see updateRec
+        """
+        if not rows:
+            return []
+        all_rids = []
+        position = 0
+        while position < len(rows):
+            with self.bufferpool.page((self.name, self.page_range_index, self.base_page_index, 'b')) as base_frame:
+                count = min(MAX_RECORDS_PER_PAGE - base_frame.numRecords, len(rows) - position)
+            if count == 0:
+                # the current base page is already full
+                self.advance_base_page()
+                continue
+            chunk = rows[position:position + count]
+            rids = [make_rid(self.page_range_index, self.base_page_index, self.record_id + i) for i in range(count)]
+            columns = [[row[j] for row in chunk] for j in range(self.num_columns)]
+            if log is not None:
+                for rid, row in zip(rids, chunk):
+                    log(('insert', rid, tuple(row)))
+            cur_frame = self.bufferpool.insertRecsBP(self.name, rids, start_time, schema_encoding, columns)
+
+            for rid in rids:
+                self.page_directory[rid] = None
+            all_rids.extend(rids)
+            self.record_id += count
+            position += count
+
+            if not cur_frame.has_capacity():
+                self.advance_base_page()
+
+        for i in range(self.num_columns):
+            self.index.add_nodes(i, [row[i] for row in rows], all_rids)
+        return all_rids
+
+    def updateRec(self, current_rid, *columns, start_time=UNCOMMITTED, delete=False, log=None):
+        """
+        Write a new version of a record, returns the entry undo() takes it back with
+        log is called with that entry before any page holds the change: a page written back flushes the log first,
+        so no page can reach disk ahead of the log record of a change it holds, see Bufferpool.write_to_disk
+        """
+        page_range_index, page_index, record_id, mark = rid_parts(current_rid)
+
+        # Base values are left alone, the new version goes to a tail record and merge folds it into the base page later
+        # The base page stays pinned and latched while its tail pages are faulted in and written
+        with self.bufferpool.page((self.name, page_range_index, page_index, 'b'), exclusive=True) as base_frame:
+            origin_rid = base_frame.get_indirection(record_id)
+            origin_time = base_frame.get_start_time(record_id)
+            tail_rid = self.latest_version(base_frame, record_id)
+            if tail_rid is None:
+                origin_columns = self.bufferpool.extract_data(base_frame, self.num_columns, record_id)
+            else:
+                with self.bufferpool.record_page(self.name, tail_rid) as tail_frame:
+                    origin_columns = self.bufferpool.extract_data(tail_frame, self.num_columns, rid_slot(tail_rid))
+            new_columns = [origin_columns[j] if columns[j] is None else columns[j] for j in range(len(columns))]
+
+            old_schema = base_frame.get_schema_encoding(record_id)
+
+            # Take the next slot of the page range's current tail page
+            page_range = self.bufferpool.allocate_page_range(self.name, self.num_columns, page_range_index)
+            if origin_rid == current_rid:
+                # The first update also keeps the original values, in the slot right before the new version,
+                # since merging overwrites them in the base page
+                tail_page_index, tail_record_id = page_range.allocate_tail_record(2)
+                previous_rid = make_rid(page_range_index, tail_page_index, tail_record_id, 't')
+                new_rid = previous_rid + 1
+            else:
+                tail_page_index, tail_record_id = page_range.allocate_tail_record()
+                previous_rid = origin_rid
+                new_rid = make_rid(page_range_index, tail_page_index, tail_record_id, 't')
+            entry = ('delete' if delete else 'update', current_rid, new_rid, origin_columns, origin_rid, old_schema,
+                     columns)
+            if log is not None:
+                log(entry)
+
+            if origin_rid == current_rid:
+                self.bufferpool.insertRecTP(self.name, previous_rid, current_rid, current_rid, origin_time, 0,
+                                            *origin_columns)
+                self.page_directory[previous_rid] = None
+            # A delete's version, the tombstone, keeps the values it deleted and is marked DELETED
+            flags = DELETED if delete else 0
+            self.bufferpool.insertRecTP(self.name, new_rid, current_rid, previous_rid, start_time,
+                                        updated_columns(columns) | flags, *new_columns)
+            base_frame.set_indirection(record_id, new_rid)
+
+            # Mark the updated columns in the base record's schema encoding
+            schema = (old_schema or 0) | updated_columns(columns) | flags
+            base_frame.set_schema_encoding(record_id, schema)
 
         # Update page directory
         self.page_directory[new_rid] = None
+        if start_time != UNCOMMITTED:
+            self.version_index.add(current_rid, start_time, new_rid)
 
-        # Update indices
+        # Index the new values, the entries of the old ones stay for readers of older versions
         for i in range(len(columns)):
             if columns[i] is not None:
-                self.index.update_node(i, columns[i], current_rid)
-
-        # Consider merging if we have many updates
-        if tail_frame.numRecords >= MAX_RECORDS_PER_PAGE:
-            self.start_merge_thread()
-
-    def greaterthan(self, a, b):
-        """Compare two RID tuples for ordering"""
-        if a[0] > b[0]:
-            return True
-        elif a[0] == b[0]:
-            if a[1] > b[1]:
-                return True
-        return False
+                self.index.add_node(i, columns[i], current_rid)
+
+        stats = self.range_stats(page_range_index)
+        stats.tail_records += 2 if origin_rid == current_rid else 1
+        if self.merge_scheduler is not None:
+            self.merge_scheduler.tail_records_added(self, page_range_index, stats)
+
+        return entry
+
+    def deleteRec(self, rid, start_time=UNCOMMITTED, log=None):
+        """
+        Delete a record by writing a tombstone version, readers at earlier snapshots still see the record
+        Its page directory and index entries stay, readers find the tombstone, see visible_version
+        """
+        return self.updateRec(rid, *[None] * self.num_columns, start_time=start_time, delete=True, log=log)
+
+    def redo(self, entry):
+        """
+        Repeat one logged change, see Table.undo for the entries
+        Used by recovery, which replays the log in order over what the last clean close left behind
+        """
+        operation = entry[0]
+        if operation == 'insert':
+            _, rid, columns = entry
+            self.bufferpool.redoRec(self.name, rid, columns, rid, 0, start_time=UNCOMMITTED)
+            self.page_directory[rid] = None
+            for i in range(len(columns)):
+                if rid not in self.index.locate(i, columns[i]):
+                    self.index.add_node(i, columns[i], rid)
+            # new inserts go after every recovered record
+            if rid >= make_rid(self.page_range_index, self.base_page_index, self.record_id):
+                self.page_range_index, self.base_page_index, self.record_id = rid_page_range(rid), rid_page(rid), rid_slot(rid) + 1
+                if self.record_id >= MAX_RECORDS_PER_PAGE:
+                    self.advance_base_page()
+        elif operation in ('update', 'delete'):
+            _, rid, tail_rid, origin_columns, origin_indirection, origin_schema, columns = entry
+            flags = DELETED if operation == 'delete' else 0
+            previous_rid = origin_indirection
+            if origin_indirection == rid:
+                # the first update kept the original values in the slot before its own, see updateRec
+                previous_rid = tail_rid - 1
+                with self.bufferpool.record_page(self.name, rid) as base_frame:
+                    origin_time = base_frame.get_start_time(rid_slot(rid))
+                self.bufferpool.redoRec(self.name, previous_rid, origin_columns, rid, 0, start_time=origin_time,
+                                        base_rid=rid)
+                self.page_directory[previous_rid] = None
+            new_columns = [origin_columns[j] if columns[j] is None else columns[j] for j in range(len(columns))]
+            self.bufferpool.redoRec(self.name, tail_rid, new_columns, previous_rid, updated_columns(columns) | flags,
+                                    start_time=UNCOMMITTED, base_rid=rid)
+            schema = (origin_schema or 0) | updated_columns(columns) | flags
+            self.bufferpool.redoRec(self.name, rid, (), tail_rid, schema)
+            self.page_directory[tail_rid] = None
+            for j in range(len(columns)):
+                if columns[j] is not None and rid not in self.index.locate(j, columns[j]):
+                    self.index.add_node(j, columns[j], rid)
+        else:
+            raise Exception(f"error in redo, unknown operation: {operation}")
+
+    def stamp(self, entry, timestamp):
+        """
+        Give the versions a logged change wrote their commit timestamp, see lstore/mvcc.py
+        """
+        operation = entry[0]
+        if operation == 'insert':
+            rids = [entry[1]]
+        elif operation in ('update', 'delete'):
+            _, rid, tail_rid, _, origin_indirection, _, _ = entry
+            rids = [tail_rid]
+            if origin_indirection == rid:
+                # the copy of the original values, uncommitted if the same transaction inserted the record
+                rids.append(tail_rid - 1)
+        else:
+            return
+        for version_rid in rids:
+            with self.bufferpool.record_page(self.name, version_rid, exclusive=True) as frame:
+                if frame.get_start_time(rid_slot(version_rid)) == UNCOMMITTED:
+                    frame.set_start_time(rid_slot(version_rid), timestamp)
+        if operation != 'insert':
+            self.version_index.add(rid, timestamp, tail_rid)
+
+    def undo(self, entry):
+        """
+        Reverse one change recorded in a transaction's undo log
+        entry is one of
+            ('insert', rid, columns)
+            ('update', rid, tail_rid, origin_columns, origin_indirection, origin_schema, columns)
+            ('delete', rid, tail_rid, origin_columns, origin_indirection, origin_schema, columns)
+        a delete's columns are all None, its tail record is the tombstone
+        """
+        operation = entry[0]
+        if operation == 'insert':
+            _, rid, columns = entry
+            # the base slot stays allocated but nothing can reach it any more
+            self.page_directory.pop(rid, None)
+            for i in range(len(columns)):
+                self.index.delete_node(i, columns[i], rid)
+        elif operation in ('update', 'delete'):
+            _, rid, tail_rid, origin_columns, origin_indirection, origin_schema, columns = entry
+            record_id = rid_slot(rid)
+            for j in range(len(columns)):
+                if columns[j] is None:
+                    continue
+                if not self.older_versions_hold(rid, origin_columns, origin_indirection, j, columns[j]):
+                    self.index.delete_node(j, columns[j], rid)
+                self.index.add_node(j, origin_columns[j], rid)
+            with self.bufferpool.record_page(self.name, rid, exclusive=True) as base_frame:
+                base_frame.set_indirection(record_id, origin_indirection)
+                base_frame.set_schema_encoding(record_id, origin_schema)
+                self.page_directory.pop(tail_rid, None)
+                self.bufferpool.discard_tail_record(self.name, tail_rid)
+                if origin_indirection == rid:
+                    # and the copy of the original values the first update made
+                    self.page_directory.pop(tail_rid - 1, None)
+                    self.bufferpool.discard_tail_record(self.name, tail_rid - 1)
+        else:
+            raise Exception(f"error in undo, unknown operation: {operation}")
 
     def merge(self, page_range_index=None):
-        """Consolidate a page range's updates into base pages"""
+        """
+        Fold the updates of a page range into its base pages, one base page at a time, see merge_page
+        Returns the number of base pages merged
+        """
         if page_range_index is None:
-            page_range_index = self.page_range_index - 1
-
-        if page_range_index < 0:
-            return
+            page_range_index = self.page_range_index
+        page_range = self.bufferpool.allocate_page_range(self.name, self.num_columns, page_range_index)
+        merged = 0
+        for page_index in range(page_range.num_base_pages):
+            if self.merge_page(page_range_index, page_index):
+                merged += 1
+        return merged
+
+    def merge_page(self, page_range_index, page_index):
+        """
+        Copy-on-write merge of one base page
+        The copy is built without the table latch: the page's columns are copied and every record whose newest
+        tail record is past the page's TPS and committed gets that record's values, tail records holding whole rows.
+        Under the table latch the copy is checked against the page and swapped in with the new TPS, the newest
+        tail RID and commit timestamp merged. A record updated since it was copied, or whose update is not
+        committed yet, keeps its old values, and TPS stays below every one of its tail records that is not merged.
+        The index entries of values only the versions folded away held then move to the history trees, see
+        Index.retire
+        Returns False if there was nothing to merge
+        """
+        key = (self.name, page_range_index, page_index, 'b')
+        with self.merge_lock:
+            with self.bufferpool.page(key) as frame:
+                tps = frame.TPS[0]
+                count = frame.numRecords
+                indirections = frame.indirection.read_many(0, count)
+                pages = []
+                for page in frame.frameData:
+                    copy = Page(bytearray(page.data))
+                    copy.num_records = page.num_records
+                    pages.append(copy)
+
+            updates = defaultdict(list)  # tail page index -> (record id, tail rid)
+            for record_id, indirection in enumerate(indirections):
+                if indirection > tps and rid_mark(indirection) == 't':
+                    updates[rid_page(indirection)].append((record_id, indirection))
+            if not updates:
+                return False
+
+            merged = {}  # record id -> tail rid whose values were copied
+            merged_time = 0  # newest commit timestamp among them
+            retired = {}  # record id -> (commit timestamp of the merged version, values of the versions it replaces)
+            for tail_page_index, records in updates.items():
+                with self.bufferpool.page((self.name, page_range_index, tail_page_index, 't')) as tail_frame:
+                    tail_pages = tail_frame.frameData
+                    for record_id, tail_rid in records:
+                        slot = rid_slot(tail_rid)
+                        start_time = tail_frame.get_start_time(slot)
+                        if start_time == UNCOMMITTED:
+                            continue
+                        replaced = [page.values[record_id] for page in pages]
+                        for column, page in enumerate(pages):
+                            page.values[record_id] = tail_pages[column].values[slot]
+                        merged[record_id] = tail_rid
+                        merged_time = max(merged_time, start_time)
+                        retired[record_id] = (start_time, self.retired_values(tail_frame, tail_rid, tps, replaced))
+            if not merged:
+                return False
+            new_tps = max(merged.values())
+
+            with self.latch:
+                with self.bufferpool.page(key, exclusive=True) as frame:
+                    # records inserted since the copy was made
+                    for page, current in zip(pages, frame.frameData):
+                        page.values[count:current.num_records] = current.values[count:current.num_records]
+                        page.num_records = current.num_records
+                    for record_id, indirection in enumerate(frame.indirection.read_many(0, frame.numRecords)):
+                        if indirection <= tps or rid_mark(indirection) != 't':
+                            continue
+                        if merged.get(record_id) == indirection:
+                            continue
+                        retired.pop(record_id, None)
+                        for page, current in zip(pages, frame.frameData):
+                            page.values[record_id] = current.values[record_id]
+                        new_tps = min(new_tps, self.oldest_unmerged(indirection, tps) - 1)
+                    if new_tps <= tps:
+                        return False
+                    frame.frameData = pages
+                    frame.TPS = [new_tps, max(frame.TPS[1], merged_time)]
+                    frame.mark_dirty()
+                entries = [set() for _ in range(self.num_columns)]
+                for record_id, (start_time, columns) in retired.items():
+                    rid = make_rid(page_range_index, page_index, record_id)
+                    for column, values in enumerate(columns):
+                        entries[column].update((value, rid) for value in values)
+                if retired:
+                    retired_time = max(start_time for start_time, columns in retired.values())
+                    for column in range(self.num_columns):
+                        self.index.retire(column, sorted(entries[column]), retired_time)
+            return True
 
-        base_frames = {}
-        tail_frames = {}
-
-        # Load base pages and pin them
-        for bp_index in range(MAX_BASEPAGES_PER_RANGE):
-            frame_idx = self.bufferpool.load_page((page_range_index, bp_index, None, 'b'))
-            if frame_idx is not None:
-                base_frames[bp_index] = self.bufferpool.frames[frame_idx]
-                base_frames[bp_index].pin_page()
-
-        # Find and load all tail pages
-        tail_page_path = f"{self.path}/tables/{self.name}/pagerange{page_range_index}/tailPages"
-        if os.path.exists(tail_page_path):
-            tp_files = [f for f in os.listdir(tail_page_path) if f.startswith('tail') and f.endswith('.pkl')]
-            for tp_file in tp_files:
-                tp_index = int(tp_file.replace("tail", "").replace(".pkl", ""))
-                frame_idx = self.bufferpool.load_page((page_range_index, tp_index, None, 't'))
-                if frame_idx is not None:
-                    tail_frames[tp_index] = self.bufferpool.frames[frame_idx]
-                    tail_frames[tp_index].pin_page()
-
-        # For each base page
-        for bp_index, base_frame in base_frames.items():
-            for record_idx in range(base_frame.numRecords):
-                if base_frame.indirection is None or record_idx >= len(base_frame.indirection) or base_frame.indirection[record_idx] is None:
-                    continue  # Skip if indirection is not properly set
-
-                if base_frame.rid is None or record_idx >= len(base_frame.rid) or base_frame.rid[record_idx] is None:
-                    continue  # Skip if RID is not properly set
-
-                current_rid = base_frame.indirection[record_idx]
-                base_rid = base_frame.rid[record_idx]
-
-                if current_rid != base_rid:  # Record has updates
-                    latest_values = [None] * self.num_columns
-                    schema = '0' * self.num_columns
-
-                    # Follow indirection chain to get latest values
-                    while current_rid != base_rid:
-                        if current_rid[3] != 't':
-                            break
-
-                        # Safely get tail frame or load it if not available
-                        if current_rid[1] not in tail_frames:
-                            frame_idx = self.bufferpool.load_page((current_rid[0], current_rid[1], None, 't'))
-                            if frame_idx is None:
-                                break  # Can't load this tail page, stop the chain
-                            tail_frames[current_rid[1]] = self.bufferpool.frames[frame_idx]
-                            tail_frames[current_rid[1]].pin_page()
-
-                        tail_frame = tail_frames[current_rid[1]]
-
-                        # Validate tail frame data
-                        if (tail_frame.schema_encoding is None or
-                                tail_frame.indirection is None or
-                                current_rid[2] >= len(tail_frame.schema_encoding) or
-                                current_rid[2] >= len(tail_frame.indirection)):
-                            break  # Invalid data, stop the chain
-
-                        record_schema = tail_frame.schema_encoding[current_rid[2]]
-
-                        # Only update values that haven't been set yet
-                        for col in range(self.num_columns):
-                            if record_schema[col] == '1' and latest_values[col] is None:
-                                latest_values[col] = tail_frame.read_data(col, current_rid[2])
-                                schema = schema[:col] + '1' + schema[col + 1:]
-
-                        current_rid = tail_frame.indirection[current_rid[2]]
-
-                    # Update base record with merged values
-                    for col in range(self.num_columns):
-                        base_frame.update_data(col, record_idx, latest_values[col])
-
-                    # Reset base record's indirection to point to itself
-                    base_frame.indirection[record_idx] = base_rid
-                    base_frame.schema_encoding[record_idx] = schema
-                    base_frame.dirtyBit = True
-
-                    # Update index for changed values
-                    for col in range(self.num_columns):
-                        if latest_values[col] is not None:
-                            self.index.update_node(col, latest_values[col], base_rid)
-
-        # Cleanup
-        for frame in base_frames.values():
-            if frame.dirtyBit:
-                frame.unpin_page()
-
-        for frame in tail_frames.values():
-            frame.unpin_page()
-
-    def start_merge_thread(self):
-        if self.merge_thread is None or not self.merge_thread.is_alive():
-            self.merge_thread = threading.Thread(target=self._background_merge)
-            self.merge_thread.daemon = True
-            self.merge_thread.start()
-
-    def _background_merge(self):
-        while True:
-            self.merge()
-            time.sleep(MERGE_INTERVAL)  # Sleep between merges
+    def retired_values(self, tail_frame, tail_rid, tps, replaced):
+        """
+        Per column, the values a merge of tail_rid folds away: those of the version the base page held, replaced,
+        and of the versions between it and tail_rid, less those tail_rid holds itself, which stay indexed unless
+        it is a tombstone
+        tail_frame holds tail_rid and is latched by the caller, versions on other tail pages are faulted in
+        """
+        columns = [{value} for value in replaced]
+        slot = rid_slot(tail_rid)
+        kept = [page.values[slot] for page in tail_frame.frameData]
+        if (tail_frame.get_schema_encoding(slot) or 0) & DELETED:
+            kept = [None] * self.num_columns
+        version_rid = tail_frame.get_indirection(slot)
+        while version_rid is not None and rid_mark(version_rid) == 't' and version_rid > tps:
+            if rid_page(version_rid) == rid_page(tail_rid):
+                previous_rid, values = self.tail_version(tail_frame, rid_slot(version_rid))
+            else:
+                with self.bufferpool.record_page(self.name, version_rid) as frame:
+                    previous_rid, values = self.tail_version(frame, rid_slot(version_rid))
+            if previous_rid is None or rid_mark(previous_rid) != 't':
+                break  # the copy of the original values, which the base page held until now
+            for column, value in enumerate(values):
+                columns[column].add(value)
+            version_rid = previous_rid
+        return [values - {kept[column], None} for column, values in enumerate(columns)]
+
+    @staticmethod
+    def tail_version(frame, slot):
+        # the indirection and raw column values of a tail record
+        return frame.get_indirection(slot), [page.values[slot] for page in frame.frameData]
+
+    def oldest_unmerged(self, tail_rid, tps):
+        # the oldest tail record past tps in the version chain starting at tail_rid
+        oldest = tail_rid
+        while tail_rid is not None and rid_mark(tail_rid) == 't' and tail_rid > tps:
+            oldest = min(oldest, tail_rid)
+            with self.bufferpool.record_page(self.name, tail_rid) as tail_frame:
+                tail_rid = tail_frame.get_indirection(rid_slot(tail_rid))
+        return oldest
 
     def savemetadata(self, path):
-        arr = array.array('i', [self.key, self.num_columns, self.page_range_index, self.base_page_index, self.record_id])
         with open(path, 'wb') as file:
-            arr.tofile(file)
+            file.write(self.metadata())
 
-    def pullpagerangesfromdisk(self, path):
-        pagerange_dir = path + "/pagerange"
-        if not os.path.exists(pagerange_dir):
+    def metadata(self):
+        arr = array.array('i', [self.key, self.num_columns, self.page_range_index, self.base_page_index, self.record_id])
+        return arr.tobytes()
+
+    def manifest(self):
+        """
+        The page ranges of the table: their count, then page range index, base pages, tail pages, current tail
+        page and the records on it of each
+        """
+        page_ranges = self.bufferpool.table_page_ranges(self.name)
+        values = [len(page_ranges)]
+        for page_range_index, page_range in page_ranges:
+            values.extend([page_range_index, page_range.num_base_pages, page_range.num_tail_pages,
+                           page_range.tail_page, page_range.tail_records])
+        return array.array('i', values).tobytes()
+
+    def load_manifest(self, path):
+        """
+        Register the page ranges listed in the manifest, their pages are faulted in on first use
+        """
+        if not os.path.exists(path):
             return
-
-        for entry in os.listdir(pagerange_dir):
-            if entry.startswith("pagerange"):
-                page_range_index = int(entry.replace("pagerange", ""))
-                pr_path = os.path.join(pagerange_dir, entry)
-
-                # Load base pages
-                for bp_file in os.listdir(pr_path):
-                    if bp_file.startswith("base"):
-                        bp_index = int(bp_file.replace("base", "").replace(".pkl", ""))
-                        self.bufferpool.load_page((page_range_index, bp_index, None, 'b'))
-
-                # Load tail pages
-                for tp_file in os.listdir(pr_path):
-                    if tp_file.startswith("tail"):
-                        tp_index = int(tp_file.replace("tail", "").replace(".pkl", ""))
-                        self.bufferpool.load_page((page_range_index, tp_index, None, 't'))
-
-    def get_record(self, rid):
-        if rid not in self.page_directory:
+        arr = array.array('i')
+        with open(path, 'rb') as file:
+            arr.frombytes(file.read())
+        for i in range(arr[0]):
+            page_range_index, num_base_pages, num_tail_pages, tail_page, tail_records = arr[1 + 5 * i:6 + 5 * i]
+            page_range = self.bufferpool.allocate_page_range(self.name, self.num_columns, page_range_index)
+            page_range.num_base_pages = num_base_pages
+            page_range.num_tail_pages = num_tail_pages
+            page_range.tail_page = tail_page
+            page_range.tail_records = tail_records
+            self.num_pageRanges = max(self.num_pageRanges, page_range_index + 1)
+
+    def get_record(self, rid, snapshot=None):
+        """
+        The latest version of a record, or the one a reader at snapshot sees, see lstore/mvcc.py
+        Returns None if there is no such version, or it is deleted
+        """
+        if not self.is_live(rid):
             return None
 
-        frame_index = self.bufferpool.load_page(rid)
-        frame = self.bufferpool.frames[frame_index]
-
-        record_columns = []
-        for col in range(self.num_columns):
-            value = frame.read_data(col, rid[2])
-            record_columns.append(value)
-
-        frame.unpin_page()
+        if snapshot is None:
+            record_columns = self.read_record(rid)
+            if record_columns is None:
+                return None
+        else:
+            version_rid = self.visible_version(rid, snapshot)
+            if version_rid is None:
+                return None
+            record_columns = self.read_version(version_rid)
         return Record(rid, record_columns[self.key], record_columns)
 
-    def get_record_version(self, rid, version):
-        if rid not in self.page_directory:
+    def scan_column(self, rids, column, version=0, snapshot=None, key_range=None):
+        """
+        Read one column of many records, one base page buffer at a time
+        Base pages hold the latest values of records whose updates are merged, and of columns no update changed;
+        the others are read from their newest tail records, one tail page buffer at a time. Only rows whose schema
+        encoding marks the column as updated are looked up in their tail records
+        With a snapshot, records it does not see are left out, and a record whose newest version is too new for it
+        is read from the version it sees
+        With a key_range, records that were deleted or whose key an update changed are only read if the version
+        read at version 0 is not deleted and has its key in the range, the index keeps entries for old keys
+        """
+        pages = defaultdict(list)
+        with self.latch:
+            for rid in rids:
+                if rid in self.page_directory:
+                    pages[(rid_page_range(rid), rid_page(rid))].append(rid_slot(rid))
+
+        values = []
+        tail_pages = defaultdict(list)  # (page range index, tail page index) -> (base rid, slot) to read
+        for (page_range_index, page_index), record_ids in pages.items():
+            with self.bufferpool.page((self.name, page_range_index, page_index, 'b')) as frame:
+                column_values = frame.frameData[column].read_many()
+                indirections = frame.indirection.read_many()
+                tps, merged_time = frame.TPS
+                start_times = frame.start_time.read_many() if snapshot is not None else None
+                schemas = frame.schema_encoding.read_many()
+            stats = self.range_stats(page_range_index)
+            stats.reads += len(record_ids)
+            page_rid = make_rid(page_range_index, page_index, 0)  # a record's RID is this ORed with its slot
+            for record_id in record_ids:
+                if snapshot is not None and start_times[record_id] > snapshot:
+                    continue
+                if key_range is not None and schemas[record_id] & (DELETED | 1 << self.key):
+                    record = self.get_record(page_rid | record_id, snapshot)
+                    if record is None or not key_range[0] <= record.columns[self.key] <= key_range[1]:
+                        continue
+                    if version != 0:
+                        record = self.get_record_version(page_rid | record_id, version, snapshot)
+                    values.append(0 if record.columns[column] is None else record.columns[column])
+                    continue
+                value = column_values[record_id]
+                # a column no update ever changed holds the same value in every version, the base page's
+                updated = schemas[record_id] >> column & 1
+                if updated and version != 0:
+                    value = self.get_record_version(page_rid | record_id, version, snapshot).columns[column]
+                elif updated:
+                    indirection = indirections[record_id]
+                    if rid_mark(indirection) == 't' and (indirection > tps or snapshot is not None
+                                                         and merged_time > snapshot):
+                        tail_pages[(page_range_index, rid_page(indirection))].append((page_rid | record_id,
+                                                                                      rid_slot(indirection)))
+                        stats.hops += 1
+                        continue
+                values.append(0 if value is None else value)
+
+        for (page_range_index, tail_page_index), records in tail_pages.items():
+            older = []  # records whose newest version the snapshot does not see
+            with self.bufferpool.page((self.name, page_range_index, tail_page_index, 't')) as tail_frame:
+                tail_values = tail_frame.frameData[column].values
+                start_times = tail_frame.start_time.values
+                for rid, slot in records:
+                    if snapshot is not None and start_times[slot] > snapshot:
+                        older.append(rid)
+                    else:
+                        values.append(0 if tail_values[slot] is None else tail_values[slot])
+            for rid in older:
+                record = self.get_record(rid, snapshot)
+                if record is not None:
+                    values.append(0 if record.columns[column] is None else record.columns[column])
+        return values
+
+    def aggregate(self, start_range, end_range, column, operation='sum', version=0, snapshot=None):
+        """
+        Aggregate one column over the records whose key is in [start_range, end_range]
+        operation is one of 'sum', 'min', 'max', 'count' or 'avg'
+        Returns None if no record is in the range, except for count
+        """
+        if operation not in AGGREGATES:
+            raise Exception(f"error in aggregate, unknown operation: {operation}")
+        with self.latch:
+            # a record whose key changed within the range is indexed under both keys, it is read once
+            rids = list(dict.fromkeys(self.index.locate_range(self.key, start_range, end_range, snapshot)))
+        values = self.scan_column(rids, column, version, snapshot, (start_range, end_range))
+        if operation == 'count':
+            return len(values)
+        if not values:
+            return None
+        if operation == 'sum':
+            return sum(values)
+        if operation == 'min':
+            return min(values)
+        if operation == 'max':
+            return max(values)
+        return sum(values) / len(values)
+
+    def get_record_version(self, rid, version, snapshot=None):
+        """
+        The record abs(version) versions before its latest one, or before the one a reader at snapshot sees
+        Returns None if there is no version at snapshot, or the record is deleted
+        """
+        if not self.is_live(rid):
             return None
-
-        page_range_index, page_index, record_id, mark = rid
-        base_frame_index = self.bufferpool.get_frame_index((page_range_index, page_index, 'b'))
 
         if version == 0:  # current version
-            record_columns = self.bufferpool.extract_data(base_frame_index, self.num_columns, record_id)
-            # print(f"record_columns: {record_columns}")
-            record_key = record_columns[self.key]
-            return Record(rid, record_key, record_columns)
-        elif version == -1:  # Original version
-            base_frame = self.bufferpool.frames[base_frame_index]
-            version_rid = base_frame.indirection[record_id]  # Start from the indirection of the base frame
-
-            frame_index = base_frame_index
-            frame = base_frame
-            # Traverse the indirection chain to find the original (earliest) version
-            while version_rid is not None and version_rid != rid:
-                # print("get_record_version with version == -1, get version_rid: ", version_rid)
-                version_page_range_index, version_page_index, version_record_id, version_mark = version_rid
-                frame_index = self.bufferpool.load_page((version_page_range_index, version_page_index, version_record_id, 't'))
-                frame = self.bufferpool.frames[frame_index]
-
-                # If there is no further indirection, we've found the original version
-                next_rid = frame.get_indirection(version_record_id)
-                if next_rid is None or next_rid == rid:  # No further indirection, original version reached
-                    break
-                version_rid = next_rid
+            return self.get_record(rid, snapshot)
 
-            # Retrieve the record from the original version's frame
-            version_page_range_index, version_page_index, version_record_id, version_mark = version_rid
-            record_columns = self.bufferpool.extract_data(frame_index, self.num_columns, version_record_id)
-            record_key = record_columns[self.key]
-            return Record(version_rid, record_key, record_columns)
+        # Walk back one tail record per version, newest first
+        # The oldest one holds the original values, its indirection points back at the base record
+        if snapshot is None:
+            version_rid = rid
         else:
-            base_frame = self.bufferpool.frames[base_frame_index]
-            updates_seen = 0
-            version_rid = base_frame.indirection[record_id]  # Start from the indirection of the base frame
-
-            target_version = abs(version) if version < 0 else version
-
-            frame_index = base_frame_index
-            frame = base_frame
-            # Traverse the indirection chain to find the original (earliest) version
-            while version_rid != rid and updates_seen < target_version:
-                updates_seen += 1
-                # print("get_record_version with version == -1, get version_rid: ", version_rid)
-                version_page_range_index, version_page_index, version_record_id, version_mark = version_rid
-                frame_index = self.bufferpool.load_page((version_page_range_index, version_page_index, version_record_id, 't'))
-                frame = self.bufferpool.frames[frame_index]
-
-            # Retrieve the record from the original version's frame
-            version_page_range_index, version_page_index, version_record_id, version_mark = version_rid
-            record_columns = self.bufferpool.extract_data(frame_index, self.num_columns, version_record_id)
-            record_key = record_columns[self.key]
-            return Record(version_rid, record_key, record_columns)
+            version_rid = self.visible_version(rid, snapshot)
+            if version_rid is None:
+                return None
+            versions = self.version_index.get(rid)
+            if versions is not None:
+                # skip straight to the version, the index holds every committed one
+                position = versions.position(snapshot)
+                version_rid = versions.rids[max(0, position - abs(version))]
+                record_columns = self.read_version(version_rid)
+                return Record(version_rid, record_columns[self.key], record_columns)
+        if version_rid == rid:
+            with self.bufferpool.record_page(self.name, rid) as base_frame:
+                if (base_frame.get_schema_encoding(rid_slot(rid)) or 0) & DELETED:
+                    return None
+                version_rid = base_frame.get_indirection(rid_slot(rid))
+        if version_rid is None or rid_mark(version_rid) != 't':
+            return self.get_record(rid, snapshot)  # never updated, the base record is the only version
+        stats = self.range_stats(rid_page_range(rid))
+        stats.reads += 1
+        stats.hops += 1
+        for _ in range(abs(version)):
+            with self.bufferpool.record_page(self.name, version_rid) as frame:
+                previous_rid = frame.get_indirection(rid_slot(version_rid))
+            if previous_rid is None or rid_mark(previous_rid) != 't':
+                break
+            version_rid = previous_rid
+            stats.hops += 1
+
+        record_columns = self.read_version(version_rid)
+        record_key = record_columns[self.key]
+        return Record(version_rid, record_key, record_columns)
@@ -1,5 +1,10 @@
 from lstore.table import Table, Record
 from lstore.index import Index
+from lstore.lock_manager import next_transaction_id, get_current_transaction, set_current_transaction
+from lstore.mvcc import clock
+
+# Queries that only read, a transaction made of nothing else runs at a snapshot, see lstore/mvcc.py
+READ_QUERIES = ('select', 'select_version', 'select_as_of', 'sum', 'sum_version', 'sum_as_of', 'aggregate')
 
 class Transaction:
 
@@ -8,7 +13,11 @@ class Transaction:
     """
     def __init__(self):
         self.queries = []
-        pass
+        self.lock_conflict = False  # set when a query was refused a lock, the worker may run the transaction again
+        self.txn_id = None  # assigned on the first run and kept across re-runs, so wait-die lets it age
+        self.held_locks = set()  # (lock manager, item) of every lock held, released on commit or abort
+        self.undo_log = []  # (table, entry) of every change made so far, see Table.undo
+        self.snapshot = None  # timestamp a read-only run reads at without locks, None while the transaction writes
 
     """
     # Adds the given query to this transaction
@@ -18,26 +27,88 @@ class Transaction:
     # t.add_query(q.update, grades_table, 0, *[None, 1, None, 2, None])
     """
     def add_query(self, query, table, *args):
-        self.queries.append((query, args))
-        # use grades_table for aborting
+        self.queries.append((query, table, args))
 
         
     # If you choose to implement this differently this method must still return True if transaction commits or False on abort
     def run(self):
-        for query, args in self.queries:
-            result = query(*args)
-            # If the query has failed the transaction should abort
-            if result == False:
-                return self.abort()
-        return self.commit()
+        self.lock_conflict = False
+        if self.txn_id is None:
+            self.txn_id = next_transaction_id()
+        self.snapshot = clock.snapshot() if self.read_only() else None
+        outer = get_current_transaction()
+        set_current_transaction(self)
+        try:
+            for query, table, args in self.queries:
+                try:
+                    result = query(*args)
+                except Exception:
+                    # a query that crashed is rolled back like one that failed
+                    return self.abort()
+                # If the query has failed the transaction should abort
+                if result == False:
+                    return self.abort()
+            return self.commit()
+        finally:
+            # should the abort itself raise, the locks are still not left behind
+            if self.held_locks:
+                self.release_locks()
+            set_current_transaction(outer)
+
+    def read_only(self):
+        return all(getattr(query, '__name__', None) in READ_QUERIES for query, table, args in self.queries)
+
+    """
+    # Locks item in the table's lock manager until the transaction commits or aborts
+    # Returns False and marks the transaction as refused a lock if it cannot be granted
+    """
+    def acquire_lock(self, lock_manager, item, exclusive):
+        if not lock_manager.acquire(self.txn_id, item, exclusive):
+            self.lock_conflict = True
+            return False
+        self.held_locks.add((lock_manager, item))
+        return True
+
+    """
+    # Records a change in the undo log and the write-ahead log
+    """
+    def log_change(self, table, entry):
+        self.undo_log.append((table, entry))
+        table.bufferpool.wal.log_change(self.txn_id, table.name, entry)
+
+    def release_locks(self):
+        # strict 2PL: nothing is released before the transaction ends
+        for lock_manager, item in self.held_locks:
+            lock_manager.release(self.txn_id, item)
+        self.held_locks = set()
 
     
     def abort(self):
-        #TODO: do roll-back and any other necessary operations
+        # roll back newest first, the locks still keep everyone else away from these records
+        for table, entry in reversed(self.undo_log):
+            with table.latch:
+                table.undo(entry)
+                table.bufferpool.wal.log_change(self.txn_id, table.name, entry, compensation=True)
+        if self.undo_log:
+            self.undo_log[0][0].bufferpool.wal.abort(self.txn_id)
+        self.undo_log = []
+        self.release_locks()
         return False
 
     
     def commit(self):
-        # TODO: commit to database
+        if self.undo_log:
+            timestamp = clock.begin_commit()
+            try:
+                # returns once the COMMIT record is durable, read-only transactions have nothing to log
+                self.undo_log[0][0].bufferpool.wal.commit(self.txn_id, timestamp)
+                # snapshots only pass the timestamp once every version is stamped, see CommitClock
+                for table, entry in self.undo_log:
+                    with table.latch:
+                        table.stamp(entry, timestamp)
+            finally:
+                clock.end_commit(timestamp)
+        self.undo_log = []
+        self.release_locks()
         return True
 
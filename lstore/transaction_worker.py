@@ -1,16 +1,40 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lstore.config import *
 from lstore.table import Table, Record
 from lstore.index import Index
 
+# One pool of threads is shared by every worker, see get_worker_pool
+worker_pool = None
+worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is None:
+            worker_pool = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix='lstore-worker')
+    return worker_pool
+
+
 class TransactionWorker:
 
     """
     # Creates a transaction worker object.
     """
-    def __init__(self, transactions = []):
+    def __init__(self, transactions = None):
         self.stats = []
-        self.transactions = transactions
+        self.transactions = transactions if transactions is not None else []
         self.result = 0
-        pass
+        self.commits = 0  # transactions that committed
+        self.aborts = 0  # transactions that aborted for good
+        self.retries = 0  # re-runs of transactions refused a lock
+        self.latencies = []  # seconds from first attempt to final outcome, per transaction
+        self.elapsed = 0
+        self.future = None
 
     
     """
@@ -24,21 +48,56 @@ class TransactionWorker:
     Runs all transaction as a thread
     """
     def run(self):
-        pass
-        # here you need to create a thread and call __run
+        # the worker's transactions run in order on one thread of the shared pool
+        self.future = get_worker_pool().submit(self.__run)
     
 
     """
     Waits for the worker to finish
     """
     def join(self):
-        pass
+        if self.future is not None:
+            # re-raises anything that escaped __run
+            self.future.result()
+
+
+    """
+    Returns the worker's counters and latency figures
+    """
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'commits': self.commits,
+            'aborts': self.aborts,
+            'retries': self.retries,
+            'mean_latency': sum(latencies) / len(latencies) if latencies else 0,
+            'p99_latency': latencies[int(0.99 * (len(latencies) - 1))] if latencies else 0,
+            'throughput': self.commits / self.elapsed if self.elapsed else 0,
+        }
 
 
     def __run(self):
+        worker_start = time.perf_counter()
         for transaction in self.transactions:
+            start = time.perf_counter()
             # each transaction returns True if committed or False if aborted
-            self.stats.append(transaction.run())
+            committed = transaction.run()
+            attempts = 0
+            backoff = TRANSACTION_RETRY_BACKOFF
+            # only transactions refused a lock are worth running again
+            while not committed and transaction.lock_conflict and attempts < TRANSACTION_MAX_RETRIES:
+                attempts += 1
+                time.sleep(backoff * random.random())
+                backoff = min(backoff * 2, TRANSACTION_MAX_BACKOFF)
+                committed = transaction.run()
+            self.retries += attempts
+            self.latencies.append(time.perf_counter() - start)
+            if committed:
+                self.commits += 1
+            else:
+                self.aborts += 1
+            self.stats.append(committed)
+        self.elapsed = time.perf_counter() - worker_start
         # stores the number of transactions that committed
         self.result = len(list(filter(lambda x: x, self.stats)))
 
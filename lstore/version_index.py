@@ -0,0 +1,63 @@
+"""
+Per-record version index.
+Finding the version a reader at some timestamp sees means walking the record's tail chain newest first, one tail
+record and often one tail page per hop, see Table.visible_version. For records with long histories the table keeps
+the commit timestamps and RIDs of their committed tail records in memory, oldest first, so a lookup deep into the
+history is a binary search instead of a walk.
+
+A record is indexed once a lookup walks VERSION_INDEX_DEPTH tail records, by walking its whole chain one more time,
+and versions committed after that are added as they are stamped. Nothing is saved, the index is built again as
+lookups need it after the database is reopened. It is changed under the table latch and read without it: a reader
+at snapshot s only looks at versions stamped no later than s, and versions stamped later always go after them.
+"""
+from array import array
+from bisect import bisect_right
+
+
+class RecordVersions:
+    """
+    Commit timestamps and RIDs of the committed tail records of one base record, oldest first
+    """
+    __slots__ = ('timestamps', 'rids')
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.rids = array('q')
+
+    def add(self, timestamp, rid):
+        if not self.timestamps or timestamp >= self.timestamps[-1]:
+            self.timestamps.append(timestamp)
+            self.rids.append(rid)
+            return
+        # a commit stamped after a newer one, keep the timestamps sorted
+        position = bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(position, timestamp)
+        self.rids.insert(position, rid)
+
+    def position(self, timestamp):
+        # position of the newest version committed no later than timestamp, -1 if there is none
+        return bisect_right(self.timestamps, timestamp) - 1
+
+
+class VersionIndex:
+    def __init__(self):
+        self.records = {}  # base rid -> RecordVersions
+
+    def get(self, rid):
+        return self.records.get(rid)
+
+    def index(self, rid, versions):
+        """
+        Index a record given (timestamp, tail rid) of each of its committed tail records, newest first
+        """
+        record_versions = RecordVersions()
+        for timestamp, version_rid in reversed(versions):
+            record_versions.add(timestamp, version_rid)
+        self.records[rid] = record_versions
+        return record_versions
+
+    def add(self, rid, timestamp, version_rid):
+        # a tail record of rid was committed, only kept if the record is indexed
+        record_versions = self.records.get(rid)
+        if record_versions is not None:
+            record_versions.add(timestamp, version_rid)
@@ -0,0 +1,312 @@
+"""
+Write-ahead log.
+Every change a query makes is appended to {path}/wal.log before the page holding it can reach disk, and a
+transaction only commits once its COMMIT record is on stable storage.
+
+The log file starts with a header holding the LSN of its first record, followed by the records (little-endian):
+    length, crc32       of the payload
+    payload             LSN, transaction id, record type, then a body depending on the type
+LSNs are log byte positions that keep growing for the life of the database, so a checkpoint can drop the front
+of the file without renumbering what is left. A torn or corrupt record ends the log when it is read back.
+
+Group commit: committing threads queue their COMMIT record and wait. The first one to find no flush in progress
+becomes the leader and writes and fsyncs everything queued so far, so transactions committing at the same time
+share one fsync.
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+from lstore.config import *
+from lstore.rid import NULL_RID, encode_rid, decode_rid
+
+# Record types
+INSERT = 1
+UPDATE = 2
+DELETE = 3
+COMMIT = 4  # its body is the commit timestamp, see lstore/mvcc.py
+ABORT = 5
+CLR = 6  # compensation: a change undone by an abort, so redo repeats the undo as well
+CHECKPOINT = 7  # a checkpoint finished, its body is the LSN it started at
+
+# Changes made by queries run outside a transaction are logged under this id and count as committed
+AUTOCOMMIT_TXN = 0
+
+LOG_MAGIC = b'LSWL'
+LOG_FORMAT_VERSION = 3
+LOG_HEADER_FORMAT = '<4sIq'  # magic, version, LSN of the first record in the file
+LOG_HEADER_SIZE = struct.calcsize(LOG_HEADER_FORMAT)
+FRAME_FORMAT = '<II'  # payload length, crc32 of the payload
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+RECORD_HEADER_FORMAT = '<QQB'  # LSN, transaction id, record type
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+
+class LogRecord:
+    def __init__(self, lsn, txn_id, record_type, table_name=None, entry=None):
+        self.lsn = lsn
+        self.txn_id = txn_id
+        self.type = record_type
+        self.table_name = table_name
+        self.entry = entry  # the change in the form of a Table.undo entry
+        self.end = None  # log offset right after the record
+
+
+def pack_values(values):
+    # a column count, a null bitmap and one int64 per column, None is stored as 0
+    bitmap = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value is None:
+            bitmap[i // 8] |= 1 << (i % 8)
+    return (struct.pack('<H', len(values)) + bytes(bitmap)
+            + struct.pack(f'<{len(values)}q', *[0 if value is None else value for value in values]))
+
+
+def unpack_values(data, offset):
+    (count,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    bitmap = data[offset:offset + (count + 7) // 8]
+    offset += len(bitmap)
+    values = list(struct.unpack_from(f'<{count}q', data, offset))
+    offset += 8 * count
+    for i in range(count):
+        if bitmap[i // 8] >> (i % 8) & 1:
+            values[i] = None
+    return values, offset
+
+
+def encode_entry(entry):
+    operation = entry[0]
+    if operation == 'insert':
+        _, rid, columns = entry
+        return INSERT, struct.pack('<q', encode_rid(rid)) + pack_values(columns)
+    if operation in ('update', 'delete'):
+        # a delete writes a tombstone version, logged like an update
+        _, rid, tail_rid, origin_columns, origin_indirection, origin_schema, columns = entry
+        return UPDATE if operation == 'update' else DELETE, (struct.pack('<qqqq', encode_rid(rid), encode_rid(tail_rid), encode_rid(origin_indirection),
+                                    NULL_RID if origin_schema is None else origin_schema)
+                        + pack_values(origin_columns) + pack_values(columns))
+    raise Exception(f"error in encode_entry, unknown operation: {operation}")
+
+
+def decode_entry(record_type, data, offset):
+    if record_type == INSERT:
+        (rid,) = struct.unpack_from('<q', data, offset)
+        columns, offset = unpack_values(data, offset + 8)
+        return ('insert', decode_rid(rid), tuple(columns))
+    if record_type in (UPDATE, DELETE):
+        rid, tail_rid, origin_indirection, origin_schema = struct.unpack_from('<qqqq', data, offset)
+        origin_columns, offset = unpack_values(data, offset + 32)
+        columns, offset = unpack_values(data, offset)
+        return ('update' if record_type == UPDATE else 'delete', decode_rid(rid), decode_rid(tail_rid), origin_columns, decode_rid(origin_indirection),
+                None if origin_schema == NULL_RID else origin_schema, tuple(columns))
+    raise Exception(f"error in decode_entry, unknown record type: {record_type}")
+
+
+def read_log(path):
+    """
+    Yield every intact record of the log at path in LSN order
+    Reading stops at the first torn or corrupt record
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as file:
+        data = file.read()
+    if len(data) < LOG_HEADER_SIZE or data[:4] != LOG_MAGIC:
+        return
+    version = struct.unpack_from(LOG_HEADER_FORMAT, data, 0)[1]
+    if version != LOG_FORMAT_VERSION and len(data) > LOG_HEADER_SIZE:
+        raise Exception(f"error in read_log, unsupported log format version: {version}")
+    offset = LOG_HEADER_SIZE
+    while offset + FRAME_SIZE <= len(data):
+        length, checksum = struct.unpack_from(FRAME_FORMAT, data, offset)
+        payload = data[offset + FRAME_SIZE:offset + FRAME_SIZE + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        lsn, txn_id, record_type = struct.unpack_from(RECORD_HEADER_FORMAT, payload, 0)
+        record = LogRecord(lsn, txn_id, record_type)
+        if record_type in (INSERT, UPDATE, DELETE, CLR):
+            body = RECORD_HEADER_SIZE
+            change_type = record_type
+            if record_type == CLR:
+                change_type = payload[body]
+                body += 1
+            (name_length,) = struct.unpack_from('<H', payload, body)
+            body += 2
+            record.table_name = payload[body:body + name_length].decode()
+            record.entry = decode_entry(change_type, payload, body + name_length)
+        elif record_type in (CHECKPOINT, COMMIT):
+            (record.entry,) = struct.unpack_from('<q', payload, RECORD_HEADER_SIZE)
+        offset += FRAME_SIZE + length
+        record.end = offset
+        yield record
+
+
+class WriteAheadLog:
+    def __init__(self, path):
+        self.path = f"{path}/wal.log"
+        os.makedirs(path, exist_ok=True)
+        self.fd = self.open_log()
+        self.mutex = threading.Lock()
+        self.flushed = threading.Condition(self.mutex)  # notified whenever a flush finishes
+        self.buffer = []  # encoded records not yet written
+        self.next_lsn = self.start_lsn + os.fstat(self.fd).st_size - LOG_HEADER_SIZE
+        self.flushed_lsn = self.next_lsn  # every record below this LSN is on stable storage
+        self.flushing = False  # a leader is writing the log
+        self.active = {}  # transaction id -> LSN of its first record, until its COMMIT or ABORT
+        self.group_commits = 0  # fsyncs issued for commits
+        self.commits = 0  # COMMIT records made durable
+
+    def open_log(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        header = os.pread(fd, LOG_HEADER_SIZE, 0)
+        if len(header) < LOG_HEADER_SIZE or header[:4] != LOG_MAGIC:
+            os.ftruncate(fd, 0)
+            os.write(fd, struct.pack(LOG_HEADER_FORMAT, LOG_MAGIC, LOG_FORMAT_VERSION, 0))
+            header = os.pread(fd, LOG_HEADER_SIZE, 0)
+        _, version, self.start_lsn = struct.unpack(LOG_HEADER_FORMAT, header)
+        if version != LOG_FORMAT_VERSION and os.fstat(fd).st_size == LOG_HEADER_SIZE:
+            # an empty log left by an older format, the records appended from now on are in this one
+            os.ftruncate(fd, 0)
+            os.write(fd, struct.pack(LOG_HEADER_FORMAT, LOG_MAGIC, LOG_FORMAT_VERSION, self.start_lsn))
+        return fd
+
+    def offset(self, lsn):
+        # position of an LSN in the log file
+        return LOG_HEADER_SIZE + lsn - self.start_lsn
+
+    def size(self):
+        # bytes of log kept since the front of the file was last dropped
+        return self.next_lsn - self.start_lsn
+
+    def append(self, txn_id, record_type, body=b''):
+        """
+        Buffer one record and return its LSN
+        """
+        with self.mutex:
+            lsn = self.next_lsn
+            payload = struct.pack(RECORD_HEADER_FORMAT, lsn, txn_id, record_type) + body
+            self.buffer.append(struct.pack(FRAME_FORMAT, len(payload), zlib.crc32(payload)) + payload)
+            self.next_lsn += FRAME_SIZE + len(payload)
+            if record_type in (COMMIT, ABORT):
+                self.active.pop(txn_id, None)
+            elif record_type != CHECKPOINT and txn_id != AUTOCOMMIT_TXN:
+                self.active.setdefault(txn_id, lsn)
+            return lsn
+    def log_change(self, txn_id, table_name, entry, compensation=False):
+        record_type, body = encode_entry(entry)
+        name = table_name.encode()
+        body = struct.pack('<H', len(name)) + name + body
+        if compensation:
+            # a CLR carries the change it undid, tagged with that change's type
+            return self.append(txn_id, CLR, struct.pack('<B', record_type) + body)
+        return self.append(txn_id, record_type, body)
+
+    def commit(self, txn_id, timestamp, durable=True):
+        """
+        Log the COMMIT record of a transaction with its commit timestamp and return once it is durable
+        Changes made outside a transaction are followed by a COMMIT record of their own that is not waited for
+        """
+        lsn = self.append(txn_id, COMMIT, struct.pack('<q', timestamp))
+        if durable:
+            self.flush(lsn, commit=True)
+        return lsn
+
+    def abort(self, txn_id):
+        # the undo already ran, nothing waits on an abort being durable
+        return self.append(txn_id, ABORT)
+
+    def flush(self, lsn=None, commit=False):
+        """
+        Make every record up to and including lsn durable, or everything buffered if lsn is None
+        """
+        with self.mutex:
+            target = self.next_lsn if lsn is None else lsn + 1
+            while self.flushed_lsn < target:
+                if self.flushing:
+                    # a leader is already writing, its flush or the next one will cover this record
+                    self.flushed.wait()
+                    continue
+                self.flushing = True
+                if commit and GROUP_COMMIT_DELAY:
+                    # give commits arriving right behind this one the chance to share the fsync
+                    self.mutex.release()
+                    time.sleep(GROUP_COMMIT_DELAY)
+                    self.mutex.acquire()
+                batch = self.buffer
+                self.buffer = []
+                end = self.next_lsn
+                self.mutex.release()
+                try:
+                    os.write(self.fd, b''.join(batch))
+                    if WAL_FSYNC:
+                        os.fsync(self.fd)
+                finally:
+                    self.mutex.acquire()
+                    self.flushing = False
+                    self.flushed.notify_all()
+                self.flushed_lsn = end
+                if commit:
+                    self.group_commits += 1
+            if commit:
+                self.commits += 1
+
+    def checkpoint(self, begin_lsn):
+        """
+        Log that a checkpoint which started at begin_lsn has finished and return its LSN
+        """
+        lsn = self.append(AUTOCOMMIT_TXN, CHECKPOINT, struct.pack('<q', begin_lsn))
+        self.flush(lsn)
+        return lsn
+
+    def oldest_active_lsn(self):
+        with self.mutex:
+            return min(self.active.values(), default=self.next_lsn)
+
+    def discard_before(self, lsn):
+        """
+        Drop the durable records below lsn from the front of the log
+        The rest is copied to a new file which then replaces the log, so a crash leaves one or the other
+        """
+        with self.mutex:
+            while self.flushing:
+                self.flushed.wait()
+            lsn = min(lsn, self.flushed_lsn)
+            if lsn <= self.start_lsn:
+                return
+            kept = os.pread(self.fd, self.flushed_lsn - lsn, self.offset(lsn))
+            temp_path = self.path + '.tmp'
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, struct.pack(LOG_HEADER_FORMAT, LOG_MAGIC, LOG_FORMAT_VERSION, lsn) + kept)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(temp_path, self.path)
+            os.close(self.fd)
+            self.fd = self.open_log()
+
+    def truncate(self, end=LOG_HEADER_SIZE):
+        """
+        Cut the log file at offset end, recovery drops a torn tail this way
+        """
+        with self.mutex:
+            self.buffer = []
+            os.ftruncate(self.fd, end)
+            if WAL_FSYNC:
+                os.fsync(self.fd)
+            self.next_lsn = self.start_lsn + end - LOG_HEADER_SIZE
+            self.flushed_lsn = self.next_lsn
+
+    def reset(self):
+        """
+        Empty the log, once every change it holds is in the page range and table files
+        """
+        self.flush()
+        self.discard_before(self.next_lsn)
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+
+
+def watch_tail_reads(table, monkeypatch):
+    # the tail pages read from now on
+    reads = []
+    page = table.bufferpool.page
+
+    @contextmanager
+    def watched(key_directory, exclusive=False):
+        if key_directory[3] == 't':
+            reads.append(key_directory)
+        with page(key_directory, exclusive) as frame:
+            yield frame
+
+    monkeypatch.setattr(table.bufferpool, 'page', watched)
+    return reads
+
+
+def test_sum_of_a_column_never_updated_reads_only_base_pages(grades, monkeypatch):
+    _, table, query = grades
+    for key in range(100):
+        assert query.insert(key, key, key)
+    for key in range(100):
+        assert query.update(key, None, key + 1, None)
+
+    reads = watch_tail_reads(table, monkeypatch)
+    assert query.sum(0, 99, 2) == sum(range(100))
+    assert query.sum_version(0, 99, 2, -1) == sum(range(100))
+    assert reads == []
+
+    assert query.sum(0, 99, 1) == sum(range(1, 101))
+    assert query.sum_version(0, 99, 1, -1) == sum(range(100))
+    assert reads != []
@@ -0,0 +1,199 @@
+import random
+import sys
+import threading
+
+import pytest
+
+from lstore.btree import BPlusTree
+from lstore.bufferpool import Bufferpool
+from lstore.db import Database
+from lstore.query import Query
+
+VALUES = 300
+RIDS = 10 ** 6
+RECORDS = 20000  # per table in the threaded test
+
+
+def open_tree(path, fresh=False):
+    bufferpool = Bufferpool(str(path))
+    bufferpool.register_table('Grades', 1)
+    return bufferpool, BPlusTree(bufferpool, 'Grades', 0, fresh=fresh)
+
+
+def random_entry(rng):
+    return rng.randrange(VALUES), rng.randrange(RIDS)
+
+
+class Model:
+    """
+    The entries the tree should hold, with constant time random picks
+    """
+
+    def __init__(self, entries=()):
+        self.entries = list(entries)
+        self.positions = {entry: i for i, entry in enumerate(self.entries)}
+
+    def __contains__(self, entry):
+        return entry in self.positions
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        if entry not in self.positions:
+            self.positions[entry] = len(self.entries)
+            self.entries.append(entry)
+
+    def discard(self, entry):
+        position = self.positions.pop(entry, None)
+        if position is not None:
+            last = self.entries.pop()
+            if position < len(self.entries):
+                self.entries[position] = last
+                self.positions[last] = position
+
+    def choice(self, rng):
+        return rng.choice(self.entries)
+
+    def sorted(self, low=None, high=None):
+        return sorted(entry for entry in self.entries
+                      if (low is None or low <= entry[0]) and (high is None or entry[0] <= high))
+
+
+@pytest.fixture(autouse=True)
+def small_bufferpool(monkeypatch):
+    # few frames, so tree nodes keep being evicted and read back
+    monkeypatch.setattr('lstore.bufferpool.FRAMECOUNT', 12)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_random_operations_match_a_sorted_set(tmp_path, seed):
+    rng = random.Random(seed)
+    bufferpool, tree = open_tree(tmp_path, fresh=True)
+    model = Model()
+    for step in range(20):
+        if rng.random() < 0.3:
+            batch = sorted({random_entry(rng) for _ in range(rng.randrange(1, 2000))} - set(model.entries))
+            tree.insert_many(batch)
+            for entry in batch:
+                model.add(entry)
+        if model and rng.random() < 0.3:
+            batch = sorted({model.choice(rng) for _ in range(rng.randrange(1, 1000))}
+                           | {random_entry(rng) for _ in range(100)})
+            assert tree.delete_many(batch) == [entry for entry in batch if entry in model]
+            for entry in batch:
+                model.discard(entry)
+        for _ in range(1000):
+            entry = random_entry(rng)
+            if rng.random() < 0.5:
+                assert tree.insert(entry) == (entry not in model)
+                model.add(entry)
+            elif model:
+                if rng.random() < 0.6:
+                    entry = model.choice(rng)
+                assert tree.delete(entry) == (entry in model)
+                model.discard(entry)
+        low, high = sorted(rng.sample(range(VALUES), 2))
+        assert list(tree.items(low, high)) == model.sorted(low, high)
+        entry = random_entry(rng)
+        assert (entry in tree) == (entry in model)
+    assert list(tree.items()) == model.sorted()
+    bufferpool.close()
+
+
+def test_saved_tree_survives_a_crash(tmp_path):
+    rng = random.Random(4)
+    latch = threading.RLock()
+    bufferpool, tree = open_tree(tmp_path, fresh=True)
+    model = Model()
+    saved = None
+    for step in range(30):
+        for _ in range(1000):
+            entry = random_entry(rng)
+            if rng.random() < 0.6:
+                tree.insert(entry)
+                model.add(entry)
+            elif model:
+                entry = model.choice(rng)
+                tree.delete(entry)
+                model.discard(entry)
+        if rng.random() < 0.4:
+            with latch:
+                snapshot = tree.freeze()
+            if snapshot is not None:
+                tree.save(snapshot, latch)
+            saved = list(model.entries)
+        if saved is not None and rng.random() < 0.3:
+            # crash: some dirty nodes reach disk, the rest are lost
+            for frame_index, key in enumerate(bufferpool.frame_info):
+                if key is not None and bufferpool.frames[frame_index].dirtyBit and rng.random() < 0.5:
+                    bufferpool.write_to_disk(key, bufferpool.frames[frame_index])
+            bufferpool.disk.close()
+            bufferpool, tree = open_tree(tmp_path)
+            model = Model(saved)
+            assert list(tree.items()) == model.sorted()
+    bufferpool.close()
+
+
+def test_lookups_stay_right_while_other_tables_fault_pages(tmp_path):
+    # index lookups on one table while reads of another keep evicting frames of the shared pool
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        db = Database()
+        db.open(str(tmp_path))
+        a = db.create_table('A', 3, 0)
+        b = db.create_table('B', 3, 0)
+        query_a, query_b = Query(a), Query(b)
+        query_a.insert_many([(key, key, key) for key in range(RECORDS)])
+        query_b.insert_many([(key, key, key) for key in range(RECORDS)])
+        errors = []
+
+        def look_up(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(1000):
+                    key = rng.randrange(RECORDS)
+                    with a.latch:
+                        if len(a.index.locate(0, key)) != 1:
+                            errors.append(key)
+            except Exception as error:
+                errors.append(error)
+
+        def scan():
+            try:
+                for _ in range(20):
+                    query_b.sum(0, RECORDS - 1, 1)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=look_up, args=(seed,)) for seed in range(3)]
+        threads += [threading.Thread(target=scan) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        db.close()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def test_locate_all_intersects_the_postings_of_several_columns(tmp_path):
+    db = Database()
+    db.open(str(tmp_path))
+    table = db.create_table('Grades', 4, 0)
+    # dense and sparse posting containers, spread over several chunks
+    rows = [(key, key % 2, key % 7, key // 3) for key in range(RECORDS)]
+    Query(table).insert_many(rows)
+    rids = {key: table.index.locate(0, key)[0] for key in range(RECORDS)}
+
+    def expected(conditions):
+        return sorted(rids[row[0]] for row in rows if all(row[column] == value for column, value in conditions.items()))
+
+    for conditions in [{1: 1, 2: 3}, {2: 6, 1: 0}, {1: 0, 2: 0, 3: 42}, {3: 100}, {0: 5, 1: 1}]:
+        assert table.index.locate_all(conditions) == expected(conditions)
+    assert table.index.locate_all({0: 5, 1: 0}) == []
+    assert table.index.locate_all({1: 2, 2: 3}) == []
+    assert table.index.locate_all({}) == []
+    db.close()
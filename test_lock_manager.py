@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+from lstore.lock_manager import LockManager
+
+ITEM = 7
+OTHER = ('key', 8)
+TIMEOUT = 5
+
+
+def entries(manager):
+    return {item: entry for shard in manager.shards for item, entry in shard.entries.items()}
+
+
+def wait_for_waiters(manager, item, count):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        shard = manager.get_shard(item)
+        with shard.mutex:
+            entry = shard.entries.get(item)
+            if entry is not None and entry.lockInfo.waiters == count:
+                return
+        time.sleep(0.001)
+    raise AssertionError(f"no {count} waiters on {item}")
+
+
+class Request(threading.Thread):
+    """
+    A lock request made on its own thread, so a test can check whether it blocks
+    """
+
+    def __init__(self, manager, txn_id, item, exclusive):
+        super().__init__(daemon=True)
+        self.args = manager, txn_id, item, exclusive
+        self.granted = None
+        self.start()
+
+    def run(self):
+        manager, txn_id, item, exclusive = self.args
+        self.granted = manager.acquire(txn_id, item, exclusive)
+
+    def result(self):
+        self.join(TIMEOUT)
+        assert not self.is_alive()
+        return self.granted
+
+
+@pytest.mark.parametrize('policy', ['no-wait', 'wait-die'])
+def test_shared_locks_are_compatible_and_exclusive_ones_conflict(policy):
+    # Requests come from younger transactions, so wait-die refuses them instead of waiting
+    manager = LockManager(policy=policy)
+    assert manager.acquire(1, ITEM, False)
+    assert manager.acquire(2, ITEM, False)
+    assert not manager.acquire(3, ITEM, True)
+
+    assert manager.acquire(4, OTHER, True)
+    assert not manager.acquire(5, OTHER, False)
+    assert not manager.acquire(6, OTHER, True)
+    # An exclusive holder may read and lock again what it holds
+    assert manager.acquire(4, OTHER, False)
+    assert manager.acquire(4, OTHER, True)
+
+
+def test_shared_lock_upgrades_only_for_the_sole_reader():
+    manager = LockManager(policy='no-wait')
+    assert manager.acquire(1, ITEM, False)
+    assert manager.acquire(2, ITEM, False)
+    assert not manager.acquire(1, ITEM, True)
+
+    manager.release(2, ITEM)
+    assert manager.acquire(1, ITEM, True)
+    assert not manager.acquire(2, ITEM, False)
+    lock = entries(manager)[ITEM].lockInfo
+    assert (lock.writer, lock.readers) == (1, set())
+
+
+def test_released_locks_leave_their_shard():
+    manager = LockManager(policy='no-wait')
+    assert manager.acquire(1, ITEM, False)
+    assert manager.acquire(2, ITEM, False)
+    assert manager.acquire(1, OTHER, True)
+    assert manager.is_locked(ITEM) and manager.is_locked(OTHER)
+
+    manager.release(1, ITEM)
+    assert manager.is_locked(ITEM)
+    manager.release(2, ITEM)
+    manager.release(1, OTHER)
+    assert not manager.is_locked(ITEM) and not manager.is_locked(OTHER)
+    assert entries(manager) == {}
+    # Neither a refused request nor releasing a lock that is not held leaves an entry behind
+    assert manager.acquire(1, ITEM, True)
+    assert not manager.acquire(2, ITEM, True)
+    manager.release(1, ITEM)
+    manager.release(3, OTHER)
+    assert entries(manager) == {}
+
+
+def test_wait_die_younger_transaction_dies():
+    manager = LockManager(policy='wait-die')
+    assert manager.acquire(1, ITEM, True)
+    assert not manager.acquire(2, ITEM, False)
+    assert not manager.acquire(2, ITEM, True)
+    assert entries(manager)[ITEM].lockInfo.waiters == 0
+
+
+def test_wait_die_older_transaction_waits_for_the_holder():
+    manager = LockManager(num_shards=1, policy='wait-die')
+    assert manager.acquire(2, ITEM, False)
+    assert manager.acquire(3, ITEM, False)
+    request = Request(manager, 1, ITEM, True)
+    wait_for_waiters(manager, ITEM, 1)
+
+    # Releasing one of two readers is not enough for the exclusive lock
+    manager.release(2, ITEM)
+    assert request.is_alive()
+    manager.release(3, ITEM)
+    assert request.result()
+    lock = entries(manager)[ITEM].lockInfo
+    assert (lock.writer, lock.waiters) == (1, 0)
+
+    manager.release(1, ITEM)
+    assert entries(manager) == {}
+
+
+def test_wait_die_avoids_deadlock_between_two_threads():
+    manager = LockManager(policy='wait-die')
+    assert manager.acquire(1, ITEM, True)
+    assert manager.acquire(2, OTHER, True)
+
+    # The older transaction waits for the younger one's item...
+    older = Request(manager, 1, OTHER, True)
+    wait_for_waiters(manager, OTHER, 1)
+    # ...while the younger one asking for the older one's item dies instead of closing the cycle
+    younger = Request(manager, 2, ITEM, True)
+    assert younger.result() is False
+
+    # Aborting releases its locks, which lets the older transaction go on
+    manager.release(2, OTHER)
+    assert older.result()
+    manager.release(1, ITEM)
+    manager.release(1, OTHER)
+    assert entries(manager) == {}
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(Exception):
+        LockManager(policy='wound-wait')
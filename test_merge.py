@@ -0,0 +1,111 @@
+import threading
+import time
+
+from lstore.merge import MergeScheduler, RangeStats
+
+PAGE_TIME = 0.02  # seconds a fake merge of one base page takes
+
+
+class FakePageRange:
+    def __init__(self, num_base_pages):
+        self.num_base_pages = num_base_pages
+
+
+class FakeTable:
+    """
+    What the scheduler uses of a table: its latch, range stats, page ranges and merge_page
+    """
+
+    def __init__(self, num_base_pages=1):
+        self.name = 'Grades'
+        self.num_columns = 3
+        self.latch = threading.RLock()
+        self.stats = {}
+        self.bufferpool = self
+        self.num_base_pages = num_base_pages
+        self.merged = []  # (page range index, page index) in merge order
+        self.merging = 0  # seconds spent in merge_page
+
+    def range_stats(self, page_range_index):
+        return self.stats.setdefault(page_range_index, RangeStats())
+
+    def allocate_page_range(self, table_name, num_columns, page_range_index):
+        return FakePageRange(self.num_base_pages)
+
+    def merge_page(self, page_range_index, page_index):
+        start = time.perf_counter()
+        time.sleep(PAGE_TIME)
+        self.merged.append((page_range_index, page_index))
+        self.merging += time.perf_counter() - start
+        return True
+
+
+def pile_up(scheduler, table, page_range_index, tail_records, reads=0, hops=0):
+    # what updates and reads of a page range record in its stats
+    stats = table.range_stats(page_range_index)
+    stats.tail_records += tail_records
+    stats.reads += reads
+    stats.hops += hops
+    scheduler.tail_records_added(table, page_range_index, stats)
+    return stats
+
+
+def test_range_is_queued_once_it_reaches_the_threshold():
+    scheduler = MergeScheduler(threshold=10)
+    table = FakeTable()
+    stats = pile_up(scheduler, table, 0, 9)
+    assert not stats.queued and scheduler.queue == []
+    pile_up(scheduler, table, 0, 1)
+    assert stats.queued and len(scheduler.queue) == 1
+    # a queued range is not queued twice
+    pile_up(scheduler, table, 0, 10)
+    assert len(scheduler.queue) == 1
+
+
+def test_ranges_whose_reads_follow_more_tail_records_are_merged_first():
+    scheduler = MergeScheduler(threshold=10)
+    table = FakeTable()
+    pile_up(scheduler, table, 0, 20)
+    pile_up(scheduler, table, 1, 10, reads=10, hops=50)
+    pile_up(scheduler, table, 2, 30)
+    pile_up(scheduler, table, 3, 20)
+    # 1: 10 * (1 + 5) = 60, then 2: 30, then 0 and 3 at 20 in the order they were queued
+    assert [scheduler.pop()[1] for _ in range(4)] == [1, 2, 0, 3]
+
+
+def test_range_whose_priority_dropped_while_queued_goes_back_in_line():
+    scheduler = MergeScheduler(threshold=10)
+    table = FakeTable()
+    pile_up(scheduler, table, 0, 20, reads=10, hops=40)
+    pile_up(scheduler, table, 1, 50)
+    # range 0 was queued at 20 * (1 + 4) = 100, the cheap reads counted since then bring it down to 36
+    pile_up(scheduler, table, 0, 0, reads=40)
+    assert [scheduler.pop()[1] for _ in range(2)] == [1, 0]
+
+
+def test_stop_leaves_queued_ranges_for_the_next_run():
+    scheduler = MergeScheduler(threshold=10)
+    table = FakeTable()
+    stats = pile_up(scheduler, table, 0, 10)
+    scheduler.stop()
+    assert scheduler.queue == [] and not stats.queued
+    assert scheduler.pop() is None
+
+
+def test_workers_merge_every_base_page_within_their_budget():
+    budget = 0.25
+    scheduler = MergeScheduler(workers=1, threshold=10, budget=budget)
+    table = FakeTable(num_base_pages=4)
+    scheduler.start()
+    start = time.perf_counter()
+    stats = pile_up(scheduler, table, 0, 10)
+    deadline = start + 10
+    while (scheduler.merged_pages < 4 or stats.queued) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+
+    assert table.merged == [(0, page_index) for page_index in range(4)]
+    assert stats.tail_records == 0 and not stats.queued
+    # merging took a budget share of the time, the workers slept the rest
+    assert elapsed >= 0.9 * table.merging / budget
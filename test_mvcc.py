@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from lstore.transaction import Transaction
+
+
+def latch_is_free(table):
+    # whether another thread can take the table latch right now
+    result = []
+
+    def writer():
+        result.append(table.latch.acquire(timeout=1))
+        if result[0]:
+            table.latch.release()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def watch_page_reads(table, monkeypatch):
+    """
+    Record, for every record page read from now on, whether a writer could take the table latch meanwhile
+    """
+    seen = []
+    page = table.bufferpool.page
+
+    @contextmanager
+    def watched(key_directory, exclusive=False):
+        with page(key_directory, exclusive) as frame:
+            if key_directory[3] != 'i':
+                seen.append(latch_is_free(table))
+            yield frame
+
+    monkeypatch.setattr(table.bufferpool, 'page', watched)
+    return seen
+
+
+def test_reads_do_not_hold_the_table_latch_while_reading_pages(grades, monkeypatch):
+    _, table, query = grades
+    for key in range(10):
+        assert query.insert(key, key, 0)
+    for key in range(0, 10, 2):
+        assert query.update(key, None, key + 100, None)
+
+    seen = watch_page_reads(table, monkeypatch)
+    assert query.select(2, 0, [1, 1, 1])[0].columns == [2, 102, 0]
+    assert query.select_version(2, 0, [1, 1, 1], -1)[0].columns == [2, 2, 0]
+    assert query.sum(0, 9, 1) == sum(range(10)) + 500
+    assert query.aggregate(0, 9, 1, 'max') == 108
+
+    # and neither do the reads of a read-only transaction
+    transaction = Transaction()
+    transaction.add_query(query.select, table, 4, 0, [1, 1, 1])
+    transaction.add_query(query.sum, table, 0, 9, 1)
+    assert transaction.run()
+    assert seen and all(seen)
+
+
+def test_as_of_reads_match_the_value_a_version_held(grades):
+    _, table, query = grades
+    assert query.insert(1, 10, 0)
+    timestamp = time.time_ns()
+    assert query.update(1, None, 20, None)
+
+    assert query.select_as_of(20, 1, [1, 1, 1], timestamp) == []
+    assert query.select_as_of(10, 1, [1, 1, 1], timestamp)[0].columns == [1, 10, 0]
+    assert query.select(10, 1, [1, 1, 1]) == []
+    assert query.select(20, 1, [1, 1, 1])[0].columns == [1, 20, 0]
+    assert query.select_version(20, 1, [1, 1, 1], -1)[0].columns == [1, 10, 0]
+
+
+def test_deleted_record_stays_visible_to_earlier_snapshots(databases):
+    _, table, query = databases.open(create=True)
+    assert query.insert(1, 10, 0)
+    assert query.insert(2, 20, 0)
+    timestamp = time.time_ns()
+    assert query.delete(2)
+
+    assert query.select(2, 0, [1, 1, 1]) == []
+    assert query.sum(1, 2, 1) == 10
+    assert query.select_as_of(2, 0, [1, 1, 1], timestamp)[0].columns == [2, 20, 0]
+    assert query.sum_as_of(1, 2, 1, timestamp) == 30
+    assert not query.update(2, None, 21, None)
+    assert not query.delete(2)
+
+    # a new record under the deleted key
+    assert query.insert(2, 5, 0)
+    assert query.select(2, 0, [1, 1, 1])[0].columns == [2, 5, 0]
+    assert query.sum(1, 2, 1) == 15
+    assert query.select_as_of(2, 0, [1, 1, 1], timestamp)[0].columns == [2, 20, 0]
+    assert query.sum_as_of(1, 2, 1, timestamp) == 30
+
+    _, table, query = databases.open()
+    assert query.select(2, 0, [1, 1, 1])[0].columns == [2, 5, 0]
+    assert query.select_as_of(2, 0, [1, 1, 1], timestamp)[0].columns == [2, 20, 0]
+    assert query.sum_as_of(1, 2, 1, timestamp) == 30
+
+
+def test_changed_key_is_read_under_the_key_each_version_held(grades):
+    _, table, query = grades
+    assert query.insert(3, 30, 0)
+    timestamp = time.time_ns()
+    assert query.update(3, 4, None, None)
+
+    assert query.select(3, 0, [1, 1, 1]) == []
+    assert query.select(4, 0, [1, 1, 1])[0].columns == [4, 30, 0]
+    assert query.select_as_of(3, 0, [1, 1, 1], timestamp)[0].columns == [3, 30, 0]
+    assert query.sum(3, 3, 1) == 0
+    assert query.sum(3, 4, 1) == 30
+    assert query.sum_as_of(3, 4, 1, timestamp) == 30
+    assert query.sum_as_of(4, 4, 1, timestamp) == 0
+    assert not query.update(3, None, 31, None)
+
+
+def test_aborted_delete_and_update_leave_no_trace(grades):
+    _, table, query = grades
+    assert query.insert(1, 10, 0)
+    transaction = Transaction()
+    transaction.add_query(query.update, table, 1, None, 20, None)
+    transaction.add_query(query.delete, table, 1)
+    transaction.add_query(query.update, table, -1, None, 1, None)
+    assert not transaction.run()
+
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 10, 0]
+    assert table.index.locate(1, 20) == []
+    assert query.update(1, None, 11, None)
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 11, 0]
+
+
+def test_merge_moves_entries_of_replaced_values_to_the_history(databases):
+    _, table, query = databases.open(create=True)
+    rng = random.Random(1)
+    for key in range(1000):
+        assert query.insert(key, key % 10, 0)
+    timestamp = time.time_ns()
+    for _ in range(20):
+        for key in range(1000):
+            assert query.update(key, None, rng.randrange(10), None)
+    before_deletes = time.time_ns()
+    for key in range(0, 1000, 100):
+        assert query.delete(key)
+    for page_range_index in range(table.page_range_index + 1):
+        table.merge(page_range_index)
+
+    latest = {key: query.select(key, 0, [1, 1, 1])[0].columns[1] for key in range(1000) if key % 100}
+    rids = {key: table.index.locate(0, key)[0] for key in latest}
+    # the index holds the latest values only, deleted records are gone from it
+    assert sorted(table.index.locate(1, 3)) == sorted(rids[key] for key in latest if latest[key] == 3)
+    assert table.index.locate(0, 100) == []
+    assert query.select(100, 0, [1, 1, 1]) == []
+
+    # readers of older versions still find them
+    def keys_as_of(value, column, at):
+        return sorted(record.columns[0] for record in query.select_as_of(value, column, [1, 1, 1], at))
+
+    assert keys_as_of(3, 1, timestamp) == list(range(3, 1000, 10))
+    assert keys_as_of(100, 0, before_deletes) == [100]
+    assert keys_as_of(100, 0, time.time_ns()) == []
+    assert query.sum_as_of(0, 999, 1, timestamp) == sum(key % 10 for key in range(1000))
+
+    _, table, query = databases.open()
+    assert keys_as_of(3, 1, timestamp) == list(range(3, 1000, 10))
+    assert keys_as_of(100, 0, before_deletes) == [100]
+    assert sorted(record.columns[0] for record in query.select(3, 1, [1, 1, 1])) == \
+        sorted(key for key in latest if latest[key] == 3)
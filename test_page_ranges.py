@@ -0,0 +1,49 @@
+from lstore.config import MAX_RECORDS_PER_PAGE, MAX_BASEPAGES_PER_RANGE
+from lstore.rid import rid_page_range, rid_page
+
+RANGE_RECORDS = MAX_RECORDS_PER_PAGE * MAX_BASEPAGES_PER_RANGE
+
+
+def locate(table, key):
+    return table.index.locate(table.key, key)[0]
+
+
+def test_inserts_roll_over_to_new_page_ranges(databases):
+    _, table, query = databases.open(create=True)
+    count = 2 * RANGE_RECORDS + 10
+    for key in range(count):
+        assert query.insert(key, key, 0)
+
+    assert (rid_page_range(locate(table, RANGE_RECORDS - 1)), rid_page(locate(table, RANGE_RECORDS - 1))) == \
+        (0, MAX_BASEPAGES_PER_RANGE - 1)
+    assert (rid_page_range(locate(table, RANGE_RECORDS)), rid_page(locate(table, RANGE_RECORDS))) == (1, 0)
+    assert rid_page_range(locate(table, count - 1)) == 2
+    assert table.page_range_index == 2
+
+    assert query.update(count - 1, None, -1, None)
+    assert query.select(count - 1, 0, [1, 1, 1])[0].columns == [count - 1, -1, 0]
+    assert query.sum(0, count - 1, 1) == sum(range(count - 1)) - 1
+
+    _, table, query = databases.open()
+    assert query.select(count - 1, 0, [1, 1, 1])[0].columns == [count - 1, -1, 0]
+    assert query.sum(0, count - 1, 1) == sum(range(count - 1)) - 1
+    # new records keep going in the last page range
+    assert query.insert(count, count, 0)
+    assert rid_page_range(locate(table, count)) == 2
+
+
+def test_bulk_inserts_roll_over_to_new_page_ranges(grades):
+    _, table, query = grades
+    count = RANGE_RECORDS + 100
+    assert query.insert_many([(key, key, 0) for key in range(count)])
+    assert rid_page_range(locate(table, RANGE_RECORDS - 1)) == 0
+    assert rid_page_range(locate(table, RANGE_RECORDS)) == 1
+    assert query.sum(0, count - 1, 1) == sum(range(count))
+
+
+def test_bulk_insert_of_no_rows(grades):
+    _, table, query = grades
+    assert query.insert_many([])
+    assert table.bulk_insert(0, 0, []) == []
+    assert query.insert_many([(1, 1, 1)])
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 1, 1]
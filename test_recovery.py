@@ -0,0 +1,236 @@
+import os
+import threading
+import traceback
+
+import pytest
+
+from lstore.checkpoint import checkpoint
+from lstore.lock_manager import next_transaction_id, set_current_transaction
+from lstore.transaction import Transaction
+
+RECORDS = 1000
+
+
+@pytest.fixture(params=['pread', 'mmap'])
+def storage_mode(request, monkeypatch):
+    monkeypatch.setattr('lstore.bufferpool.STORAGE_MODE', request.param)
+    return request.param
+
+
+@pytest.fixture
+def databases(databases, storage_mode):
+    # the storage mode is picked before the database opens
+    return databases
+
+
+def crash(databases, work):
+    """
+    Run work(db, table, query) on the closed database in a child process that then dies without closing it
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            db, table, query = databases.open()
+            work(db, table, query)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+
+def start_loser():
+    # a transaction still running when the database crashes
+    loser = Transaction()
+    loser.txn_id = next_transaction_id()
+    set_current_transaction(loser)
+    return loser
+
+
+def expected_rows():
+    rows = {key: [key, key, -key] for key in range(RECORDS)}
+    for key in range(0, RECORDS, 3):
+        rows[key][1] = key + 1
+    del rows[2]
+    rows[RECORDS] = [RECORDS, 1, 1]
+    return rows
+
+
+def committed_work(table, query):
+    for key in range(0, RECORDS, 3):
+        transaction = Transaction()
+        transaction.add_query(query.update, table, key, None, key + 1, None)
+        assert transaction.run()
+    transaction = Transaction()
+    transaction.add_query(query.delete, table, 2)
+    assert transaction.run()
+    transaction = Transaction()
+    transaction.add_query(query.insert, table, RECORDS, 1, 1)
+    assert transaction.run()
+    # aborted before the crash
+    transaction = Transaction()
+    transaction.add_query(query.update, table, 5, None, 555, None)
+    transaction.add_query(query.update, table, -1, None, 1, None)
+    assert not transaction.run()
+
+
+def test_recovery_redoes_winners_and_undoes_losers(databases, monkeypatch):
+    # a small bufferpool, so pages changed by the loser are evicted before the crash
+    monkeypatch.setattr('lstore.bufferpool.FRAMECOUNT', 8)
+    _, table, query = databases.open(create=True)
+    for key in range(RECORDS):
+        assert query.insert(key, key, -key)
+    databases.close()
+
+    def work(db, table, query):
+        committed_work(table, query)
+        start_loser()
+        assert query.update(7, None, 777, 777)
+        assert query.insert(RECORDS + 1, 9, 9)
+        assert query.delete(8)
+        for key in range(100, RECORDS, 2):
+            assert query.update(key, None, None, 0)
+        table.bufferpool.wal.flush()
+
+    crash(databases, work)
+
+    db, table, query = databases.open()
+    assert db.recovery_stats['losers'] == 1
+    for key, row in expected_rows().items():
+        assert query.select(key, 0, [1, 1, 1])[0].columns == row
+    assert query.select(RECORDS + 1, 0, [1, 1, 1]) == []
+    assert query.select(2, 0, [1, 1, 1]) == []
+    assert query.select(777, 1, [1, 1, 1]) == []
+    # new inserts go after the recovered records
+    assert query.insert(RECORDS + 2, 2, 2)
+    assert query.select(RECORDS, 0, [1, 1, 1])[0].columns == [RECORDS, 1, 1]
+
+    db, table, query = databases.open()
+    assert db.recovery_stats['records'] == 0
+    for key, row in expected_rows().items():
+        assert query.select(key, 0, [1, 1, 1])[0].columns == row
+
+
+def test_unlogged_change_never_reaches_the_page_files(grades, databases):
+    _, table, query = grades
+    for key in range(10):
+        assert query.insert(key, key, key)
+    databases.close()
+
+    def work(db, table, query):
+        start_loser()
+        assert query.update(3, None, 333, None)
+
+    crash(databases, work)
+
+    _, table, query = databases.open()
+    assert query.select(3, 0, [1, 1, 1])[0].columns == [3, 3, 3]
+    assert query.sum(0, 9, 1) == sum(range(10))
+
+
+def write_back_unpinned_pages(bufferpool):
+    # what a reader faulting pages in may do at any moment: write back every dirty record page nobody has pinned
+    with bufferpool.latch:
+        for key, frame in zip(bufferpool.frame_info, bufferpool.frames):
+            if key is not None and key[3] != 'i' and frame.dirtyBit and not frame.is_pinned():
+                bufferpool.write_to_disk(key, frame)
+
+
+@pytest.mark.parametrize('change', [
+    lambda query: query.update(3, None, 333, None),
+    lambda query: query.delete(3),
+    lambda query: query.insert(10, 10, 10),
+], ids=['update', 'delete', 'insert'])
+def test_change_is_logged_before_its_pages_can_be_written_back(grades, databases, change):
+    _, table, query = grades
+    for key in range(10):
+        assert query.insert(key, key, key)
+    databases.close()
+
+    def work(db, table, query):
+        wal = table.bufferpool.wal
+        log_change = wal.log_change
+
+        def write_back_first(*args, **kwargs):
+            write_back_unpinned_pages(table.bufferpool)
+            return log_change(*args, **kwargs)
+
+        wal.log_change = write_back_first
+        start_loser()
+        assert change(query)
+
+    crash(databases, work)
+
+    _, table, query = databases.open()
+    # the latest version, which writing transactions read, as well as the snapshot reads
+    assert table.read_record(table.index.locate(0, 3)[0]) == [3, 3, 3]
+    assert query.select(3, 0, [1, 1, 1])[0].columns == [3, 3, 3]
+    assert query.select(10, 0, [1, 1, 1]) == []
+    assert query.sum(0, 10, 1) == sum(range(10))
+
+
+def test_recovery_after_crash_without_clean_close(grades, databases):
+    databases.close()
+
+    def work(db, table, query):
+        for key in range(RECORDS):
+            assert query.insert(key, key, -key)
+        committed_work(table, query)
+        start_loser()
+        assert query.update(4, None, 444, None)
+        table.bufferpool.wal.flush()
+
+    crash(databases, work)
+
+    _, table, query = databases.open()
+    for key, row in expected_rows().items():
+        assert query.select(key, 0, [1, 1, 1])[0].columns == row
+    assert query.sum(0, RECORDS, 1) == sum(row[1] for row in expected_rows().values())
+
+
+def test_checkpoint_under_load_shrinks_the_log_and_keeps_recovery_right(grades, databases):
+    _, table, query = grades
+    for key in range(RECORDS):
+        assert query.insert(key, key, -key)
+    databases.close()
+    concurrent_keys = range(501, RECORDS, 10)
+
+    def concurrent_work(table, query):
+        for key in concurrent_keys:
+            transaction = Transaction()
+            transaction.add_query(query.update, table, key, None, None, 1)
+            assert transaction.run()
+
+    def work(db, table, query):
+        committed_work(table, query)
+        wal = table.bufferpool.wal
+        loser = start_loser()
+        assert query.update(7, None, 777, 777)
+        assert query.delete(8)
+        assert query.insert(RECORDS + 1, 9, 9)
+        size = wal.size()
+        first_loser_lsn = wal.active[loser.txn_id]
+
+        # winners keep committing while the checkpoint writes back every page, the loser's included
+        thread = threading.Thread(target=concurrent_work, args=(table, query))
+        thread.start()
+        _, kept = checkpoint(db)
+        thread.join()
+        assert wal.start_lsn == first_loser_lsn
+        assert kept < size
+        wal.flush()
+
+    crash(databases, work)
+
+    rows = expected_rows()
+    for key in concurrent_keys:
+        rows[key][2] = 1
+    db, table, query = databases.open()
+    assert db.recovery_stats['losers'] == 1
+    for key, row in rows.items():
+        assert query.select(key, 0, [1, 1, 1])[0].columns == row
+    assert query.select(RECORDS + 1, 0, [1, 1, 1]) == []
+    assert query.select(777, 1, [1, 1, 1]) == []
@@ -0,0 +1,107 @@
+import pytest
+
+import lstore.bufferpool
+from lstore.replacement import ClockPolicy, LRUKPolicy, LRUPolicy, REPLACEMENT_POLICIES
+
+FRAMES = 16  # small enough that the workload below evicts all the time
+RECORDS = 3000
+
+
+def accessed(policy, *frame_indices):
+    for frame_index in frame_indices:
+        policy.record_access(frame_index)
+    return policy
+
+
+def unpinned(frame_index):
+    return False
+
+
+def pinned(*frame_indices):
+    return lambda frame_index: frame_index in frame_indices
+
+
+def victims(policy, count):
+    # Evict the way the bufferpool does: the victim's slot is emptied before it is reused
+    order = []
+    for _ in range(count):
+        frame_index = policy.victim(unpinned)
+        policy.remove(frame_index)
+        order.append(frame_index)
+    return order
+
+
+def test_lru_evicts_least_recently_used_first():
+    policy = accessed(LRUPolicy(4), 0, 1, 2, 3, 1, 0)
+    assert victims(policy, 4) == [2, 3, 1, 0]
+
+
+def test_clock_gives_referenced_frames_a_second_chance():
+    policy = accessed(ClockPolicy(4), 0, 1, 2, 3)
+    # The first sweep clears every reference bit, then the hand comes back round to slot 0
+    assert policy.victim(unpinned) == 0
+    policy.remove(0)
+    policy.record_access(1)
+    # Slot 1 was referenced again since the sweep, so the hand passes it
+    assert policy.victim(unpinned) == 2
+    policy.remove(2)
+    assert policy.victim(unpinned) == 3
+
+
+def test_clock_skips_empty_slots():
+    policy = accessed(ClockPolicy(4), 1, 3)
+    assert victims(policy, 2) == [1, 3]
+    assert policy.victim(unpinned) is None
+
+
+def test_lru_k_evicts_the_oldest_kth_most_recent_access():
+    # Slot 0's second most recent access is the oldest of the three
+    policy = accessed(LRUKPolicy(3, k=2), 0, 1, 2, 0, 1, 2, 1, 2, 0)
+    assert victims(policy, 3) == [0, 1, 2]
+
+
+def test_lru_k_evicts_slots_with_fewer_than_k_accesses_first():
+    # Slots 2 and 3 were used only once, so they go first, oldest access first, however recent they are
+    policy = accessed(LRUKPolicy(4, k=2), 0, 0, 1, 1, 2, 3)
+    assert victims(policy, 4) == [2, 3, 0, 1]
+
+
+def test_lru_k_forgets_removed_slots():
+    policy = accessed(LRUKPolicy(3, k=2), 0, 0, 1)
+    policy.remove(1)
+    # Slot 1 comes back with a fresh history of one access, which is why it is evicted first again
+    policy.record_access(1)
+    policy.record_access(2)
+    policy.record_access(2)
+    assert victims(policy, 3) == [1, 0, 2]
+
+
+@pytest.mark.parametrize('name', REPLACEMENT_POLICIES)
+def test_victim_skips_pinned_frames(name):
+    policy = accessed(REPLACEMENT_POLICIES[name](4), 0, 1, 2, 3)
+    assert policy.victim(pinned(0, 1)) == 2
+
+
+@pytest.mark.parametrize('name', REPLACEMENT_POLICIES)
+def test_victim_is_none_when_every_frame_is_pinned(name):
+    policy = accessed(REPLACEMENT_POLICIES[name](4), 0, 1, 2, 3)
+    assert policy.victim(pinned(0, 1, 2, 3)) is None
+    # Pinning does not lose track of the frames
+    assert policy.victim(pinned(0, 1, 3)) == 2
+
+
+@pytest.mark.parametrize('name', REPLACEMENT_POLICIES)
+def test_database_runs_under_each_policy(monkeypatch, databases, name):
+    monkeypatch.setattr(lstore.bufferpool, 'REPLACEMENT_POLICY', name)
+    monkeypatch.setattr(lstore.bufferpool, 'FRAMECOUNT', FRAMES)
+
+    db, _, query = databases.open(create=True)
+    for key in range(RECORDS):
+        assert query.insert(key, key, 0)
+    for key in range(0, RECORDS, 3):
+        assert query.update(key, None, None, key + 1)
+    assert db.bufferpool.numFrames == FRAMES
+
+    _, _, query = databases.open()
+    for key in range(RECORDS):
+        assert query.select(key, 0, [1, 1, 1])[0].columns == [key, key, int(key % 3 == 0) * (key + 1)]
@@ -0,0 +1,60 @@
+from lstore.transaction import Transaction
+from lstore.transaction_worker import TransactionWorker
+
+
+def crash(*args):
+    raise RuntimeError("query crashed")
+
+
+def test_query_raising_aborts_the_transaction(grades):
+    _, table, query = grades
+    assert query.insert(1, 10, 0)
+
+    transaction = Transaction()
+    transaction.add_query(query.update, table, 1, None, 20, None)
+    transaction.add_query(query.insert, table, 2, 2, 2)
+    transaction.add_query(crash, table)
+    assert transaction.run() is False
+
+    # its changes are undone and its locks released
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 10, 0]
+    assert query.select(2, 0, [1, 1, 1]) == []
+    assert query.select(20, 1, [1, 1, 1]) == []
+    assert transaction.held_locks == set()
+    # and it ended with an ABORT record, so it does not hold back log truncation
+    assert table.bufferpool.wal.active == {}
+
+    other = Transaction()
+    other.add_query(query.update, table, 1, None, 30, None)
+    assert other.run()
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 30, 0]
+
+
+def test_query_raising_in_a_worker_counts_as_an_abort(grades):
+    _, table, query = grades
+    assert query.insert(1, 10, 0)
+
+    failing = Transaction()
+    failing.add_query(query.update, table, 1, None, 20, None)
+    failing.add_query(crash, table)
+    passing = Transaction()
+    passing.add_query(query.update, table, 1, None, 30, None)
+    worker = TransactionWorker([failing, passing])
+    worker.run()
+    worker.join()
+
+    assert worker.summary()['commits'] == 1
+    assert worker.summary()['aborts'] == 1
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 30, 0]
+
+
+def test_failed_query_aborts_the_transaction(grades):
+    _, table, query = grades
+    assert query.insert(1, 10, 0)
+
+    transaction = Transaction()
+    transaction.add_query(query.update, table, 1, None, 20, None)
+    # no record has key 5
+    transaction.add_query(query.update, table, 5, None, 20, None)
+    assert transaction.run() is False
+    assert query.select(1, 0, [1, 1, 1])[0].columns == [1, 10, 0]